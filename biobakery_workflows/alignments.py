@@ -0,0 +1,256 @@
+"""
+bioBakery Workflows: alignments module
+Functions to compress, index, and read subsets of sam alignment files
+
+Copyright (c) 2016 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import sys
+import zlib
+import heapq
+import shutil
+import tempfile
+
+# A compressed sam file is a series of independent gzip members (blocks) so it
+# can be read with zcat or any gzip reader. The alignments are sorted by reference
+# and the index has the offset of each block and the blocks for each reference.
+COMPRESSED_SAM_EXTENSION=".gz"
+INDEX_EXTENSION=".idx"
+INDEX_COMMENT="# biobakery_workflows sam index"
+HEADER_REFERENCE="@"
+
+SAM_REFERENCE_INDEX=2
+
+# the uncompressed size of each block
+BLOCK_SIZE=64*1024
+
+# the most alignments to sort in memory at once
+MAX_SORT_LINES=500000
+
+def index_file(file):
+    """ Get the name of the index for the compressed sam file """
+
+    return file+INDEX_EXTENSION
+
+def is_indexed(file):
+    """ Check if the sam file is compressed and indexed """
+
+    return file.endswith(COMPRESSED_SAM_EXTENSION) and os.path.isfile(index_file(file))
+
+def get_reference(line):
+    """ Get the reference name from a sam alignment line (as bytes) """
+
+    data=line.split(b"\t",SAM_REFERENCE_INDEX+1)
+    return data[SAM_REFERENCE_INDEX] if len(data) > SAM_REFERENCE_INDEX else b"*"
+
+def decode(line):
+    """ Convert bytes read from the file to a string """
+
+    return line.decode("utf-8") if sys.version_info[0] > 2 else line
+
+def spill_alignments(folder, alignments):
+    """ Write the alignments grouped by reference (in input order for each reference) to a temp file """
+
+    spill=tempfile.mkstemp(dir=folder)
+    with os.fdopen(spill[0],"wb") as file_handle:
+        for reference in sorted(alignments):
+            file_handle.writelines(alignments[reference])
+    return spill[1]
+
+def read_spill(spill, number):
+    """ Read the alignments from a temp file with a key to merge by reference then input order """
+
+    with open(spill,"rb") as file_handle:
+        for line_number, line in enumerate(file_handle):
+            yield get_reference(line), number, line_number, line
+
+def compress_sam(input, output, block_size=BLOCK_SIZE, max_sort_lines=MAX_SORT_LINES):
+    """ Compress a sam file into blocks, sorted by reference, and write the index
+
+    Args:
+        input (string): The sam file
+        output (string): The compressed sam file to write (the index is written to output.idx)
+        block_size (int): The uncompressed size of each block
+        max_sort_lines (int): The most alignments to sort in memory at once
+    """
+
+    folder=tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        # sort the alignments by reference, spilling to temp files
+        header=[]
+        alignments={}
+        total_lines=0
+        spills=[]
+        with open(input,"rb") as file_handle:
+            for line in file_handle:
+                if line.startswith(b"@"):
+                    header.append(line)
+                    continue
+                alignments.setdefault(get_reference(line),[]).append(line)
+                total_lines+=1
+                if total_lines >= max_sort_lines:
+                    spills.append(spill_alignments(folder, alignments))
+                    alignments={}
+                    total_lines=0
+        if alignments or not spills:
+            spills.append(spill_alignments(folder, alignments))
+
+        blocks=[]
+        references=[]
+        with open(output,"wb") as file_handle:
+            def write_block(lines):
+                data=b"".join(lines)
+                compressor=zlib.compressobj(6, zlib.DEFLATED, 31)
+                compressed=compressor.compress(data)+compressor.flush()
+                blocks.append((file_handle.tell(), len(compressed)))
+                file_handle.write(compressed)
+
+            def add_reference(reference, first_block, last_block):
+                if references and references[-1][0] == reference:
+                    references[-1][2]=last_block
+                else:
+                    references.append([reference, first_block, last_block])
+
+            # write the header lines first
+            if header:
+                write_block(header)
+                add_reference(HEADER_REFERENCE.encode("utf-8"), 0, 0)
+
+            # write the alignments in blocks, recording the blocks for each reference
+            block=[]
+            block_length=0
+            block_references=[]
+            merged=heapq.merge(*[read_spill(spill, number) for number, spill in enumerate(spills)])
+            for reference, number, line_number, line in merged:
+                block.append(line)
+                block_length+=len(line)
+                if not block_references or block_references[-1] != reference:
+                    block_references.append(reference)
+                if block_length >= block_size:
+                    for block_reference in block_references:
+                        add_reference(block_reference, len(blocks), len(blocks))
+                    write_block(block)
+                    block=[]
+                    block_length=0
+                    block_references=[]
+            if block:
+                for block_reference in block_references:
+                    add_reference(block_reference, len(blocks), len(blocks))
+                write_block(block)
+
+        with open(index_file(output)+".tmp","w") as file_handle:
+            file_handle.write(INDEX_COMMENT+"\n")
+            for offset, size in blocks:
+                file_handle.write("\t".join(["block",str(offset),str(size)])+"\n")
+            for reference, first_block, last_block in references:
+                file_handle.write("\t".join(["reference",decode(reference),str(first_block),str(last_block)])+"\n")
+        os.rename(index_file(output)+".tmp", index_file(output))
+    finally:
+        shutil.rmtree(folder)
+
+def read_index(file):
+    """ Read the index for a compressed sam file
+
+    Returns:
+        (list): The offset and compressed size of each block
+        (dict): The first and last block for each reference
+    """
+
+    blocks=[]
+    references={}
+    with open(index_file(file)) as file_handle:
+        for line in file_handle:
+            data=line.rstrip("\n").split("\t")
+            if data[0] == "block":
+                blocks.append((int(data[1]),int(data[2])))
+            elif data[0] == "reference":
+                references[data[1]]=(int(data[2]),int(data[3]))
+    return blocks, references
+
+def references(file):
+    """ Get the names of the references with alignments in the compressed sam file """
+
+    return [reference for reference in read_index(file)[1] if reference != HEADER_REFERENCE]
+
+def read_blocks(file, blocks, block_numbers):
+    """ Read and decompress the blocks in order, yielding the lines in each block """
+
+    with open(file,"rb") as file_handle:
+        for number in sorted(block_numbers):
+            offset, size = blocks[number]
+            file_handle.seek(offset)
+            for line in zlib.decompress(file_handle.read(size), 31).splitlines(True):
+                yield decode(line)
+
+def read_lines(file):
+    """ Read all of the lines from a sam file (allowing for gzip compression) """
+
+    if file.endswith(".gz"):
+        import gzip
+        file_handle=gzip.open(file,"rt" if sys.version_info[0] > 2 else "r")
+    else:
+        file_handle=open(file)
+
+    with file_handle:
+        for line in file_handle:
+            yield line
+
+def read_sam_lines(file, references=None, header=False):
+    """ Read the alignment lines from a sam file. If the file is compressed
+        and indexed only the blocks with the references are read, otherwise
+        all lines are read and filtered.
+
+    Args:
+        file (string): The sam file (or compressed and indexed sam file)
+        references (set): Only read alignments to these references (optional)
+        header (bool): Also read the header lines
+
+    Returns:
+        (generator): The lines from the file
+    """
+
+    if references is not None and not isinstance(references, (set, dict)):
+        references=set(references)
+
+    if is_indexed(file):
+        blocks, index = read_index(file)
+        names=list(index.keys()) if references is None else [name for name in references if name in index]
+        if header and HEADER_REFERENCE in index:
+            names.append(HEADER_REFERENCE)
+        block_numbers=set()
+        for name in names:
+            first_block, last_block = index[name]
+            block_numbers.update(range(first_block, last_block+1))
+        lines=read_blocks(file, blocks, block_numbers)
+    else:
+        lines=read_lines(file)
+
+    for line in lines:
+        if line.startswith("@"):
+            if header:
+                yield line
+        elif references is None:
+            yield line
+        else:
+            data=line.split("\t",SAM_REFERENCE_INDEX+1)
+            if len(data) > SAM_REFERENCE_INDEX and data[SAM_REFERENCE_INDEX] in references:
+                yield line
@@ -33,7 +33,14 @@ except ImportError:
     sys.exit("Please upgrade to python v2.7")
 
 import os
-import subprocess
+import time
+import runpy
+
+# try to import the builtins module for python3
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
 
 VERSION = "0.15.1"
 WORKFLOW_FOLDER="workflows"
@@ -47,11 +54,86 @@ def find_workflows():
     for file in os.listdir(workflow_folder):
         # look for files with the expected extension
         if file.endswith(WORKFLOW_EXTENSION):
-            # do not need to add full path as these are also installed as executable scripts
-            workflows[file.replace(WORKFLOW_EXTENSION,"")]=file
+            workflows[file.replace(WORKFLOW_EXTENSION,"")]=os.path.join(workflow_folder,file)
     
     return workflows
 
+class ImportProfiler(object):
+    """ Record the time spent importing each module while active (stopping when
+        the workflow starts running the tasks) """
+
+    def __init__(self, max_modules=25):
+        self.max_modules=max_modules
+        self.timings=[]
+        self.depth=0
+        self.active=False
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=None, *args, **kwargs):
+        """ Import the module recording the time if any new modules were imported
+            (this includes submodules imported from packages already loaded) """
+
+        args=(globals, locals, fromlist)+args
+        loaded=len(sys.modules)
+        start=time.time()
+        self.depth+=1
+        try:
+            return self.original_import(name, *args, **kwargs)
+        finally:
+            self.depth-=1
+            if len(sys.modules) > loaded:
+                # relative imports (ie "from . import utilities") do not include a name
+                if fromlist:
+                    name=(name or "")+"."+",".join(fromlist)
+                self.timings.append((time.time()-start, self.depth, name))
+
+    def __enter__(self):
+        self.start=time.time()
+        self.original_import=builtins.__import__
+        builtins.__import__=self.timed_import
+        self.active=True
+
+        # stop when the workflow starts running the tasks so only the startup is profiled
+        from anadama2.workflow import Workflow
+        self.original_go=Workflow.go
+        profiler=self
+        def go(workflow, *args, **kwargs):
+            profiler.stop()
+            return profiler.original_go(workflow, *args, **kwargs)
+        Workflow.go=go
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def stop(self):
+        """ Stop recording the imports and print the report """
+
+        if not self.active:
+            return
+        self.active=False
+        builtins.__import__=self.original_import
+        from anadama2.workflow import Workflow
+        Workflow.go=self.original_go
+        self.report()
+
+    def report(self):
+        """ Print the slowest imports, including the time for nested imports """
+
+        total=time.time()-self.start
+        import_total=sum(seconds for seconds, depth, name in self.timings if depth == 0)
+        sys.stderr.write("\nStartup profile: {:.3f} sec total, {:.3f} sec in {} imports of new modules\n".format(
+            total, import_total, len(self.timings)))
+        for seconds, depth, name in sorted(self.timings, reverse=True)[:self.max_modules]:
+            sys.stderr.write("{:10.3f} sec  {}{}\n".format(seconds, "  "*depth, name))
+
+def split_arguments(args):
+    """ Split the arguments into those for the launcher and those for the workflow """
+
+    for index, arg in enumerate(args):
+        if not arg.startswith("-"):
+            return args[:index+1], args[index+1:]
+    return args, []
+
 def parse_arguments(args,workflows):
     """ 
     Parse the arguments from the user
@@ -64,6 +146,10 @@ def parse_arguments(args,workflows):
         "--version",
         action="version",
         version="%(prog)s v"+VERSION)
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="print the time spent importing modules (set before the workflow name)")
     parser.add_argument(
         "workflow",
         choices=workflows,
@@ -72,24 +158,33 @@ def parse_arguments(args,workflows):
     return parser.parse_args(args)
 
 def run_workflow(args, workflow):
-    """ Run the workflow with the arguments provided """
-    
+    """ Run the workflow in this process with the arguments provided """
+
+    # check the workflow can be read (errors from running the workflow are not caught)
     try:
-        command = [workflow]+args[2:]
-        subprocess.call(command)
-    except ( subprocess.CalledProcessError, EnvironmentError):
-        sys.exit("Error: Unable to run workflow: " +" ".join(command))
+        open(workflow).close()
+    except EnvironmentError:
+        sys.exit("Error: Unable to read workflow: " + workflow)
+
+    # set the arguments as if the workflow was run as a script
+    sys.argv = [workflow]+args
+    runpy.run_path(workflow, run_name="__main__")
 
 
 def main():
     # find workflows
     workflows=find_workflows()
     
-    # parse the arguments (only the first two as the rest are for the workflow)
-    args=parse_arguments(sys.argv[1:2],workflows.keys())
+    # parse the arguments (only those up to the workflow name as the rest are for the workflow)
+    launcher_args, workflow_args = split_arguments(sys.argv[1:])
+    args=parse_arguments(launcher_args,workflows.keys())
     
-    # run the workflow (providing all of the arguments)
-    run_workflow(sys.argv,workflows[args.workflow])
+    # run the workflow (providing all of the remaining arguments)
+    if args.profile_startup:
+        with ImportProfiler():
+            run_workflow(workflow_args,workflows[args.workflow])
+    else:
+        run_workflow(workflow_args,workflows[args.workflow])
     
     
 if __name__ == "__main__":
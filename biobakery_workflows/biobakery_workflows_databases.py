@@ -35,6 +35,7 @@ import argparse
 import os
 import subprocess
 import shutil
+import tempfile
 import zipfile
 
 def check_dependencies(depends):
@@ -95,71 +96,128 @@ def create_strainphlan_db(location):
     print("Generating strainphlan fasta database")
     run_command(" ".join(["bowtie2-inspect",strainphlan_db,">",os.path.join(install_folder,"all_markers.fasta")]),shell=True)
 
-def parse_arguments(args):
-    """ 
-    Parse the arguments from the user
-    """
-    parser = argparse.ArgumentParser(
-        description= "bioBakery workflows databases\n",
-        formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument(
-        "--available", 
-        action="store_true",
-        help="print the available databases\n")
-    parser.add_argument(
-        "--install",
-        metavar="<workflow>",
-        choices=["wmgx","wmgx_demo","wmgx_wmtx","16s_usearch","16s_dada2","16s_its","isolate_assembly"],
-        help="install the databases for the selected workflow\n")
-    parser.add_argument(
-        "--location", 
-        default=default_install_location(),
-        help="location to install databases [DEFAULT: "+default_install_location()+")]\n")
-    
-    return parser.parse_args()
+def install_paths(install, location, humann2_install_folder):
+    """ Get the folders (and files) in the location written by the install of the database set """
+
+    paths=[]
+    if "wmgx" in install:
+        paths+=[os.path.join(humann2_install_folder,folder) for folder in ["chocophlan","uniref","utility_mapping"]]
+        paths+=[os.path.join(location,config.ShotGun.vars[name].default_folder)
+            for name in ["strainphlan_db_markers","strainphlan_db_reference","kneaddata_db_human_genome"]]
+    if install == "wmgx_wmtx":
+        paths+=[os.path.join(location,config.ShotGun.vars[name].default_folder)
+            for name in ["kneaddata_db_rrna","kneaddata_db_human_metatranscriptome"]]
+    elif install == "16s_usearch":
+        paths+=[os.path.join(location,config.SixteenS.vars[name].default_path)
+            for name in ["greengenes_fasta","greengenes_usearch","greengenes_taxonomy"]]
+    elif install == "16s_dada2":
+        paths+=[os.path.join(location,config.SixteenS.vars[name].default_path)
+            for name in ["greengenes_dada2","rdp_dada2","silva_dada2","rdp_species_dada2","silva_species_dada2"]]
+    elif install == "16s_its":
+        paths+=[os.path.join(location,config.SixteenS.vars["unite_zip"].default_path),
+            os.path.join(location,config.SixteenS.vars["unite"].default_folder)]
+    elif install == "isolate_assembly":
+        paths.append(os.path.join(location,"eggnog_mapper"))
+    return paths
+
+def install_files(location, paths):
+    """ Get the relative paths of the database files in the location found in the
+        install paths (so the files of other sets in the location are not included) """
+
+    files=set()
+    for install_path in paths:
+        if os.path.isfile(install_path):
+            found=[install_path]
+        else:
+            found=[os.path.join(root,name) for root, folders, names in os.walk(install_path) for name in names]
+        for file in found:
+            # skip any links outside of the database set
+            if not os.path.islink(file):
+                files.add(os.path.relpath(file,location))
+    return sorted(files)
+
+def store_object_path(store, checksum):
+    """ Get the path to the object in the store for the checksum """
+
+    return os.path.join(store,"objects",checksum[0:2],checksum[2:])
+
+def store_manifest_path(store, install):
+    """ Get the path to the manifest in the store for the database set """
+
+    return os.path.join(store,"manifests",install+".tsv")
+
+def provision_from_store(store, install, location):
+    """ Link the database set from the store into the install location,
+        return False if the store does not hold a complete copy of the set """
+
+    manifest_file=store_manifest_path(store, install)
+    if not os.path.isfile(manifest_file):
+        return False
+
+    manifest=utilities.read_manifest(manifest_file)
+    if not all(os.path.isfile(store_object_path(store, checksum)) for checksum in manifest.values()):
+        print("WARNING: The database store is missing files for "+install+". Reinstalling.")
+        return False
+
+    print("Provisioning "+install+" databases from store: "+store)
+    methods=set()
+    for path, checksum in manifest.items():
+        methods.add(utilities.link_file(store_object_path(store, checksum),os.path.join(location,path)))
+    if "copy" in methods:
+        print("WARNING: Unable to hardlink or reflink from the store to the install location. "+
+            "Some database files were copied (the store and location must be on the same file system to link).")
+
+    utilities.write_manifest(manifest,os.path.join(location,"manifest_"+install+".tsv"))
+    return True
+
+def move_to_store(install_file, object_file):
+    """ Move the file into the store through a temp name in the object folder
+        so an incomplete object is never visible in the store """
+
+    object_folder=os.path.dirname(object_file)
+    try_create_folder(object_folder)
+    file_handle, temp_file=tempfile.mkstemp(dir=object_folder,prefix=".tmp_")
+    os.close(file_handle)
+    try:
+        shutil.move(install_file,temp_file)
+        os.chmod(temp_file,0o444)
+        os.rename(temp_file,object_file)
+    except EnvironmentError:
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+        raise
+
+def add_to_store(store, install, location, humann2_install_folder):
+    """ Move the files installed for the database set into the store,
+        keyed by checksum and read-only, then link them back into the install location """
+
+    print("Adding "+install+" databases to store: "+store)
+    manifest={}
+    for path in install_files(location, install_paths(install, location, humann2_install_folder)):
+        install_file=os.path.join(location,path)
+        checksum=utilities.file_checksum(install_file)
+        manifest[path]=checksum
+
+        object_file=store_object_path(store, checksum)
+        if not os.path.isfile(object_file):
+            move_to_store(install_file, object_file)
+        utilities.link_file(object_file,install_file)
+
+    utilities.write_manifest(manifest,store_manifest_path(store, install))
+    utilities.write_manifest(manifest,os.path.join(location,"manifest_"+install+".tsv"))
+
+def configure_humann2(humann2_install_folder):
+    """ Update the humann2 configuration to use the databases in the install folder """
+
+    for database, folder in [("nucleotide","chocophlan"),("protein","uniref"),("utility_mapping","utility_mapping")]:
+        if os.path.isdir(os.path.join(humann2_install_folder,folder)):
+            run_command(["humann2_config","--update","database_folders",database,
+                os.path.join(humann2_install_folder,folder)])
+
+def download_databases(args, humann2_install_folder):
+    """ Download the databases for the workflow selected """
 
-def main():
-    # Parse arguments from the command line
-    args=parse_arguments(sys.argv)
-    
-    # if no option is set, show available databases
-    if not args.install and not args.available:
-        args.available = True
-        
-    if args.available:
-        print("There are five available database sets each corresponding to a data "+
-            "processing workflow.\n"+
-            "wmgx: The full databases for the whole metagenome workflow\n"+
-            "wmgx_demo: The demo databases for the whole metagenome workflow\n"+
-            "wmgx_wmtx: The full databases for the whole metagenome and metatranscriptome workflow\n"+
-            "16s_usearch: The full databases for the 16s workflow\n" +
-            "16s_dada2: The full databases for the dada2 workflow\n"+
-            "16s_its: The unite database for the its workflow\n"+
-            "isolate_assembly: The eggnog-mapper databases for the assembly workflow")
-        sys.exit(0)
-    
-    # Check the install location
-    if not args.location:
-        sys.exit("Please select the install location as the default options are not writable")
-        
-    if not args.install:
-        sys.exit("Please select a database set to install")
-        
-    # try to create the base install folder
-    try_create_folder(args.location)
-    
-    # check required dependencies are installed for wmgx installs
-    dependencies=[]
-    if "wmgx" in args.install:
-        dependencies=[("humann2_databases","HUMAnN2"),("kneaddata_database","Kneaddata"),
-            ("strainphlan.py","StrainPhlAn"),("bowtie2-inspect","Bowtie2")]
-    elif "usearch" in args.install:
-        dependencies=[("usearch","usearch")]    
-    if dependencies:
-        check_dependencies(dependencies)
-        
     # install humann2 utility dbs for all shotgun workflows
-    humann2_install_folder=os.path.join(args.location,"humann2")
     if "wmgx" in args.install:
         print("Installing humann2 utility mapping database")
         run_command(["humann2_databases","--download","utility_mapping","full",humann2_install_folder])
@@ -233,13 +291,7 @@ def main():
         eggnog_install_path = os.path.join(args.location, "eggnog_mapper/")
         try_create_folder(eggnog_install_path)
         run_command(["download_eggnog_data.py","--data_dir",eggnog_install_path,"-y"])
-        run_command(["ln","-s",eggnog_install_path+"/eggnog.db","/opt/conda/bin/data/"])
-        run_command(["ln","-s",eggnog_install_path+"/eggnog_proteins.dmnd","/opt/conda/bin/data/"])
 
-    if "16s" in args.install:
-        # install the picrust databases
-        run_command(["download_picrust_files.py"])
-       
     # if metatranscriptome workflow, install the additional kneaddata database
     if args.install == "wmgx_wmtx":
         print("Installing rRNA and mRNA kneaddata database")
@@ -247,9 +299,110 @@ def main():
             os.path.join(args.location,config.ShotGun.vars["kneaddata_db_rrna"].default_folder)])
         run_command(["kneaddata_database","--download","human_transcriptome","bowtie2",
             os.path.join(args.location,config.ShotGun.vars["kneaddata_db_human_metatranscriptome"].default_folder)])
-        
+
+def print_location_message(args):
+    """ Print a message about setting the environment variable for custom install locations """
+
     # Check for a custom install location
     if args.location != default_install_location():
         print("\n\nA custom install location was selected. Please set the "+
             "environment variable $"+config.Workflow.base_environment_variable+" to the install location.")
     
+
+def parse_arguments(args):
+    """ 
+    Parse the arguments from the user
+    """
+    parser = argparse.ArgumentParser(
+        description= "bioBakery workflows databases\n",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        "--available", 
+        action="store_true",
+        help="print the available databases\n")
+    parser.add_argument(
+        "--install",
+        metavar="<workflow>",
+        choices=["wmgx","wmgx_demo","wmgx_wmtx","16s_usearch","16s_dada2","16s_its","isolate_assembly"],
+        help="install the databases for the selected workflow\n")
+    parser.add_argument(
+        "--location", 
+        default=default_install_location(),
+        help="location to install databases [DEFAULT: "+default_install_location()+")]\n")
+    parser.add_argument(
+        "--database-store",
+        help="shared read-only store of database files keyed by checksum\n"+
+             "databases found in the store are hardlinked (or reflinked) into the\n"+
+             "install location instead of downloaded, new installs are added to the store\n")
+    
+    return parser.parse_args()
+
+def main():
+    # Parse arguments from the command line
+    args=parse_arguments(sys.argv)
+    
+    # if no option is set, show available databases
+    if not args.install and not args.available:
+        args.available = True
+        
+    if args.available:
+        print("There are five available database sets each corresponding to a data "+
+            "processing workflow.\n"+
+            "wmgx: The full databases for the whole metagenome workflow\n"+
+            "wmgx_demo: The demo databases for the whole metagenome workflow\n"+
+            "wmgx_wmtx: The full databases for the whole metagenome and metatranscriptome workflow\n"+
+            "16s_usearch: The full databases for the 16s workflow\n" +
+            "16s_dada2: The full databases for the dada2 workflow\n"+
+            "16s_its: The unite database for the its workflow\n"+
+            "isolate_assembly: The eggnog-mapper databases for the assembly workflow")
+        sys.exit(0)
+    
+    # Check the install location
+    if not args.location:
+        sys.exit("Please select the install location as the default options are not writable")
+        
+    if not args.install:
+        sys.exit("Please select a database set to install")
+        
+    # try to create the base install folder
+    try_create_folder(args.location)
+
+    # link the databases from the shared store if they have already been installed
+    provisioned=False
+    if args.database_store:
+        args.database_store=os.path.abspath(args.database_store)
+        provisioned=provision_from_store(args.database_store, args.install, args.location)
+    
+    # check required dependencies are installed for wmgx installs
+    dependencies=[]
+    if "wmgx" in args.install:
+        dependencies=[("humann2_databases","HUMAnN2"),("kneaddata_database","Kneaddata"),
+            ("strainphlan.py","StrainPhlAn"),("bowtie2-inspect","Bowtie2")]
+    elif "usearch" in args.install:
+        dependencies=[("usearch","usearch")]    
+    if dependencies:
+        check_dependencies(dependencies)
+        
+    humann2_install_folder=os.path.join(args.location,"humann2")
+    if provisioned:
+        # the database files were linked from the store so only update the humann2 configuration
+        if "wmgx" in args.install:
+            configure_humann2(humann2_install_folder)
+    else:
+        download_databases(args, humann2_install_folder)
+
+    if args.install == "isolate_assembly":
+        # link the eggnog mapper databases into the eggnog data folder
+        eggnog_install_path = os.path.join(args.location, "eggnog_mapper/")
+        run_command(["ln","-s",eggnog_install_path+"/eggnog.db","/opt/conda/bin/data/"])
+        run_command(["ln","-s",eggnog_install_path+"/eggnog_proteins.dmnd","/opt/conda/bin/data/"])
+
+    if "16s" in args.install:
+        # install the picrust databases
+        run_command(["download_picrust_files.py"])
+
+    # share the new database files through the store
+    if args.database_store and not provisioned:
+        add_to_store(args.database_store, args.install, args.location, humann2_install_folder)
+
+    print_location_message(args)
@@ -47,6 +47,26 @@ def install_locations():
         
     return options
 
+# the install locations and databases found, resolved once per process
+_existing_install_locations=None
+_database_locations={}
+
+def existing_install_locations():
+    """ Get the default install locations that exist (checked once per process) """
+
+    global _existing_install_locations
+    if _existing_install_locations is None:
+        _existing_install_locations=[folder for folder in install_locations() if os.path.isdir(folder)]
+
+    return _existing_install_locations
+
+def clear_database_locations():
+    """ Clear the resolved database locations so they will be searched again """
+
+    global _existing_install_locations
+    _existing_install_locations=None
+    _database_locations.clear()
+
 class DBInfo(object):
     def __init__(self, name, description, url=None, file_name=None, default_path=None):
         self.name = name
@@ -82,37 +102,73 @@ def get_environment_variable(name):
 class Workflow(object):
     base_environment_variable = "BIOBAKERY_WORKFLOWS_DATABASES"
     
-    def __getattr__(self, name):
-        """ Try to get the database location """
-        
+    def resolve(self, name):
+        """ Search for the database location, returns the location and if it exists.
+            Results are stored so each database is only searched for once per process. """
+
+        database=self.vars[name]
+        key=(database.name, database.default_path)
+        if key in _database_locations:
+            return _database_locations[key]
+
         # first check for the environment variable for the database
-        variable = get_environment_variable(self.vars[name].name)
+        variable = get_environment_variable(database.name)
         
         if not variable:
             # next check for the overall location variable
             base_folder = get_environment_variable(self.base_environment_variable)
             if base_folder:
-                variable = os.path.join(base_folder,self.vars[name].default_path)
+                variable = os.path.join(base_folder,database.default_path)
                 
-        if variable and not (os.path.isfile(variable) or os.path.isdir(variable)):
+        found = bool(variable) and os.path.exists(variable)
+        if not found:
             # if this is not a valid folder/file, then resume search
             variable = None
         
-        # check in the default folders, if not found with env variables
-        if not variable:
-            for folder in install_locations():
-                if os.path.isdir(folder):
-                    variable = os.path.join(folder,self.vars[name].default_path)
-                    if os.path.isfile(variable) or os.path.isdir(variable):
-                        return variable
+            # check in the default folders, if not found with env variables
+            for folder in existing_install_locations():
+                variable = os.path.join(folder,database.default_path)
+                if os.path.exists(variable):
+                    found = True
+                    break
+
+        _database_locations[key]=(variable, found)
+        return variable, found
+
+    def missing_message(self, name):
+        """ Get the message describing where to find the database """
+
+        return ("Unable to find database "+self.vars[name].name+
+            ". "+self.vars[name].description+" Unable to find in default"+
+            " install folders or with environment variables.")
+
+    def __getattr__(self, name):
+        """ Try to get the database location """
+
+        if name not in self.vars:
+            raise AttributeError(name)
+
+        variable, found = self.resolve(name)
         
         if not variable:
-            sys.exit("ERROR: Unable to find database "+self.vars[name].name+
-                ". "+self.vars[name].description+" Unable to find in default"+
-                " install folders or with environment variables.")
+            sys.exit("ERROR: "+self.missing_message(name))
             
         return variable
 
+    def validate_all(self, names=None):
+        """ Check all of the databases (or those selected) can be found, exit
+            reporting all of the missing databases at once """
+
+        # check all of the databases only if none are selected (an empty list checks none)
+        if names is None:
+            names=sorted(self.vars.keys())
+
+        missing=[name for name in names if not self.resolve(name)[1]]
+
+        if missing:
+            sys.exit("ERROR: Unable to find "+str(len(missing))+" required database(s).\n"+
+                "\n".join(self.missing_message(name) for name in missing))
+
 class ShotGun(Workflow):
     vars={}
     vars["kneaddata_db_human_genome"]=DBInfo("KNEADDATA_DB_HUMAN_GENOME",
@@ -274,5 +274,7 @@ class SixteenS(Workflow):
             "The counts included in each step of workflow process"))
     file_info["filtN"]=FileInfo("filtN",
         description=("Folder with N filtered files"))
+    file_info["primers"]=FileInfo("primers",
+        description=("Folder with the primers (in the orientation found) removed from the reads"))
 
         
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# This script will compress a sam file into blocks sorted by reference and write an
+# index of the blocks for each reference (to the output file plus ".idx"). The compressed
+# file can be read with zcat. The index allows reading the alignments to a subset of
+# references (ie the markers for a set of species) without reading the full file.
+# With the decompress option, the blocks for all of the indexed references are
+# streamed to a plain sam file (for tools that only read plain sam files).
+
+import sys
+import os
+import argparse
+
+try:
+    from biobakery_workflows import alignments
+except ImportError:
+    sys.exit("Please install biobakery_workflows")
+
+def parse_arguments(args):
+    """
+    Parse the arguments from the user
+    """
+    parser = argparse.ArgumentParser(
+        description= "Compress and index a sam file\n",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        "-i", "--input",
+        help="the sam file\n[REQUIRED]",
+        metavar="<input.sam>",
+        required=True)
+    parser.add_argument(
+        "-o", "--output",
+        help="the compressed sam file to write\n[REQUIRED]",
+        metavar="<output.sam.gz>",
+        required=True)
+    parser.add_argument(
+        "--remove-input",
+        help="remove the input file after it is compressed",
+        action="store_true")
+    parser.add_argument(
+        "--decompress",
+        help="write a plain sam file with the header and the alignments for all\n"+
+             "indexed references from the compressed input file",
+        action="store_true")
+
+    return parser.parse_args()
+
+def main():
+    # parse arguments from the user
+    args = parse_arguments(sys)
+
+    if args.decompress:
+        try:
+            with open(args.output,"w") as file_handle:
+                for line in alignments.read_sam_lines(args.input, header=True):
+                    file_handle.write(line)
+        except EnvironmentError:
+            sys.exit("ERROR: Unable to decompress sam file: " + args.input)
+        return
+
+    if not args.output.endswith(alignments.COMPRESSED_SAM_EXTENSION):
+        sys.exit("ERROR: The output file must have the extension " + alignments.COMPRESSED_SAM_EXTENSION)
+
+    try:
+        alignments.compress_sam(args.input, args.output)
+    except EnvironmentError:
+        sys.exit("ERROR: Unable to compress sam file: " + args.input)
+
+    if args.remove_input:
+        os.remove(args.input)
+
+    print("Compressed sam file written: " + args.output)
+
+if __name__ == "__main__":
+    main()
@@ -203,10 +203,13 @@ def write_denovo_otu_table(nonchimera_uc_mapping, output_file):
     return sample_list, denovo_otu_table, queries_to_otus
                     
 def count_reads_per_sample(file):
-    """ Count the reads for each sample from the original fasta file """
+    """ Count the reads for each sample from the original fasta file
+        (or read the counts from a table of the original read counts for each sample) """
 
     samples={}
     for line in catch_open(file):
+        if line.startswith("#"):
+            return read_count_table(file)
         if line.startswith(">"):
             try:
                 sample, read = line.replace(">","").split(SAMPLE_READ_DELIMITER)
@@ -221,6 +224,17 @@ def count_reads_per_sample(file):
 
     return sample_counts
 
+def read_count_table(file):
+    """ Read the original read counts for each sample from a table """
+
+    sample_counts={}
+    for line in catch_open(file):
+        if not line.startswith("#") and line.strip():
+            sample, count = line.rstrip("\n").split("\t")
+            sample_counts[sample]=int(count)
+
+    return sample_counts
+
 def write_read_count_table(output_file, original_counts, known_counts, unknown_counts):
     """ Write a table of read counts per sample """
 
@@ -239,7 +253,7 @@ def parse_arguments(args):
     parser.add_argument('input_greengenes_uc',help="The uc file of the alignment results from usearch to green genes.")
     parser.add_argument('input_nonchimera_uc',help="The uc file of alignment results from usearch to nonchimeras.")
     parser.add_argument('input_nonchimera_fasta',help="The uc nonchimeras fasta file.")
-    parser.add_argument('input_original_fasta',help="The original fasta file containing all reads for all samples.")
+    parser.add_argument('input_original_fasta',help="The original fasta file containing all reads for all samples\n(or a table of the original read counts for each sample).")
     parser.add_argument('output_open_ref_tsv',help="The open ref otu table written.")
     parser.add_argument('output_open_ref_fasta',help="The open ref fasta written.")
     parser.add_argument('output_closed_ref_tsv',help="The closed reference otu table written.")
@@ -5,6 +5,7 @@ import os
 import argparse
 import subprocess
 import random
+import tempfile
 
 try:
     from humann2 import config
@@ -12,6 +13,11 @@ try:
 except ImportError:
     sys.exit("Please install humann2.")
 
+try:
+    from biobakery_workflows import alignments
+except ImportError:
+    sys.exit("Please install biobakery_workflows.")
+
 # This script will take as input the bowtie2 alignment file from
 # running humann2 along with a list of species and pathways. The selection list
 # will be formatted as two tab delimited columns of species \t pathway. 
@@ -19,6 +25,13 @@ except ImportError:
 # have headers or comments starting with "#". The script will output a 
 # reduced fasta (or fastq if selected) file that only includes reads that 
 # will map to those species and pathways when running the fastq file as input to humann2.
+# If the alignment file is compressed and indexed (with compress_sam.py) only the blocks
+# with alignments to references for the selected species are read.
+
+# The sam file is read once. The reads that could be written are stored in a temp file
+# (in the output folder) in the order they are first found, and reads, gene families
+# and reactions are tracked by integer ids (the id of a read is its record number
+# in the temp file) to limit the memory used for large alignment files.
 
 # Please note since some pathways have reactions that overlap with other pathways
 # more than just the selected pathways may appear for a specific species. 
@@ -104,10 +117,53 @@ def write_sequence(file_handle, read_name, sequence, quality_scores, output_form
         file_handle.write("+\n")
         file_handle.write(quality_scores+"\n")
 
-def read_sam(file, gene_families_to_use):
-    """ Read the sam file, only reading alignments """
+def reference_species(reference_name):
+    """ Get the species from the reference name (or None if the reference is not a gene) """
+
+    try:
+        return reference_name.split(config.chocophlan_delimiter)[-4].split(".")[-1]
+    except IndexError:
+        return None
+
+class IdMap(object):
+    """ Assign integer ids to names, in the order they are added """
+
+    def __init__(self):
+        self.ids={}
+        self.names=[]
+
+    def add(self, name):
+        """ Get the id for the name, adding it if it is new """
 
-    for line in open(file):
+        try:
+            return self.ids[name]
+        except KeyError:
+            self.ids[name]=len(self.names)
+            self.names.append(name)
+            return self.ids[name]
+
+    def get(self, name):
+        return self.ids.get(name)
+
+    def __len__(self):
+        return len(self.names)
+
+def read_store(file):
+    """ Read the records from the store of reads (in order of read id) """
+
+    with open(file) as file_handle:
+        for read_id, line in enumerate(file_handle):
+            read_name, sequence, quality_scores = line.rstrip("\n").split("\t")
+            yield read_id, read_name, sequence, quality_scores
+
+def read_sam(file, gene_families_to_use, species=None):
+    """ Read the sam file, only reading alignments (for the species if the file is indexed) """
+
+    references=None
+    if species is not None and alignments.is_indexed(file):
+        references=set(filter(lambda reference: reference_species(reference) in species, alignments.references(file)))
+
+    for line in alignments.read_sam_lines(file, references):
         data=line.rstrip().split("\t")
         if len(data) > config.sam_read_quality:
             read_name=data[config.sam_read_name_index]
@@ -177,37 +233,73 @@ def main():
         file_handle=open(args.output,"w")
     except EnvironmentError:
         sys.exit("ERROR: Unable to open output file: " + args.output)
-                
+
+    # the store of reads is removed even if selecting the reads fails
+    store_handle, store_file=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(args.output)),prefix=os.path.basename(args.output)+".")
+    os.close(store_handle)
+    try:
+        write_selected_reads(args, reactions_database, genefamilies, all_genefamilies_in_pathways, file_handle, store_file)
+    finally:
+        os.remove(store_file)
+
+    print("Output file written: " + args.output)
+
+def write_selected_reads(args, reactions_database, genefamilies, all_genefamilies_in_pathways, file_handle, store_file):
+    """ Find the reads for the species and gene families selected (storing the reads
+        that could be written in the store file) and write them to the output file """
+
     # find the reads for the species and pathways selected
     print("Reading sam file")
-    selected_reads=set()
-    reads_to_gene_familes={}
-    reaction_totals={}
+    reads=IdMap()
+    genes=IdMap()
+    reaction_ids=IdMap()
+    # the reactions (as ids) for each gene id and the gene ids for each selected read
+    gene_reactions=[]
+    reads_to_gene_families={}
+    reaction_totals=[]
     
     # open a fasta file to write the species specific sequences for input to metaphlan2
     if args.add_markers:
         species_fasta_file=args.output+".species_specific_reads.fasta"
         species_fasta_file_handle=open(species_fasta_file,"w")
         
+    # reads that are unintegrated can be from any species
+    selected_species=None if args.add_unintegrated else set(genefamilies.keys())
+
+    # write the reads that could be included in the output to the store
+    store_handle=open(store_file,"w")
+
     selected_reads_to_species={}
-    for species, gene_family, read_name, sequence, quality_scores in read_sam(args.input_sam, args.gene_families):
+    for species, gene_family, read_name, sequence, quality_scores in read_sam(args.input_sam, args.gene_families, selected_species):
         # record the reads that align to species/gene families requested
         requested_genes_for_species=genefamilies.get(species,[])
-        if (gene_family in requested_genes_for_species) or ("ALL" in requested_genes_for_species) or (args.add_unintegrated and not(gene_family in all_genefamilies_in_pathways)):
-            selected_reads.add(read_name)
+        selected=(gene_family in requested_genes_for_species) or ("ALL" in requested_genes_for_species) or (args.add_unintegrated and not(gene_family in all_genefamilies_in_pathways))
+        add_marker=args.add_markers and species in genefamilies
+
+        if selected or add_marker:
+            total_reads=len(reads)
+            read_id=reads.add(read_name)
+            if read_id == total_reads:
+                store_handle.write("\t".join([read_name, sequence, quality_scores])+"\n")
+
+        if selected:
             selected_reads_to_species[species]=selected_reads_to_species.get(species,0)+1
-            if not read_name in reads_to_gene_familes:
-                reads_to_gene_familes[read_name]=set()
-            
-            reads_to_gene_familes[read_name].add(gene_family)
+            gene_id=genes.add(gene_family)
+            if gene_id == len(gene_reactions):
+                gene_reactions.append(tuple(reaction_ids.add(reaction) for reaction in reactions_database.find_reactions(gene_family)))
+                reaction_totals.extend([0.0]*(len(reaction_ids)-len(reaction_totals)))
+            reads_to_gene_families.setdefault(read_id,set()).add(gene_id)
             
             # add to the reaction totals count
-            for reaction in reactions_database.find_reactions(gene_family):
-                reaction_totals[reaction]=reaction_totals.get(reaction,0)+1.0
+            for reaction_id in gene_reactions[gene_id]:
+                reaction_totals[reaction_id]+=1.0
                 
         # if this is a species in the list, and we are adding markers, write this to the fasta file for input to metaphlan2
-        if args.add_markers and species in genefamilies.keys():
+        if add_marker:
             write_sequence(species_fasta_file_handle, read_name, sequence, quality_scores, "fasta")
+
+    store_handle.close()
+    selected_reads=set(reads_to_gene_families.keys())
            
     print("Total reads per species based on gene families")
     for species, count in selected_reads_to_species.items():
@@ -219,7 +311,7 @@ def main():
             
     print("Total reads found: " + str(len(selected_reads)))
     
-    # get the markers reads from the species fasta file
+    # get the markers reads from the species fasta file (as read ids)
     marker_reads_to_add=set()
     read_to_species_marker={}
     read_to_marker_name={}
@@ -244,46 +336,45 @@ def main():
             if not line.startswith("#"):
                 read_name, taxon = line.rstrip().split("\t")
                 species = taxon.split("|")[-1]
-                if species in genefamilies.keys():
-                    marker_reads_to_add.add(read_name)
+                read_id = reads.get(read_name)
+                if species in genefamilies and read_id is not None:
+                    marker_reads_to_add.add(read_id)
                     if not species in read_to_species_marker:
                         read_to_species_marker[species]=set()
                         
-                    read_to_species_marker[species].add(read_name)
-                    all_reads_mapping_to_markers.add(read_name)
+                    read_to_species_marker[species].add(read_id)
+                    all_reads_mapping_to_markers.add(read_id)
                     
         # read through the file to identify the name of the marker the reads map to
         for line in open(metaphlan2_bowtie2_file):
             try:
                 read_name, marker_name = line.rstrip().split("\t")
-            except IndexError:
+            except ValueError:
                 continue
             
-            if read_name in all_reads_mapping_to_markers:
-                read_to_marker_name[read_name]=marker_name
+            read_id = reads.get(read_name)
+            if read_id in all_reads_mapping_to_markers:
+                read_to_marker_name[read_id]=marker_name
                     
         print("Found a total of "+str(len(marker_reads_to_add))+" reads to species markers")
+
+    # the read names are no longer needed (the store has the names in order of id)
+    reads=None
     
     if args.percent < 100:
         print("Filtering reads by percent requested: " + str(args.percent))
         filtered_reads=set()
-        current_reaction_totals={reaction:0 for reaction in reaction_totals.keys()}
+        current_reaction_totals=[0]*len(reaction_totals)
         # go through the reads, adding until there is enough in the reaction list
         # to hit the percent requested
-        for read_name in selected_reads:
+        for read_id in sorted(selected_reads):
+            read_reactions=[reaction_id for gene_id in reads_to_gene_families[read_id] for reaction_id in gene_reactions[gene_id]]
             # check if this read is needed into increase the reaction percents
-            add_read=False
-            for gene in reads_to_gene_familes[read_name]:
-                for reaction in reactions_database.find_reactions(gene):
-                    if (current_reaction_totals[reaction]/reaction_totals[reaction])*100 < args.percent:
-                        add_read=True
-                        
-            if add_read:
-                filtered_reads.add(read_name)
+            if any((current_reaction_totals[reaction_id]/reaction_totals[reaction_id])*100 < args.percent for reaction_id in read_reactions):
+                filtered_reads.add(read_id)
                 # update the current reaction counts
-                for gene in reads_to_gene_familes[read_name]:
-                    for reaction in reactions_database.find_reactions(gene):
-                        current_reaction_totals[reaction]+=1
+                for reaction_id in read_reactions:
+                    current_reaction_totals[reaction_id]+=1
                         
         # update the selected reads to those that are filtered
         selected_reads=filtered_reads
@@ -395,11 +486,10 @@ def main():
         print("Adding "+str(total_trimmable)+" total trimmable reads")
  
     print("Writing output file")
-    for species, gene_family, read_name, sequence, quality_scores in read_sam(args.input_sam, args.gene_families):
-        # write the read sequences requested once
-        if read_name in selected_reads:
+    for read_id, read_name, sequence, quality_scores in read_store(store_file):
+        # write the read sequences requested
+        if read_id in selected_reads:
             write_sequence(file_handle, read_name, sequence, quality_scores, args.output_format)
-            selected_reads.remove(read_name)
             if len(trimmable) < total_trimmable:
                 trimmable.append([read_name, sequence, quality_scores])
 
@@ -408,7 +498,5 @@ def main():
         new_length=int(len(sequence)/2.0)
         write_sequence(file_handle, "trimmable_"+read_name, sequence[0:new_length], quality_scores[0:new_length], args.output_format)
 
-    print("Output file written: " + args.output)
-    
 if __name__ == "__main__":
     main()
@@ -8,6 +8,11 @@ import sys
 import os
 import argparse
 
+try:
+    from biobakery_workflows import utilities
+except ImportError:
+    sys.exit("Please install biobakery_workflows")
+
 TOTAL_COUNT_TAG="reads; of these:\n"
 NUCLEOTIDE_COUNT_TAG="Unaligned reads after nucleotide alignment:"
 TRANSLATED_COUNT_TAG="Unaligned reads after translated alignment:"
@@ -30,9 +35,55 @@ def parse_arguments(args):
         help="file to write counts table\n[REQUIRED]", 
         metavar="<output>", 
         required=True)
+    parser.add_argument(
+        "-t", "--threads", 
+        help="number of processes to read the log files\n[DEFAULT: 1]", 
+        metavar="<threads>", 
+        type=int,
+        default=1)
+    parser.add_argument(
+        "--cache", 
+        help="file of counts from logs read on prior runs, logs that have not changed are not read again\n[DEFAULT: .<output>.cache in the output folder]", 
+        metavar="<cache>")
 
     return parser.parse_args()
 
+def get_counts(file):
+    """
+    Get the read and species counts from a log file, stopping once all are found
+    """
+
+    data=["NA","NA","NA","NA"]
+    found=set()
+    with open(file) as file_handle:
+        for line in file_handle:
+            if line.endswith(TOTAL_COUNT_TAG):
+                data[0]=int(line.split()[7])
+                found.add(TOTAL_COUNT_TAG)
+            elif NUCLEOTIDE_COUNT_TAG in line:
+                try:
+                    data[1]=int(data[0]*((100-float(line.split()[-2]))/100.0))
+                except (ValueError, TypeError):
+                    print("Warning: Unable to compute nucleotide reads aligned from log line: " + line)
+                found.add(NUCLEOTIDE_COUNT_TAG)
+            elif TRANSLATED_COUNT_TAG in line:
+                try:
+                    data[2]=int(data[0]*((100-float(line.split()[-2]))/100.0))
+                except (ValueError, TypeError):
+                    print("Warning: Unable to compute translated reads aligned from log line: " + line)
+                found.add(TRANSLATED_COUNT_TAG)
+            elif SPECIES_COUNT_TAG in line:
+                data[3]=line.split()[-1]
+                found.add(SPECIES_COUNT_TAG)
+            else:
+                continue
+
+            # stop reading once all of the counts are found (the rest of the log can be large)
+            if len(found) == 4:
+                break
+
+    return data
+
 def main():
     # parse arguments from the user
     args = parse_arguments(sys)
@@ -43,6 +94,12 @@ def main():
         for file in filter(lambda x: x.endswith(".log"), files):
             log_files.append(os.path.join(path,file))
 
+    if not args.cache:
+        args.cache=os.path.join(os.path.dirname(args.output),"."+os.path.basename(args.output)+".cache")
+
+    # read the new (or changed) logs in parallel
+    all_counts=utilities.parse_files(get_counts, log_files, args.cache, args.threads)
+
     try:
         file_handle=open(args.output,"w")
     except EnvironmentError:
@@ -51,26 +108,9 @@ def main():
     # write out the header
     file_handle.write("\t".join(["# samples","total reads","total nucleotide aligned","total translated aligned","total species"])+"\n")
 
-    for file in log_files:
+    for file, counts in zip(log_files, all_counts):
         sample=os.path.basename(file).split(".log")[0]
-        data=[sample,"NA","NA","NA","NA"]
-        for line in open(file):
-            if line.endswith(TOTAL_COUNT_TAG):
-                data[1]=int(line.split()[7])
-            elif NUCLEOTIDE_COUNT_TAG in line:
-                try:
-                    data[2]=int(data[1]*((100-float(line.split()[-2]))/100.0))
-                except (ValueError, TypeError):
-                    print("Warning: Unable to compute nucleotide reads aligned from log line: " + line)
-            elif TRANSLATED_COUNT_TAG in line:
-                try:
-                    data[3]=int(data[1]*((100-float(line.split()[-2]))/100.0))
-                except (ValueError, TypeError):
-                    print("Warning: Unable to compute translated reads aligned from log line: " + line)
-            elif SPECIES_COUNT_TAG in line:
-                data[4]=line.split()[-1]
-
-        file_handle.write("\t".join([str(i) for i in data])+"\n")
+        file_handle.write("\t".join([str(i) for i in [sample]+counts])+"\n")
 
     file_handle.close()
     print("Read table written to file: " + args.output)
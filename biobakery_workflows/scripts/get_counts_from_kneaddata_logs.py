@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# This script will create a table of read counts from kneaddata log files. The table
+# matches the output of kneaddata_read_count_table. Logs are read in parallel and the
+# counts are cached so logs that have not changed are not read again on reruns.
+
+import sys
+import os
+import argparse
+
+try:
+    from biobakery_workflows import utilities
+except ImportError:
+    sys.exit("Please install biobakery_workflows")
+
+READ_COUNT_IDENTIFIER="READ COUNT"
+
+def parse_arguments(args):
+    """
+    Parse the arguments from the user
+    """
+    parser = argparse.ArgumentParser(
+        description= "Reads the KneadData logs and prints a table of read counts\n",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        "-i", "--input",
+        help="the folder of log files\n[REQUIRED]",
+        metavar="<input_folder>",
+        required=True)
+    parser.add_argument(
+        "-o", "--output",
+        help="file to write counts table\n[REQUIRED]",
+        metavar="<output>",
+        required=True)
+    parser.add_argument(
+        "-t", "--threads",
+        help="number of processes to read the log files\n[DEFAULT: 1]",
+        metavar="<threads>",
+        type=int,
+        default=1)
+    parser.add_argument(
+        "--cache",
+        help="file of counts from logs read on prior runs, logs that have not changed are not read again\n[DEFAULT: .<output>.cache in the output folder]",
+        metavar="<cache>")
+
+    return parser.parse_args()
+
+def get_counts(file):
+    """
+    Get the read count for each type from a log file
+    """
+
+    counts={}
+    with open(file) as file_handle:
+        for line in file_handle:
+            if READ_COUNT_IDENTIFIER in line:
+                data=line.rstrip().split(":")
+                counts[data[-3].strip()]=data[-1].strip()
+
+    return counts
+
+def header_order(types):
+    """
+    Order the read types (raw, trimmed, decontaminated, then final with pairs before orphans)
+    """
+
+    order=[]
+    for column in ["raw","trimmed","decontaminated","final"]:
+        column_types=sorted(filter(lambda x: x.startswith(column), types))
+        paired=list(filter(lambda x: "pair" in x, column_types))
+        if paired:
+            order+=paired+list(filter(lambda x: "orphan" in x, column_types))
+        else:
+            order+=column_types
+
+    return order
+
+def main():
+    # parse arguments from the user
+    args = parse_arguments(sys)
+
+    # find the log files
+    log_files=sorted(filter(lambda file: file.endswith(".log") and os.path.isfile(file),
+        [os.path.join(args.input,file) for file in os.listdir(args.input)]))
+
+    if not args.cache:
+        args.cache=os.path.join(os.path.dirname(args.output),"."+os.path.basename(args.output)+".cache")
+
+    # read the new (or changed) logs in parallel
+    reads={}
+    for file, counts in zip(log_files, utilities.parse_files(get_counts, log_files, args.cache, args.threads)):
+        reads[os.path.basename(file).split(".")[0]]=counts
+
+    types=set()
+    for counts in reads.values():
+        types.update(counts.keys())
+    columns=header_order(types)
+
+    try:
+        file_handle=open(args.output,"w")
+    except EnvironmentError:
+        sys.exit("Error: Unable to open output file: " + args.output)
+
+    file_handle.write("\t".join(["Sample"]+columns)+"\n")
+    for sample in sorted(reads.keys()):
+        file_handle.write("\t".join([sample]+[str(reads[sample].get(column,"NA")) for column in columns])+"\n")
+
+    file_handle.close()
+    print("Read count table written: " + args.output)
+
+if __name__ == "__main__":
+    main()
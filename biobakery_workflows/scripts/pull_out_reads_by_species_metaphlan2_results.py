@@ -1,8 +1,8 @@
-import cPickle as pickle
-import bz2
-
 from anadama2 import Workflow
 
+from biobakery_workflows import alignments
+from biobakery_workflows import utilities
+
 # To run
 # $ python pull_out_reads_by_species_metaphlan2_results.py --input input_sam --output output_fastq
 # This will look for the metaphlan2 sam output files named *_bowtie2.sam in the input folder and write
@@ -13,7 +13,11 @@ from anadama2 import Workflow
 # one per line with metaphlan2 format (ie "s__Gemella_sanguinis") and for unknown species
 # include the genus in this file (ie "s__Gemella_unclassified" should be included in the file as "g__Gemella").
 # The metaphlan2 pkl database is also required for this script to run and can be provided 
-# with the option "--pkl-database". 
+# with the option "--pkl-database". The input files can also be sam files compressed and
+# indexed by compress_sam.py (set "--input-tag-extension _bowtie2.sam.gz"), in which case
+# only the blocks with alignments to the markers for the species are read.
+# The pkl database is read once to write the markers for the species (to the file
+# "marker_to_species.tsv" in the output folder) which is then used by all of the tasks.
 
 SAM_READ_NAME_INDEX = 0
 SAM_REFERENCE_NAME_INDEX = 2
@@ -27,36 +31,51 @@ workflow.add_argument("species-list", desc="the list of species to pull reads fo
 workflow.add_argument("input-tag-extension", desc="the file name tag and extension", default="_bowtie2.sam")
 args = workflow.parse_args()
 
-def find_reads(task):
+def write_marker_to_species(task):
     # read in the species
-    with open(args.species_list) as file_handle:
+    with open(task.depends[1].name) as file_handle:
         species_list = [taxon.rstrip() for taxon in file_handle.readlines()]
 
-    db = pickle.load(bz2.BZ2File(args.pkl_database, 'r'))
+    # write the species for each of the markers
+    marker_to_species = utilities.read_clade_markers(task.depends[0].name, species_list)
+    with open(task.targets[0].name, "w") as file_handle:
+        for marker in sorted(marker_to_species):
+            file_handle.write("\t".join([marker, marker_to_species[marker]])+"\n")
 
+def read_marker_to_species(file):
     marker_to_species={}
-    for marker,info in db['markers'].items():
-        if info['clade'] in species_list:
-            marker_to_species[marker]=info['clade']
+    with open(file) as file_handle:
+        for line in file_handle:
+            marker, species = line.rstrip("\n").split("\t")
+            marker_to_species[marker]=species
+    return marker_to_species
+
+def find_reads(task):
+    marker_to_species = read_marker_to_species(task.depends[1].name)
 
     # read in the sam file and pull out the reads that align with the markers
     with open(task.targets[0].name, "w") as file_handle_write:
-        with open(task.depends[0].name) as file_handle:
-            for line in file_handle:
-                if not line.startswith("@"):
-                    data=line.rstrip().split("\t")
-                    reference=data[SAM_REFERENCE_NAME_INDEX]
-                    if reference in marker_to_species.keys():
-                        seq_id = ";".join([data[SAM_READ_NAME_INDEX],marker_to_species[reference]])
-                        seq = data[SAM_SEQ_INDEX]
-                        file_handle_write.write("\n".join([">"+seq_id,seq])+"\n")
+        for line in alignments.read_sam_lines(task.depends[0].name, references=marker_to_species):
+            data=line.rstrip().split("\t")
+            reference=data[SAM_REFERENCE_NAME_INDEX]
+            if reference in marker_to_species:
+                seq_id = ";".join([data[SAM_READ_NAME_INDEX],marker_to_species[reference]])
+                seq = data[SAM_SEQ_INDEX]
+                file_handle_write.write("\n".join([">"+seq_id,seq])+"\n")
+
+# read the markers for the species from the pkl database once for all files
+marker_file = workflow.name_output_files("marker_to_species.tsv")
+workflow.add_task(
+    write_marker_to_species,
+    depends=[args.pkl_database, args.species_list],
+    targets=marker_file)
 
 # for each of the input files write the fasta file of reads
 for infile in workflow.get_input_files(extension=args.input_tag_extension):
     outfile = workflow.name_output_files(infile).replace(args.input_tag_extension,"_metaphlan2_marker_aligned_subset.fasta")
     workflow.add_task(
         find_reads,
-        depends=infile,
+        depends=[infile, marker_file],
         targets=outfile)
 
 workflow.go()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# This script will regroup the features in a humann2 table with a group index
+# (see tables.write_group_index). The output matches humann2_regroup_table.
+# The index is memory-mapped so only the pages for the features in the table are read.
+
+import sys
+import argparse
+
+try:
+    from biobakery_workflows import tables
+except ImportError:
+    sys.exit("Please install biobakery_workflows")
+
+def parse_arguments(args):
+    """
+    Parse the arguments from the user
+    """
+    parser = argparse.ArgumentParser(
+        description= "Regroup a table with a group index\n",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        "-i", "--input",
+        help="the table to regroup\n[REQUIRED]",
+        metavar="<input.tsv>",
+        required=True)
+    parser.add_argument(
+        "--index",
+        help="the group index\n[REQUIRED]",
+        metavar="<groups.idx>",
+        required=True)
+    parser.add_argument(
+        "-o", "--output",
+        help="the regrouped table to write\n[REQUIRED]",
+        metavar="<output.tsv>",
+        required=True)
+
+    return parser.parse_args()
+
+def main():
+    # parse arguments from the user
+    args = parse_arguments(sys)
+
+    try:
+        tables.regroup_table(args.input, args.output, args.index, index=True)
+    except EnvironmentError:
+        sys.exit("ERROR: Unable to regroup table: " + args.input)
+
+    print("Regrouped table written: " + args.output)
+
+if __name__ == "__main__":
+    main()
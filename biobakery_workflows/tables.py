@@ -0,0 +1,838 @@
+"""
+bioBakery Workflows: tables module
+Functions to read, join, and count features in HUMAnN2 and MetaPhlAn2 tables
+
+Copyright (c) 2016 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import sys
+import heapq
+import shutil
+import tempfile
+import struct
+import hashlib
+import mmap
+import bisect
+
+COMMENT="#"
+DELIMITER="\t"
+STRATIFIED_DELIMITER="|"
+NAME_DELIMITER=": "
+
+# the special features are always sorted first (matching humann2 tables)
+SPECIAL_FEATURE_ORDER={"UNMAPPED":0,"UNGROUPED":1,"UNINTEGRATED":2,"UniRef50_unknown":3,"UniRef90_unknown":4}
+
+# the name of the index file in a chunked table store
+STORE_INDEX="index.tsv"
+# the record of the last joined table written from the store
+STORE_MATERIALIZED=".materialized"
+
+# the features not included when renormalizing and those always kept when regrouping (matching humann2)
+UNGROUPED="UNGROUPED"
+RENORM_SPECIAL_FEATURES=["UNMAPPED","UNINTEGRATED",UNGROUPED]
+PROTECTED_FEATURES=["UNMAPPED","UNINTEGRATED"]
+
+# the most tables to open at once for a streaming merge
+MAX_OPEN_TABLES=256
+
+# the group mappings loaded by this process, by file (with the modification time of the file)
+_group_mappings={}
+
+# the layout of a group index: a header, the first record for each hash prefix,
+# the sorted records (feature hash, first group id, total groups), the group ids,
+# the group names, and then any features with the same hash (as text)
+GROUP_INDEX_MAGIC=b"BBGIDX01"
+GROUP_INDEX_HEADER=struct.Struct(">8sIIII")
+GROUP_INDEX_RECORD=struct.Struct(">QII")
+GROUP_INDEX_ID=struct.Struct(">I")
+GROUP_INDEX_PREFIX_BITS=16
+
+def open_file(file, mode="r"):
+    """ Open a text file allowing for gzip and bzip2 compression """
+
+    if file.endswith(".gz"):
+        import gzip
+        return gzip.open(file, mode+"t" if sys.version_info[0] > 2 else mode)
+    elif file.endswith(".bz2"):
+        import bz2
+        if sys.version_info[0] > 2:
+            return bz2.open(file, mode+"t")
+        return bz2.BZ2File(file, mode)
+    return open(file, mode)
+
+def read_table(file):
+    """ Read a table with an optional header (the last comment line before the data)
+
+    Args:
+        file (string): The path to the table (allows for gzip and bzip2 compression)
+
+    Returns:
+        (list): The header (or None if the table does not have a header)
+        (generator): The feature and list of values for each row
+    """
+
+    file_handle=open_file(file)
+
+    # find the header
+    header=None
+    first_line=""
+    for line in file_handle:
+        if line.startswith(COMMENT):
+            header=line.rstrip("\r\n").split(DELIMITER)
+        else:
+            first_line=line
+            break
+
+    def rows():
+        try:
+            for line in [first_line] if first_line else []:
+                data=line.rstrip("\r\n").split(DELIMITER)
+                if data[0]:
+                    yield data[0], data[1:]
+            for line in file_handle:
+                data=line.rstrip("\r\n").split(DELIMITER)
+                if data[0]:
+                    yield data[0], data[1:]
+        finally:
+            file_handle.close()
+
+    return header, rows()
+
+def read_header(file):
+    """ Read the header of a table (or None if the table does not have a header) """
+
+    header=None
+    with open_file(file) as file_handle:
+        for line in file_handle:
+            if not line.startswith(COMMENT):
+                break
+            header=line.rstrip("\r\n").split(DELIMITER)
+    return header
+
+def feature_sort_key(feature):
+    """ Get the key to sort features in the same order as the humann2 tools.
+        Special features are first, then features are sorted with stratified
+        rows after the community total. """
+
+    return (SPECIAL_FEATURE_ORDER.get(feature.split(STRATIFIED_DELIMITER)[0].split(NAME_DELIMITER)[0],
+        len(SPECIAL_FEATURE_ORDER)), feature.split(STRATIFIED_DELIMITER))
+
+def file_basename(file):
+    """ Get the basename of the file without the extension """
+
+    return ".".join(os.path.basename(file).split(".")[:-1])
+
+def write_table(output, header, rows):
+    """ Write the header and rows (feature and list of values) to a tab-delimited file """
+
+    try:
+        file_handle=open(output,"w")
+    except EnvironmentError:
+        sys.exit("Unable to write file: " + output)
+
+    with file_handle:
+        file_handle.write(DELIMITER.join(header)+"\n")
+        for feature, values in rows:
+            file_handle.write(DELIMITER.join([feature]+[str(value) for value in values])+"\n")
+
+def join_tables(tables, output=None):
+    """ Join the tables into a single table, filling in zeros for features not
+        found in all tables. This matches the output of humann2_join_tables.
+
+    Args:
+        tables (list): The paths to the tables to join
+        output (string): The file to write (optional)
+
+    Returns:
+        (string): The first column header
+        (list): The column names from the headers of each table
+        (list): The basenames of the tables (one per column)
+        (list): The sorted features and values
+    """
+
+    data={}
+    start_column=""
+    samples=[]
+    basenames=[]
+    for table in tables:
+        header, rows = read_table(table)
+        if header:
+            start_column=start_column or header[0]
+            table_samples=header[1:]
+        else:
+            # if there is no header, use the file name as the sample name
+            table_samples=[file_basename(table)]
+
+        index=len(samples)
+        for feature, values in rows:
+            values=values[:len(table_samples)]
+            current=data.setdefault(feature,[])
+            if len(current) > index:
+                # sum the values for features repeated in the same table
+                for i, value in enumerate(values):
+                    current[index+i]=str(float(current[index+i])+float(value))
+            else:
+                current.extend(["0"]*(index-len(current))+values)
+
+        samples+=table_samples
+        basenames+=[file_basename(table)]*len(table_samples)
+
+    rows=[(feature, data[feature]+["0"]*(len(samples)-len(data[feature])))
+        for feature in sorted(data, key=feature_sort_key)]
+
+    if output:
+        write_table(output, [start_column or "# header "]+column_names(samples, basenames), rows)
+
+    return start_column, samples, basenames, rows
+
+def column_names(samples, basenames):
+    """ Get the column names for a joined table, if all of the header names are
+        the same use the file names instead (matching humann2_join_tables) """
+
+    if samples and samples.count(samples[0]) == len(samples):
+        return basenames
+    return samples
+
+def merge_sorted_tables(tables):
+    """ Merge tables, each with features sorted in the same order, with a
+        streaming N-way merge-join. Only one row from each table is in memory.
+
+    Args:
+        tables (list): The header and rows generator from read_table for each table
+
+    Returns:
+        (generator): The feature and list of values (across all tables) for each row
+    """
+
+    widths=[len(header)-1 for header, rows in tables]
+
+    def decorate(index, rows):
+        for feature, values in rows:
+            yield feature_sort_key(feature), index, feature, values
+
+    merged=heapq.merge(*[decorate(index, rows) for index, (header, rows) in enumerate(tables)])
+
+    current_feature=None
+    current_values=None
+    for key, index, feature, values in merged:
+        if feature != current_feature:
+            if current_feature is not None:
+                yield current_feature, sum(current_values,[])
+            current_feature=feature
+            current_values=[["0"]*width for width in widths]
+        current_values[index]=values[:widths[index]]+["0"]*(widths[index]-len(values))
+
+    if current_feature is not None:
+        yield current_feature, sum(current_values,[])
+
+def read_store_index(store):
+    """ Read the index of the chunked table store
+
+    Returns:
+        (list): The chunk, file, size, mtime, and column names for each table in the store
+    """
+
+    entries=[]
+    index_file=os.path.join(store,STORE_INDEX)
+    if not os.path.isfile(index_file):
+        return entries
+
+    with open(index_file) as file_handle:
+        for line in file_handle:
+            if line.startswith(COMMENT):
+                continue
+            data=line.rstrip("\n").split(DELIMITER)
+            entries.append([data[0],data[1],int(data[2]),data[3],data[4:]])
+
+    return entries
+
+def write_store_index(store, entries):
+    """ Write the index of the chunked table store """
+
+    index_file=os.path.join(store,STORE_INDEX)
+    with open(index_file+".tmp","w") as file_handle:
+        file_handle.write(DELIMITER.join(["# chunk","file","size","mtime","columns"])+"\n")
+        for chunk, file, size, mtime, columns in entries:
+            file_handle.write(DELIMITER.join([chunk,file,str(size),mtime]+columns)+"\n")
+    os.rename(index_file+".tmp",index_file)
+
+def file_signature(file):
+    """ Get the size and modification time of the file """
+
+    stat=os.stat(file)
+    return stat.st_size, repr(stat.st_mtime)
+
+def update_store(store, tables, max_chunks=32):
+    """ Add tables to a column-chunked store. Only the new (or changed) tables
+        are read and joined into a new chunk. Chunks with tables that have
+        changed or are no longer included are rebuilt.
+
+    Args:
+        store (string): The folder for the chunked table store
+        tables (list): The paths to all of the tables to include
+        max_chunks (int): Combine all chunks into one if there are more than this many
+
+    Returns:
+        (list): The chunks in the store
+    """
+
+    if not os.path.isdir(store):
+        os.makedirs(store)
+
+    tables=sorted(os.path.abspath(table) for table in tables)
+    signatures=dict((table,file_signature(table)) for table in tables)
+
+    # keep the chunks where all tables are unchanged and still included
+    entries=read_store_index(store)
+    invalid_chunks=set(chunk for chunk, file, size, mtime, columns in entries
+        if not file in signatures or signatures[file] != (size, mtime))
+    entries=[entry for entry in entries if not entry[0] in invalid_chunks]
+    for chunk in invalid_chunks:
+        remove_chunk(store, chunk)
+
+    # join all of the new tables into a new chunk
+    stored_tables=set(entry[1] for entry in entries)
+    new_tables=[table for table in tables if not table in stored_tables]
+    if new_tables:
+        chunk=new_chunk_name(entries)
+        start_column, samples, basenames, rows = join_tables(new_tables)
+        write_table(os.path.join(store,chunk),[start_column or "# header "]+samples,rows)
+        for table in new_tables:
+            header=read_header(table)
+            columns=header[1:] if header else [file_basename(table)]
+            size, mtime = signatures[table]
+            entries.append([chunk,table,size,mtime,columns])
+
+    if len(store_chunks(entries)) > max_chunks:
+        entries=compact_store(store, entries)
+
+    write_store_index(store, entries)
+    return store_chunks(entries)
+
+def store_chunks(entries):
+    """ Get the chunks in the order they were created """
+
+    chunks=[]
+    for entry in entries:
+        if not entry[0] in chunks:
+            chunks.append(entry[0])
+    return sorted(chunks, key=lambda chunk: int(chunk.split("_")[1].split(".")[0]))
+
+def new_chunk_name(entries):
+    """ Get the name for a new chunk """
+
+    chunks=store_chunks(entries)
+    number=int(chunks[-1].split("_")[1].split(".")[0])+1 if chunks else 1
+    return "chunk_"+str(number)+".tsv"
+
+def remove_chunk(store, chunk):
+    """ Remove the chunk and any cached counts for the chunk """
+
+    for file in os.listdir(store):
+        if file == chunk or file.startswith(chunk+"."):
+            os.remove(os.path.join(store,file))
+
+def compact_store(store, entries):
+    """ Combine all of the chunks in the store into a single chunk """
+
+    chunks=store_chunks(entries)
+    chunk=new_chunk_name(entries)
+    tables=[read_table(os.path.join(store,name)) for name in chunks]
+    header=[tables[0][0][0]]+sum([header[1:] for header, rows in tables],[])
+    write_table(os.path.join(store,chunk), header, merge_sorted_tables(tables))
+    for name in chunks:
+        remove_chunk(store, name)
+
+    # order the tables to match the columns in the new chunk
+    entries=sorted(entries, key=lambda entry: chunks.index(entry[0]))
+    for entry in entries:
+        entry[0]=chunk
+    return entries
+
+def store_layout(entries):
+    """ Get the chunks, the column names, and the order of the columns in the
+        joined table. Columns are ordered by table path (as humann2_join_tables
+        orders by file name) no matter which chunk they are stored in.
+
+    Returns:
+        (list): The chunks in the store
+        (list): The column names for the joined table
+        (list): The index of the chunk column for each joined table column
+    """
+
+    chunks=store_chunks(entries)
+    columns=[]
+    for chunk in chunks:
+        for chunk_name, file, size, mtime, names in entries:
+            if chunk_name == chunk:
+                columns+=[(file, name, file_basename(file)) for name in names]
+
+    order=sorted(range(len(columns)), key=lambda index: columns[index][0])
+    names=column_names([columns[index][1] for index in order],[columns[index][2] for index in order])
+
+    return chunks, names, order
+
+def materialized_signature(store, output):
+    """ Get the signature of the store index and the joined table """
+
+    with open(os.path.join(store,STORE_INDEX),"rb") as file_handle:
+        index_checksum=hashlib.md5(file_handle.read()).hexdigest()
+    return [os.path.abspath(output),index_checksum]+[str(value) for value in file_signature(output)]
+
+def materialize_store(store, output):
+    """ Write the joined table from the chunks in the store with a streaming merge.
+        The table is only written if the store has changed since it was last written.
+
+    Returns:
+        (bool): True if the table was written
+    """
+
+    record_file=os.path.join(store,STORE_MATERIALIZED)
+    if os.path.isfile(output) and os.path.isfile(record_file):
+        with open(record_file) as file_handle:
+            if file_handle.read().rstrip("\n").split(DELIMITER) == materialized_signature(store, output):
+                return False
+
+    chunks, names, order = store_layout(read_store_index(store))
+    tables=[read_table(os.path.join(store,chunk)) for chunk in chunks]
+    start_column=tables[0][0][0] if tables else "# header "
+    rows=((feature, [values[index] for index in order]) for feature, values in merge_sorted_tables(tables))
+    write_table(output, [start_column]+names, rows)
+
+    with open(record_file,"w") as file_handle:
+        file_handle.write(DELIMITER.join(materialized_signature(store, output))+"\n")
+    return True
+
+def include_feature(line, include=None, filter=None, ignore_un_features=None, ignore_stratification=None):
+    """ Check if the feature should be counted (matching the count_features.py script) """
+
+    if STRATIFIED_DELIMITER in line and ignore_stratification:
+        return False
+    if "UNMAPPED" in line or "UNGROUPED" in line or ("UNINTEGRATED" in line and ignore_un_features):
+        return False
+    if include and not include in line:
+        return False
+    if filter and filter in line:
+        return False
+    return True
+
+def reduce_sample_name(sample):
+    """ Remove the extra strings added to sample names by the workflow tools """
+
+    return sample.replace("_Abundance-RPKs","").replace("_genefamilies_Abundance","").replace("_Abundance","").replace("_taxonomic_profile","")
+
+def count_chunk_features(file, **keywords):
+    """ Count the features with non-zero values for each column in the table """
+
+    header, rows = read_table(file)
+    counts=[0]*(len(header)-1)
+    for feature, values in rows:
+        if include_feature(DELIMITER.join([feature]+values), **keywords):
+            for i, value in enumerate(values):
+                if float(value) > 0:
+                    counts[i]+=1
+    return counts
+
+def count_store_features(store, output, reduce_sample_names=None, **keywords):
+    """ Write the total features for each sample in the store. The counts for
+        each chunk are cached so only new chunks are counted.
+
+    Args:
+        store (string): The folder for the chunked table store
+        output (string): The file to write
+        reduce_sample_names (bool): Remove the extra strings from the sample names
+        keywords: The options for the features to count (see include_feature)
+    """
+
+    cache_key=".counts_"+"_".join(key+"-"+str(keywords[key]) for key in sorted(keywords)
+        if keywords[key]).replace(os.sep,"").replace(" ","")
+
+    chunks, samples, order = store_layout(read_store_index(store))
+    counts=[]
+    for chunk in chunks:
+        cache_file=os.path.join(store,chunk+cache_key)
+        if os.path.isfile(cache_file):
+            with open(cache_file) as file_handle:
+                chunk_counts=[int(count) for count in file_handle.read().split()]
+        else:
+            chunk_counts=count_chunk_features(os.path.join(store,chunk), **keywords)
+            with open(cache_file,"w") as file_handle:
+                file_handle.write("\n".join(str(count) for count in chunk_counts)+"\n")
+        counts+=chunk_counts
+
+    counts=[counts[index] for index in order]
+    if reduce_sample_names:
+        samples=[reduce_sample_name(sample) for sample in samples]
+
+    write_table(output, ["# samples","total features"], zip(samples, [[count] for count in counts]))
+
+def sort_rows(rows, width):
+    """ Sort the rows by feature, summing the values for features repeated
+        in the same table (matching join_tables) """
+
+    sorted_rows=[]
+    for feature, values in sorted(rows, key=lambda row: feature_sort_key(row[0])):
+        values=values[:width]
+        if sorted_rows and sorted_rows[-1][0] == feature:
+            sorted_rows[-1][1][:]=[str(float(current)+float(value)) for current, value in zip(sorted_rows[-1][1], values)]
+        else:
+            sorted_rows.append((feature, list(values)))
+    return sorted_rows
+
+def spill_table(folder, file, header, rows):
+    """ Write the rows of a table, sorted by feature, to a temp file for a streaming merge
+
+    Args:
+        folder (string): The temp folder
+        file (string): The path to the original table (used to name the columns)
+        header (list): The header of the table (or None if the table does not have a header)
+        rows (list): The feature and list of values for each row
+
+    Returns:
+        (string): The temp file
+        (string): The first column header
+        (list): The column names from the header of the table
+        (list): The basename of the table (one per column)
+    """
+
+    table_samples=header[1:] if header else [file_basename(file)]
+    spill=tempfile.mkstemp(suffix=".tsv", dir=folder)
+    os.close(spill[0])
+    write_table(spill[1], [header[0] if header else "# header "]+table_samples, sort_rows(rows, len(table_samples)))
+    return spill[1], header[0] if header else "", table_samples, [file_basename(file)]*len(table_samples)
+
+def merge_spills(folder, spills, output, max_open=MAX_OPEN_TABLES):
+    """ Join the sorted temp tables with a streaming N-way merge. If there are
+        more than the max open, merge in batches. Columns are ordered by the
+        path to the original table (as humann2_join_tables orders by file name).
+
+    Args:
+        folder (string): The temp folder
+        spills (list): The original table path and the spill_table output for each table
+        output (string): The joined table to write
+        max_open (int): The most tables to open at once
+    """
+
+    spills=[spill[1] for spill in sorted(spills, key=lambda spill: spill[0])]
+    start_column=""
+    samples=[]
+    basenames=[]
+    for spill, table_start_column, table_samples, table_basenames in spills:
+        start_column=start_column or table_start_column
+        samples+=table_samples
+        basenames+=table_basenames
+
+    files=[spill[0] for spill in spills]
+    while len(files) > max_open:
+        batches=[files[i:i+max_open] for i in range(0, len(files), max_open)]
+        files=[]
+        for batch in batches:
+            tables=[read_table(file) for file in batch]
+            merged=tempfile.mkstemp(suffix=".tsv", dir=folder)
+            os.close(merged[0])
+            write_table(merged[1], [tables[0][0][0]]+sum([header[1:] for header, rows in tables],[]),
+                merge_sorted_tables(tables))
+            files.append(merged[1])
+
+    write_table(output, [start_column or "# header "]+column_names(samples, basenames),
+        merge_sorted_tables([read_table(file) for file in files]))
+
+def stream_join_tables(tables, output, max_open=MAX_OPEN_TABLES):
+    """ Join the tables, which do not need to be sorted, with a streaming merge.
+        Only one table is read into memory at a time. This matches the output
+        of join_tables (and humann2_join_tables).
+
+    Args:
+        tables (list): The paths to the tables to join
+        output (string): The file to write
+        max_open (int): The most tables to open at once
+    """
+
+    folder=tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        spills=[]
+        for table in tables:
+            header, rows = read_table(table)
+            spills.append((table, spill_table(folder, table, header, rows)))
+        merge_spills(folder, spills, output, max_open)
+    finally:
+        shutil.rmtree(folder)
+
+def renorm_rows(rows, special=False):
+    """ Normalize the rows to relative abundance. The stratified rows are
+        normalized by the community totals (matching humann2_renorm_table
+        with units relab).
+
+    Args:
+        rows (list): The feature and list of values for each row
+        special (bool): Include the special features (ie UNMAPPED, UNINTEGRATED, UNGROUPED)
+
+    Returns:
+        (list): The feature and list of normalized values (formatted) for each row
+    """
+
+    if not special:
+        rows=[(feature, values) for feature, values in rows
+            if not feature.split(STRATIFIED_DELIMITER)[0] in RENORM_SPECIAL_FEATURES]
+
+    rows=[(feature, [float(value) for value in values]) for feature, values in rows]
+    totals=None
+    for feature, values in rows:
+        if not STRATIFIED_DELIMITER in feature:
+            totals=values if totals is None else [total + value for total, value in zip(totals, values)]
+
+    totals=[total if total != 0 else 1 for total in totals or []]
+    return [(feature, ["%.6g" % (value / total) for value, total in zip(values, totals)]) for feature, values in rows]
+
+def renorm_table(input, output, special=False):
+    """ Normalize a table to relative abundance (see renorm_rows) """
+
+    header, rows = read_table(input)
+    write_table(output, header or ["# header "], renorm_rows(list(rows), special))
+
+def load_group_mapping(file):
+    """ Load a mapping of groups to features (one group per line followed by
+        the features in the group) as a dictionary of features to groups. Each
+        mapping is only loaded once per process (unless the file is modified).
+
+    Args:
+        file (string): The mapping file (allows for gzip and bzip2 compression)
+
+    Returns:
+        (dict): The groups for each feature
+    """
+
+    def load(file):
+        mapping={}
+        with open_file(file) as file_handle:
+            for line in file_handle:
+                data=line.rstrip().split(DELIMITER)
+                for feature in data[1:]:
+                    groups=mapping.setdefault(feature,[])
+                    if not data[0] in groups:
+                        groups.append(data[0])
+        return mapping
+
+    return cached_group_mapping(file, load)
+
+def cached_group_mapping(file, load):
+    """ Get the mapping loaded for the file, loading it again if the file has been modified """
+
+    key=(os.path.abspath(file), os.path.getmtime(file))
+    if not key in _group_mappings:
+        _group_mappings[key]=load(file)
+    return _group_mappings[key]
+
+def feature_hash(feature):
+    """ Get the 64-bit hash of a feature (the same for all python versions) """
+
+    return struct.unpack(">Q",hashlib.md5(feature.encode("utf-8")).digest()[:8])[0]
+
+def write_group_index(mapping_file, index_file):
+    """ Convert a mapping of groups to features (see load_group_mapping) to a
+        compact index of feature hashes that can be memory mapped. The mapping
+        is read once here instead of for every table regrouped.
+
+    Args:
+        mapping_file (string): The mapping file (allows for gzip and bzip2 compression)
+        index_file (string): The index file to write
+    """
+
+    group_names=[]
+    group_ids={}
+    feature_groups={}
+    with open_file(mapping_file) as file_handle:
+        for line in file_handle:
+            data=line.rstrip().split(DELIMITER)
+            if not data[0] in group_ids:
+                group_ids[data[0]]=len(group_names)
+                group_names.append(data[0])
+            for feature in data[1:]:
+                groups=feature_groups.setdefault(feature,[])
+                if not group_ids[data[0]] in groups:
+                    groups.append(group_ids[data[0]])
+
+    # features with the same hash are stored as text
+    hashes={}
+    for feature in feature_groups:
+        hashes.setdefault(feature_hash(feature),[]).append(feature)
+    collisions=[feature for features in hashes.values() if len(features) > 1 for feature in features]
+    collision_text="".join(DELIMITER.join([feature]+[group_names[id] for id in feature_groups[feature]])+"\n"
+        for feature in sorted(collisions)).encode("utf-8")
+
+    records=sorted((hash, features[0]) for hash, features in hashes.items() if len(features) == 1)
+    names=("\n".join(group_names)).encode("utf-8")
+
+    temp_file=index_file+".tmp"
+    with open(temp_file,"wb") as file_handle:
+        file_handle.write(GROUP_INDEX_HEADER.pack(GROUP_INDEX_MAGIC, len(records),
+            sum(len(feature_groups[feature]) for hash, feature in records), len(names), len(collision_text)))
+
+        # write the index of the first record for each hash prefix
+        shift=64-GROUP_INDEX_PREFIX_BITS
+        prefixes=[hash >> shift for hash, feature in records]
+        for prefix in range(2**GROUP_INDEX_PREFIX_BITS+1):
+            file_handle.write(GROUP_INDEX_ID.pack(bisect.bisect_left(prefixes, prefix)))
+
+        start=0
+        for hash, feature in records:
+            file_handle.write(GROUP_INDEX_RECORD.pack(hash, start, len(feature_groups[feature])))
+            start+=len(feature_groups[feature])
+        for hash, feature in records:
+            for id in feature_groups[feature]:
+                file_handle.write(GROUP_INDEX_ID.pack(id))
+        file_handle.write(names)
+        file_handle.write(collision_text)
+    os.rename(temp_file, index_file)
+
+class GroupIndex(object):
+    """ A memory mapped index of the groups for each feature (see write_group_index).
+        Features are looked up with get (like the dictionary from load_group_mapping). """
+
+    def __init__(self, index_file):
+        self.file_handle=open(index_file,"rb")
+        self.data=mmap.mmap(self.file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.total_records, total_ids, names_length, collisions_length = GROUP_INDEX_HEADER.unpack_from(self.data, 0)
+        if magic != GROUP_INDEX_MAGIC:
+            sys.exit("ERROR: The file is not a group index: " + index_file)
+
+        self.prefixes_start=GROUP_INDEX_HEADER.size
+        self.records_start=self.prefixes_start+(2**GROUP_INDEX_PREFIX_BITS+1)*GROUP_INDEX_ID.size
+        self.ids_start=self.records_start+self.total_records*GROUP_INDEX_RECORD.size
+        names_start=self.ids_start+total_ids*GROUP_INDEX_ID.size
+
+        self.group_names=self.data[names_start:names_start+names_length].decode("utf-8").split("\n")
+        self.collisions={}
+        collisions=self.data[names_start+names_length:names_start+names_length+collisions_length].decode("utf-8")
+        for line in collisions.splitlines():
+            data=line.split(DELIMITER)
+            self.collisions[data[0]]=data[1:]
+
+    def get(self, feature, default=None):
+        """ Get the groups for the feature (or the default if the feature is not in any group) """
+
+        if feature in self.collisions:
+            return self.collisions[feature]
+
+        hash=feature_hash(feature)
+        prefix=hash >> (64-GROUP_INDEX_PREFIX_BITS)
+        low, high = struct.unpack_from(">II", self.data, self.prefixes_start+prefix*GROUP_INDEX_ID.size)
+
+        # binary search the records with the same hash prefix
+        while low < high:
+            middle=(low+high)//2
+            record_hash, start, total = GROUP_INDEX_RECORD.unpack_from(self.data, self.records_start+middle*GROUP_INDEX_RECORD.size)
+            if record_hash < hash:
+                low=middle+1
+            elif record_hash > hash:
+                high=middle
+            else:
+                ids=struct.unpack_from(">"+str(total)+"I", self.data, self.ids_start+start*GROUP_INDEX_ID.size)
+                return [self.group_names[id] for id in ids]
+        return default
+
+    def close(self):
+        self.data.close()
+        self.file_handle.close()
+
+def load_group_index(index_file):
+    """ Open the group index, each index is only opened once per process (unless the file is modified) """
+
+    return cached_group_mapping(index_file, GroupIndex)
+
+def regroup_rows(rows, mapping, ungrouped=True, protected=True, precision=3):
+    """ Regroup the features by summing the values for all of the features in
+        each group (matching humann2_regroup_table). Stratified rows are
+        regrouped within each stratum.
+
+    Args:
+        rows (list): The feature and list of values for each row
+        mapping (dict): The groups for each feature (from load_group_mapping or load_group_index)
+        ungrouped (bool): Add the features not found in any group to UNGROUPED
+        protected (bool): Keep the UNMAPPED and UNINTEGRATED features
+        precision (int): The decimal places to round the values
+
+    Returns:
+        (list): The sorted groups and list of values for each row
+    """
+
+    groups={}
+    feature_groups_found={}
+    for feature, values in rows:
+        stratum=feature.split(STRATIFIED_DELIMITER)[1] if STRATIFIED_DELIMITER in feature else None
+        feature=feature.split(STRATIFIED_DELIMITER)[0].split(NAME_DELIMITER)[0]
+
+        # look up each feature once (the stratified rows follow the community total)
+        if not feature in feature_groups_found:
+            feature_groups_found[feature]=mapping.get(feature,[])
+        feature_groups=feature_groups_found[feature]
+        if protected and feature in PROTECTED_FEATURES and not feature in feature_groups:
+            feature_groups=feature_groups+[feature]
+        if not feature_groups and ungrouped:
+            feature_groups=[UNGROUPED]
+
+        for group in feature_groups:
+            if stratum is not None:
+                group=STRATIFIED_DELIMITER.join([group, stratum])
+            sums=groups.setdefault(group,[0]*len(values))
+            for i, value in enumerate(values):
+                sums[i]+=float(value)
+
+    return [(group, [repr(round(value, precision)) for value in groups[group]])
+        for group in sorted(groups, key=feature_sort_key)]
+
+def regroup_table(input, output, mapping_file, index=False, **keywords):
+    """ Regroup the features in a table (see regroup_rows) with a mapping file
+        or a group index (see write_group_index) """
+
+    mapping=load_group_index(mapping_file) if index else load_group_mapping(mapping_file)
+    header, rows = read_table(input)
+    write_table(output, header or ["# header "], regroup_rows(rows, mapping, **keywords))
+
+def renorm_join_tables(tables, relab_tables, output, relab_output, max_open=MAX_OPEN_TABLES):
+    """ Normalize each table to relative abundance then join the original tables
+        and the normalized tables. Each table is only read once.
+
+    Args:
+        tables (list): The paths to the tables
+        relab_tables (list): The paths to write the normalized tables (one per table)
+        output (string): The joined table to write
+        relab_output (string): The joined normalized table to write
+        max_open (int): The most tables to open at once
+    """
+
+    folder=tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        spills=[]
+        relab_spills=[]
+        for table, relab_table in zip(tables, relab_tables):
+            header, rows = read_table(table)
+            rows=list(rows)
+            relab_rows=renorm_rows(rows)
+            write_table(relab_table, header or ["# header "], relab_rows)
+            spills.append((table, spill_table(folder, table, header, rows)))
+            relab_spills.append((relab_table, spill_table(folder, relab_table, header, relab_rows)))
+        merge_spills(folder, spills, output, max_open)
+        merge_spills(folder, relab_spills, relab_output, max_open)
+    finally:
+        shutil.rmtree(folder)
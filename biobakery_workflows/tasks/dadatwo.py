@@ -24,10 +24,150 @@ THE SOFTWARE.
 """
 from anadama2.tracked import TrackedDirectory, TrackedExecutable
 from biobakery_workflows import files, config, utilities
-import os,fnmatch
+import os,fnmatch,re
+import sys
+import gzip
+import hashlib
+import shutil
+import subprocess
+
+# the resources for each per-sample task (time in minutes, memory in MB), scaled by the
+# size of the filtered files for the sample (in GB)
+SAMPLE_TASK_TIME="int(30+6*60*( file_size('{0}') + file_size('{1}') ))"
+SAMPLE_TASK_MEM="int(4*1024+16*1024*( file_size('{0}') + file_size('{1}') ))"
+
+# the read counts after filtering (written with the filtered files, or gathered if filtering each sample)
+FILTER_READ_COUNTS="Read_counts_after_filtering.tsv"
+
+# the number of reads sampled from each file for the quality plots
+QUALITY_PLOT_READS=10000
+
+# the number of reads from the first sample used to identify the primer orientation
+PRIMER_CHECK_READS=10000
+
+# the cached error rates are used for reads from the same sequencer runs if the distributions of
+# quality scores (from the first reads of each file) differ by at most this total variation distance
+ERROR_RATES_CACHE_READS=10000
+ERROR_RATES_CACHE_MAX_DISTANCE=0.05
+
+# the IUPAC ambiguity codes (as regex) and complements used to search for primers
+IUPAC_CODES={"R":"[AGR]","Y":"[CTY]","S":"[GCS]","W":"[ATW]","K":"[GTK]","M":"[ACM]","B":"[CGTB]",
+    "D":"[AGTD]","H":"[ACTH]","V":"[ACGV]","N":"[ACGTN]"}
+IUPAC_COMPLEMENT={"A":"T","T":"A","G":"C","C":"G","R":"Y","Y":"R","S":"S","W":"W","K":"M","M":"K",
+    "B":"V","V":"B","D":"H","H":"D","N":"N"}
+
+# the taxonomy cache is keyed by the reference databases, dada2 version, and the
+# min bootstrap confidence (the dada2 assignTaxonomy default, passed for each chunk)
+TAXONOMY_MIN_BOOT=50
+TAXONOMY_CACHE_FILE="taxonomy.tsv"
+
+def sample_names(input_files, pair_id):
+    """ Get the sample names for the forward read files (matching the names used by the R scripts)
+       Args:
+           input_files (list): paths to the input files
+           pair_id (string): pair identifier
+
+       Returns:
+           list: sample names (sorted)
+    """
+    names=[os.path.basename(file).split(pair_id)[0] for file in input_files if pair_id in os.path.basename(file) and ".fastq" in file]
+    return sorted(names)
+
+def paired_sample_files(input_files, pair_id):
+    """ Get the forward and reverse input files for each sample
+       Args:
+           input_files (list): paths to the input files
+           pair_id (string): pair identifier
+
+       Returns:
+           list: forward and reverse files (in order of sorted sample names)
+    """
+    pair_id2 = pair_id.replace("1", "2", 1)
+    fwd_files = dict((os.path.basename(file).split(pair_id)[0], file) for file in input_files if pair_id in os.path.basename(file))
+    rev_files = dict((os.path.basename(file).split(pair_id2)[0], file) for file in input_files if pair_id2 in os.path.basename(file))
+    return [[fwd_files[sample], rev_files.get(sample)] for sample in sample_names(input_files, pair_id)]
+
+def filtered_files(output_folder, filtered_dir, sample, input_extension):
+    """ Get the forward and reverse filtered files for the sample (as named by the filter and trim step) """
+
+    extension = "fastq.gz" if input_extension.endswith("gz") else input_extension
+    return [os.path.join(os.path.abspath(output_folder), filtered_dir, sample+"_"+read+"_filt."+extension) for read in ["F","R"]]
+
+def filter_read_counts_file(output_folder, sample):
+    """ Get the read counts file written by the filter and trim step for the sample (when filtering each sample) """
+
+    return os.path.join(os.path.abspath(output_folder), "filter_read_counts", sample+"_F_filt_readcounts.tsv")
+
+def sample_filtered_depends(output_folder, filtered_dir, sample, input_extension):
+    """ Get the dependencies for the filtered reads of the sample (when filtering each sample)
+
+    The filtered files are written with the read counts for the sample. Samples without reads
+    after filtering do not have filtered files so the read counts file is always included.
+    """
+
+    sample_filtered_files = filtered_files(output_folder, filtered_dir, sample, input_extension)
+    depends = [filter_read_counts_file(output_folder, sample)]
+    if all(os.path.isfile(file) for file in sample_filtered_files):
+        depends += sample_filtered_files
+    return depends
+
+def reverse_complement(sequence):
+    """ Get the reverse complement of a sequence (allowing for IUPAC ambiguity codes) """
+
+    return "".join(IUPAC_COMPLEMENT.get(base, base) for base in reversed(sequence.upper()))
+
+def primer_pattern(primer):
+    """ Get a regex to search for a primer (allowing for IUPAC ambiguity codes) """
+
+    return re.compile("".join(IUPAC_CODES.get(base, base) for base in primer.upper()))
+
+def read_fastq_sequences(file, max_reads):
+    """ Read the sequences from a fastq file (allowing for gzip compression), skipping those with Ns """
+
+    file_handle = gzip.open(file, "rt" if sys.version_info[0] > 2 else "r") if file.endswith(".gz") else open(file)
+    sequences = []
+    with file_handle:
+        for line_number, line in enumerate(file_handle):
+            if len(sequences) >= max_reads:
+                break
+            if line_number % 4 == 1 and not "N" in line.upper():
+                sequences.append(line.strip().upper())
+    return sequences
+
+def primer_hits(primer, sequences):
+    """ Count the number of sequences in which the primer is found """
+
+    pattern = primer_pattern(primer)
+    return sum(1 for sequence in sequences if pattern.search(sequence))
 
-def remove_primers(workflow,fwd_primer,rev_primer,input_folder,output_folder,pair_id,threads):
-    """ Identifies primers and N filters samples
+def identify_primers(task, fwd_primer, rev_primer, max_reads=PRIMER_CHECK_READS):
+    """ Identify the orientation of the primers from the reads for the first sample and write
+        the primers (and their reverse complements) to fasta files for cutadapt
+       Args:
+           task (anadama2.task): an instance of the task class (the depends are the forward and
+               reverse reads and the targets are the forward, forward reverse complement, reverse,
+               and reverse reverse complement primer files)
+           fwd_primer (string): forward primer
+           rev_primer (string): reverse primer
+           max_reads (int): the max number of reads to check for each file
+    """
+
+    fwd_reads = read_fastq_sequences(task.depends[0].name, max_reads)
+    rev_reads = read_fastq_sequences(task.depends[1].name, max_reads)
+
+    # use the orientation found in the most reads
+    if primer_hits(fwd_primer, fwd_reads) <= primer_hits(reverse_complement(fwd_primer), fwd_reads):
+        fwd_primer = reverse_complement(fwd_primer)
+    if primer_hits(rev_primer, rev_reads) <= primer_hits(reverse_complement(rev_primer), rev_reads):
+        rev_primer = reverse_complement(rev_primer)
+
+    primers = [fwd_primer, reverse_complement(fwd_primer), rev_primer, reverse_complement(rev_primer)]
+    for primer, target in zip(primers, task.targets):
+        with open(target.name, "w") as file_handle:
+            file_handle.write(">"+os.path.basename(target.name).split(".")[0]+"\n"+primer+"\n")
+
+def remove_primers(workflow,fwd_primer,rev_primer,input_folder,output_folder,pair_id,threads,input_files=None):
+    """ Identifies primers and removes them (and reads with Ns) from each sample
        Args:
            workflow (anadama2.workflow): an instance of the workflow class
            input_folder (string): path to input folder
@@ -36,96 +176,56 @@ def remove_primers(workflow,fwd_primer,rev_primer,input_folder,output_folder,pai
            rev_primer (string): reverse primer
            pair_id (string): pair identifier
            threads (string): number of threads
+           input_files (list): paths to the input files (optional, the input folder is listed if not provided)
 
        Requires:
-          dada2, Biostrings, ShortRead, tools r packages
+          cutadapt
 
        Returns:
            string: path to folder with primers removed files
+           list: paths to the primers removed files
     """
-    script_path = utilities.get_package_file("identify_primers", "Rscript")
-    filtN_folder = os.path.join(output_folder,"filtN")
-    primers_folder = os.path.join(output_folder,"primers")
-    fwd_primer_file = os.path.join(primers_folder,"fwd_primer_file.txt")
-    rev_primer_file = os.path.join(primers_folder,"rev_primer_file.txt")
-    cutadapt_folder = os.path.join(output_folder, "cutadapt")
-
-    # run identify primers task
+    primers_folder = os.path.join(os.path.abspath(output_folder),"primers")
+    primer_files = [os.path.join(primers_folder,name+".fasta") for name in ["fwd_primer","fwd_primer_rc","rev_primer","rev_primer_rc"]]
+    cutadapt_folder = os.path.join(os.path.abspath(output_folder), "cutadapt")
+    utilities.create_folders(primers_folder)
+    utilities.create_folders(cutadapt_folder)
+
+    if input_files is None:
+        input_files = fnmatch.filter(os.listdir(input_folder), "*.fastq*")
+    sample_files = [[os.path.join(input_folder,os.path.basename(file)) for file in pair]
+        for pair in paired_sample_files(input_files, pair_id)]
+
+    # identify the orientation of the primers once from the first sample
     workflow.add_task(
-        "[vars[0]]  \
-          --input_dir=[args[3]] \
-          --filtn_dir=[vars[1]] \
-          --primers_dir=[vars[2]] \
-          --threads=[args[4]] \
-          --fwd_primer_file=[targets[0]] \
-          --rev_primer_file=[targets[1]] \
-          --fwd_primer=[args[0]] \
-          --rev_primer=[args[1]] \
-          --pair_id=[args[2]]",
-        targets=[fwd_primer_file,rev_primer_file,
-                 TrackedDirectory(filtN_folder)],
-        args=[fwd_primer, rev_primer, pair_id,input_folder,threads],
-        vars=[script_path,filtN_folder,primers_folder,output_folder],
+        utilities.partial_function(identify_primers, fwd_primer=fwd_primer, rev_primer=rev_primer),
+        depends=sample_files[0] if sample_files else [],
+        targets=primer_files,
         name="identify_primers"
     )
 
-    pair_id2 = pair_id.replace("1", "2",1)
-    fwd_files = sorted(fnmatch.filter(os.listdir(input_folder), "*"+pair_id+"*.fastq*"))
-    rev_files = sorted(fnmatch.filter(os.listdir(input_folder), "*" + pair_id2 + "*.fastq*"))
-
-    #run cutadapt to remove primers
-    for i in range(0,len(fwd_files)):
-        fwd_file=os.path.join(input_folder,fwd_files[i])
-        rev_file = os.path.join(input_folder, rev_files[i])
-        workflow.add_task(
-            cutadapt_do,
-            depends=[fwd_primer_file,
-                     rev_primer_file,
-                     fwd_file,
-                     rev_file,
-                     TrackedDirectory(filtN_folder),
+    # run cutadapt to remove primers for each sample
+    cutadapt_files = []
+    for sample, (fwd_file, rev_file) in zip(sample_names(input_files, pair_id), sample_files):
+        targets = [os.path.join(cutadapt_folder,os.path.basename(fwd_file)), os.path.join(cutadapt_folder,os.path.basename(rev_file))]
+        cutadapt_files += targets
+        workflow.add_task_gridable(
+            "cutadapt -j [args[0]] -g file:[depends[0]] -a file:[depends[3]] -G file:[depends[2]] -A file:[depends[1]] "+\
+                "-n 2 --max-n 0 --minimum-length 10 -o [targets[0]] -p [targets[1]] [depends[4]] [depends[5]]",
+            depends=primer_files+[fwd_file,rev_file,
                      TrackedExecutable("cutadapt",version_command="echo 'cutadapt' `cutadapt --version`")],
-            targets=[TrackedDirectory(cutadapt_folder)],
-            name="remove_primers"
+            targets=targets,
+            args=[threads],
+            time="int(10+60*( file_size('{0}') + file_size('{1}') ))".format(fwd_file, rev_file), # 10 minutes or more depending on input size
+            mem=2*1024,
+            cores=threads,
+            name=utilities.name_task(sample,"remove_primers")
         )
 
-    return cutadapt_folder
-
-
-def cutadapt_do(task):
-
-    """Reads primers from the files and runs cutadapt task
-           Args:
-               task (anadama2.task): an instance of the task class"""
-
-    from anadama2.util import get_name
+    return cutadapt_folder, cutadapt_files
 
-    with open(get_name(task.depends[0])) as f:
-        FWD = f.read().splitlines()
-    with open(get_name(task.depends[1])) as f:
-        REV = f.read().splitlines()
 
-    cutadapt_folder=get_name(task.targets[0])
-    filtN_folder = get_name(task.depends[4])
-    fwd_filename=os.path.basename(get_name(task.depends[2]))
-    rev_filename = os.path.basename(get_name(task.depends[3]))
-
-    fwd_reads_out=os.path.join(cutadapt_folder,fwd_filename)
-    rev_reads_out = os.path.join(cutadapt_folder,rev_filename)
-    fwd_reads_in = os.path.join(filtN_folder,fwd_filename)
-    rev_reads_in = os.path.join(filtN_folder,rev_filename)
-
-    if not os.path.exists(cutadapt_folder):
-        os.mkdir(cutadapt_folder)
-
-    command="cutadapt -g "+FWD[0]+" -a "+REV[1]+" -G "+REV[0]+" -A "+FWD[1]+" -n 2 -o "+fwd_reads_out+\
-                       " -p "+rev_reads_out+" "+fwd_reads_in+" "+ rev_reads_in+" --minimum-length 10"
-    
-    #run task
-    utilities.run_task(command, depends=task.depends, targets=task.targets)
-
-
-def filter_trim(workflow,input_folder,output_folder,maxee,trunc_len_max,pair_id,threads):
+def filter_trim(workflow,input_folder,output_folder,maxee,trunc_len_max,pair_id,threads,samples=None,input_files=None,input_depends=None):
     
          """ Filters samples by maxee and trims them, renders quality control plots
          of forward and reverse reads for each sample, creates read counts tsv and rds files.
@@ -138,6 +238,10 @@ def filter_trim(workflow,input_folder,output_folder,maxee,trunc_len_max,pair_id,
                 trunc_len_max (string): max length for truncating reads
                 pair_id (string): pair identifier
                 threads (int): number of threads
+                samples (list): if provided, run a gridable filter task for each sample
+                input_files (list): the forward and reverse input files for each sample (required with samples)
+                input_depends (list): the dependencies for the input files, if they are not
+                    the input folder (or the input files for each sample)
                 
             Requires:
                dada2, gridExtra,tools r packages
@@ -149,33 +253,80 @@ def filter_trim(workflow,input_folder,output_folder,maxee,trunc_len_max,pair_id,
          reads_plotF_png = files.SixteenS.path("readF_qc", output_folder)
          reads_plotR_png = files.SixteenS.path("readR_qc", output_folder)
 
-         readcounts_tsv_path = os.path.join(output_folder, "Read_counts_after_filtering.tsv")
+         readcounts_tsv_path = os.path.join(output_folder, FILTER_READ_COUNTS)
          readcounts_rds_path = os.path.join(output_folder, "Read_counts_filt.rds")
          filtered_dir = "filtered_input"
          script_path = utilities.get_package_file("filter_and_trim", "Rscript")
-         workflow.add_task(
-             "[vars[0]] \
+
+         command = "[vars[0]] \
                --input_dir=[args[0]]\
                --output_dir=[args[1]]\
                --filtered_dir=[vars[1]]\
                --maxee=[args[2]]\
                --trunc_len_max=[args[3]]\
-               --readcounts_tsv_path=[targets[0]]\
-               --readcounts_rds_path=[targets[1]]\
-               --reads_plotF=[targets[2]]\
-               --reads_plotR=[targets[3]]\
                --pair_id=[args[4]]\
-               --threads=[args[5]]",
-             depends =[TrackedDirectory(input_folder)],
-             targets = [readcounts_tsv_path, readcounts_rds_path, reads_plotF_png, reads_plotR_png],
-             args = [input_folder, output_folder, maxee, trunc_len_max, pair_id, threads],
+               --threads=[args[5]]"
+         readcounts_options = " --readcounts_tsv_path=[targets[0]] --readcounts_rds_path=[targets[1]]"
+
+         if not samples:
+             workflow.add_task(
+                 command+readcounts_options+" --reads_plotF=[targets[2]] --reads_plotR=[targets[3]]",
+                 depends = (input_depends or [TrackedDirectory(input_folder)]),
+                 targets = [readcounts_tsv_path, readcounts_rds_path, reads_plotF_png, reads_plotR_png],
+                 args = [input_folder, output_folder, maxee, trunc_len_max, pair_id, threads],
+                 vars = [script_path,filtered_dir],
+                 name ="filter_and_trim"
+                 )
+             return readcounts_tsv_path, filtered_dir
+
+         # filter each sample, writing the read counts for each sample
+         readcounts_folder = os.path.join(os.path.abspath(output_folder), "filter_read_counts")
+         utilities.create_folders(readcounts_folder)
+         input_depends = input_depends or []
+         sample_readcounts = []
+         for sample, sample_input_files in zip(samples, input_files):
+             sample_readcounts_tsv = filter_read_counts_file(output_folder, sample)
+             sample_readcounts.append(os.path.splitext(sample_readcounts_tsv)[0]+".rds")
+             workflow.add_task_gridable(
+                 command+readcounts_options+" --sample_name=[args[6]] --plots=FALSE",
+                 depends = (input_depends or sample_input_files),
+                 targets = [sample_readcounts_tsv, sample_readcounts[-1]],
+                 args = [input_folder, output_folder, maxee, trunc_len_max, pair_id, threads, sample],
+                 vars = [script_path,filtered_dir],
+                 time = "int(10+60*( file_size('{0}') + file_size('{1}') ))".format(*sample_input_files), # 10 minutes or more depending on input size
+                 mem = "int(2*1024+4*1024*( file_size('{0}') + file_size('{1}') ))".format(*sample_input_files), # 2 GB or more depending on input size
+                 cores = threads,
+                 name = utilities.name_task(sample,"filter_and_trim")
+                 )
+
+         # gather the read counts for all samples
+         workflow.add_task(
+             "[vars[0]] \
+               --readcounts_dir=[args[0]]\
+               --readcounts_tsv_path=[targets[0]]\
+               --readcounts_rds_path=[targets[1]]",
+             depends = sample_readcounts,
+             targets = [readcounts_tsv_path, readcounts_rds_path],
+             args = [readcounts_folder],
+             vars = [utilities.get_package_file("gather_read_counts", "Rscript")],
+             name = "gather_filter_read_counts"
+             )
+
+         # create the quality plots from a sample of the reads from each file (nothing depends on the plots)
+         workflow.add_task(
+             command+" --reads_plotF=[targets[0]] --reads_plotR=[targets[1]] --filter=FALSE --plot_reads=[args[6]]",
+             depends = (input_depends or [file for sample_input_files in input_files for file in sample_input_files]),
+             targets = [reads_plotF_png, reads_plotR_png],
+             args = [input_folder, output_folder, maxee, trunc_len_max, pair_id, threads, QUALITY_PLOT_READS],
              vars = [script_path,filtered_dir],
-             name ="filter_and_trim"
+             name = "quality_plots"
              )
+
          return readcounts_tsv_path, filtered_dir
      
 
-def learn_error(workflow, output_folder, filtered_dir, readcounts_tsv_path, threads):
+def learn_error(workflow, output_folder, filtered_dir, readcounts_tsv_path, threads, error_model=None, error_model_cache=None,
+    samples=None, input_extension="fastq.gz"):
     
          """ Learns error rates for each sample, renders error rates plots for forward and reverse reads
             
@@ -185,6 +336,13 @@ def learn_error(workflow, output_folder, filtered_dir, readcounts_tsv_path, thre
                 filtered_dir (string): path to directory with filtered files
                 readcounts_tsv_path (string): path to read counts after filtering tsv file
                 threads (int): number of threads
+                error_model (list): paths to rds files of forward and reverse error rates
+                    to use instead of learning the error rates (optional)
+                error_model_cache (string): path to folder to cache learned error rates, keyed by the
+                    sequencer runs of the filtered reads (optional)
+                samples (list): if provided, depend on the filtered reads for each sample (as filtered
+                    by a task for each sample) instead of the read counts file
+                input_extension (string): the extension of the input files (used to name the filtered files)
 
             Requires:
                 dada2, ggplot2 r packages
@@ -201,17 +359,34 @@ def learn_error(workflow, output_folder, filtered_dir, readcounts_tsv_path, thre
          error_ratesR_path =os.path.join(output_folder, "error_ratesREV.rds")
 
          script_path = utilities.get_package_file("learn_error_rates", "Rscript")
-       
-         workflow.add_task(
-             "[vars[0]] \
+
+         command = "[vars[0]] \
                --output_dir=[args[0]]\
                --filtered_dir=[args[1]]\
                --error_ratesF_png=[targets[0]]\
                --error_ratesR_png=[targets[1]]\
                --error_ratesF_path=[targets[2]]\
                --error_ratesR_path=[targets[3]]\
-               --threads=[vars[1]]",
-             depends = [readcounts_tsv_path],
+               --threads=[vars[1]]"
+
+         # use the error rates provided (these do not depend on the filtered reads)
+         # or learn the error rates from the filtered reads (caching them if requested)
+         if error_model:
+             command += " --error_ratesF_input=[depends[0]] --error_ratesR_input=[depends[1]]"
+             depends = list(error_model)
+         else:
+             if samples:
+                 depends = [file for sample in samples for file in sample_filtered_depends(output_folder, filtered_dir, sample, input_extension)]
+             else:
+                 depends = [readcounts_tsv_path]
+             if error_model_cache:
+                 command = utilities.partial_function(cached_error_rates, command=command, args=[output_folder, filtered_dir],
+                     variables=[script_path, threads], cache_folder=os.path.abspath(error_model_cache),
+                     filtered_folder=os.path.join(output_folder, filtered_dir))
+       
+         workflow.add_task(
+             command,
+             depends = depends,
              targets = [error_ratesF_png, error_ratesR_png, error_ratesF_path, error_ratesR_path],  
              args = [output_folder, filtered_dir],
              vars = [script_path, threads],
@@ -220,7 +395,140 @@ def learn_error(workflow, output_folder, filtered_dir, readcounts_tsv_path, thre
          return error_ratesF_path, error_ratesR_path
      
 
-def merge_paired_ends(workflow, output_dir, filtered_dir, error_ratesF_path, error_ratesR_path, threads, minoverlap, maxmismatch):
+def error_rates_fingerprint(files, reads=ERROR_RATES_CACHE_READS):
+    """ Get the sequencer run ids and the counts of each quality score from the first reads of each fastq file
+
+    Args:
+        files (list): The paths to the fastq files (compressed or not).
+        reads (int): The number of reads to read from each file.
+
+    Returns:
+        list: The sorted run ids (instrument, run number, and flowcell) or None if any
+            read does not have an illumina read id.
+        dict: The total count of each quality score (as the ascii code).
+    """
+
+    run_ids = set()
+    qualities = {}
+    for file in files:
+        file_handle = gzip.open(file, "rt" if sys.version_info[0] > 2 else "r") if file.endswith(".gz") else open(file)
+        with file_handle:
+            for line_number, line in enumerate(file_handle):
+                if line_number >= reads*4:
+                    break
+                if line_number % 4 == 0:
+                    fields = (line[1:].split() or [""])[0].split(":")
+                    if len(fields) < 7:
+                        run_ids = None
+                    elif run_ids is not None:
+                        run_ids.add(":".join(fields[:3]))
+                elif line_number % 4 == 3:
+                    # count the scores as they are read so they are not all kept in memory
+                    for score in line.rstrip():
+                        qualities[ord(score)] = qualities.get(ord(score), 0) + 1
+
+    return (sorted(run_ids) if run_ids is not None else None), qualities
+
+def quality_distance(qualities1, qualities2):
+    """ Get the total variation distance between the distributions of quality scores """
+
+    total1 = float(sum(qualities1.values())) or 1.0
+    total2 = float(sum(qualities2.values())) or 1.0
+    return sum(abs(qualities1.get(score, 0)/total1 - qualities2.get(score, 0)/total2)
+        for score in set(qualities1).union(qualities2)) / 2.0
+
+def error_rates_cache_file(cache_folder, run_ids, direction):
+    """ Get the cached error rates file for the sequencer runs, read direction, and dada2 version """
+
+    key = hashlib.md5("\t".join(["dada2="+dada2_version()]+run_ids).encode("utf-8")).hexdigest()
+    return os.path.join(cache_folder, key+"_err"+direction+".rds")
+
+def read_cached_qualities(cache_file):
+    """ Read the counts of each quality score for the reads the cached error rates were learned from """
+
+    qualities = {}
+    with open(cache_file.replace(".rds", "_qualities.tsv")) as file_handle:
+        for line in file_handle:
+            score, count = line.rstrip("\n").split("\t")
+            qualities[int(score)] = int(count)
+    return qualities
+
+def find_cached_error_rates(cache_folder, files, direction):
+    """ Find the cached error rates learned from reads from the same sequencer runs with a similar
+    distribution of quality scores
+
+    Args:
+        cache_folder (string): The folder of cached error rates.
+        files (list): The paths to the filtered fastq files.
+        direction (string): The read direction (F or R).
+
+    Returns:
+        string: The path to the cache file (or None if the reads do not have illumina read ids).
+        dict: The counts of each quality score for the reads.
+        bool: The cached error rates can be used.
+    """
+
+    run_ids, qualities = error_rates_fingerprint(files)
+    if not run_ids:
+        return None, qualities, False
+
+    cache_file = error_rates_cache_file(cache_folder, run_ids, direction)
+    found = os.path.isfile(cache_file) and os.path.isfile(cache_file.replace(".rds", "_qualities.tsv")) and \
+        quality_distance(qualities, read_cached_qualities(cache_file)) <= ERROR_RATES_CACHE_MAX_DISTANCE
+    return cache_file, qualities, found
+
+def cache_error_rates(error_rates_file, cache_file, qualities):
+    """ Copy the error rates to the cache with the counts of the quality scores they were learned from """
+
+    utilities.create_folders(os.path.dirname(cache_file))
+    qualities_file = cache_file.replace(".rds", "_qualities.tsv")
+
+    # write to temp files and then rename so runs sharing the cache do not read partial files
+    shutil.copyfile(error_rates_file, cache_file+".tmp")
+    with open(qualities_file+".tmp", "w") as file_handle:
+        for score, count in sorted(qualities.items()):
+            file_handle.write(str(score)+"\t"+str(count)+"\n")
+    os.rename(cache_file+".tmp", cache_file)
+    os.rename(qualities_file+".tmp", qualities_file)
+
+def cached_error_rates(task, command, args, variables, cache_folder, filtered_folder):
+    """ Learn the error rates, or use the error rates cached for reads from the same sequencer runs,
+    and add the learned error rates to the cache
+
+    Args:
+        task (anadama2.task): An instance of the task class (the targets are the error rates
+            plots and the forward and reverse error rates files).
+        command (string): The command to learn the error rates.
+        args (list): The args for the command.
+        variables (list): The vars for the command.
+        cache_folder (string): The folder of cached error rates.
+        filtered_folder (string): The folder of filtered reads.
+
+    Requires:
+        dada2, ggplot2 r packages
+
+    Returns:
+        None
+    """
+
+    cached = []
+    for direction in ["F", "R"]:
+        files = [os.path.join(filtered_folder, file) for file in sorted(os.listdir(filtered_folder)) if "_"+direction+"_filt.fastq" in file]
+        cached.append(find_cached_error_rates(cache_folder, files, direction))
+
+    if all(found for cache_file, qualities, found in cached):
+        print("Using cached error rates: "+" ".join(cache_file for cache_file, qualities, found in cached))
+        command += " --error_ratesF_input="+cached[0][0]+" --error_ratesR_input="+cached[1][0]
+        utilities.run_task(command, depends=task.depends, targets=task.targets, args=args, vars=variables)
+        return
+
+    utilities.run_task(command, depends=task.depends, targets=task.targets, args=args, vars=variables)
+    for error_rates_file, (cache_file, qualities, found) in zip([task.targets[2].name, task.targets[3].name], cached):
+        if cache_file:
+            cache_error_rates(error_rates_file, cache_file, qualities)
+
+def merge_paired_ends(workflow, output_dir, filtered_dir, error_ratesF_path, error_ratesR_path, threads, minoverlap, maxmismatch,
+    samples=None, input_extension="fastq.gz"):
     
         """ Dereplicates and merges paired reads
             
@@ -233,18 +541,19 @@ def merge_paired_ends(workflow, output_dir, filtered_dir, error_ratesF_path, err
                 threads (int): number of threads
                 minoverlap (int): the min number of pairs for overlap for the merge step
                 maxmismatch (int): the max number of mismatch for pairs to merge
+                samples (list): if provided, run a gridable task for each sample
+                input_extension (string): the extension of the input files (used to name the filtered files)
             Requires:
                 dada2, tools r packages
                 
             Returns:
                 string: path to rds file that contains merged and dereplicated reads
+                    (or a list of rds files, one for each sample, if samples are provided)
          """
 
-        mergers_file_path = os.path.join(output_dir, "mergers.rds")
         script_path = utilities.get_package_file("merge_paired_ends", "Rscript")
-        
-        workflow.add_task(
-            "[vars[0]] \
+
+        command = "[vars[0]] \
               --output_dir=[args[0]]\
               --filtered_dir=[args[1]]\
               --error_ratesF_path=[depends[0]]\
@@ -252,8 +561,33 @@ def merge_paired_ends(workflow, output_dir, filtered_dir, error_ratesF_path, err
               --mergers_file_path=[targets[0]]\
               --threads=[vars[1]]\
               --minoverlap=[args[2]]\
-              --maxmismatch=[args[3]]",
-            depends = [error_ratesF_path, error_ratesR_path],
+              --maxmismatch=[args[3]]"
+
+        if samples:
+            # run the sample inference and merge for each sample
+            mergers_folder = os.path.join(os.path.abspath(output_dir), "mergers")
+            utilities.create_folders(mergers_folder)
+            mergers_files = [os.path.join(mergers_folder, sample+"_mergers.rds") for sample in samples]
+            for sample, mergers_file in zip(samples, mergers_files):
+                sample_filtered_files = filtered_files(output_dir, filtered_dir, sample, input_extension)
+                workflow.add_task_gridable(
+                    command+" --sample_name=[args[4]]",
+                    depends = [error_ratesF_path, error_ratesR_path]+sample_filtered_depends(output_dir, filtered_dir, sample, input_extension),
+                    targets = [mergers_file],
+                    args = [output_dir, filtered_dir, minoverlap, maxmismatch, sample],
+                    vars = [script_path, threads],
+                    time = SAMPLE_TASK_TIME.format(*sample_filtered_files), # 30 minutes or more depending on filtered reads
+                    mem = SAMPLE_TASK_MEM.format(*sample_filtered_files), # 4 GB or more depending on filtered reads
+                    cores = threads,
+                    name = utilities.name_task(sample,"dereplicate_and_merge")
+                    )
+            return mergers_files
+
+        mergers_file_path = os.path.join(output_dir, "mergers.rds")
+        
+        workflow.add_task(
+            command,
+            depends = [error_ratesF_path, error_ratesR_path, os.path.join(output_dir, FILTER_READ_COUNTS)],
             targets = [mergers_file_path],                       
             args = [output_dir, filtered_dir, minoverlap, maxmismatch],
             vars = [script_path, threads],
@@ -271,6 +605,7 @@ def const_seq_table(workflow, output_folder, filtered_dir,  mergers_file_path, t
                 output_folder (string):  path to output folder
                 filtered_dir (string): path to directory with filtered files
                 mergers_file_path (string): path to rds file that contains merged reads
+                    (or a list of rds files, one for each sample, to gather)
                 threads (int): number of threads
                 
             Requires:
@@ -294,8 +629,7 @@ def const_seq_table(workflow, output_folder, filtered_dir,  mergers_file_path, t
 
          version_command = """echo 'r' `r -e 'packageVersion("dada2")' | grep -C 1 dada2`"""
 
-         workflow.add_task(
-            "[vars[0]] \
+         command = "[vars[0]] \
               --output_dir=[args[0]]\
               --filtered_dir=[args[1]]\
               --merged_file_path=[depends[0]]\
@@ -304,8 +638,18 @@ def const_seq_table(workflow, output_folder, filtered_dir,  mergers_file_path, t
               --asv_tsv=[vars[3]]\
               --seqtab_file_path=[targets[1]]\
               --seqs_fasta_path=[targets[2]]\
-              --threads=[vars[1]]",
-            depends = [mergers_file_path,TrackedExecutable("R", version_command="echo '" +  version_script + "' `" + version_script + "`")],
+              --threads=[vars[1]]"
+
+         # gather the merged reads for each sample, if provided
+         if isinstance(mergers_file_path, list):
+             command += " --mergers_dir="+os.path.dirname(mergers_file_path[0])
+         else:
+             mergers_file_path = [mergers_file_path]
+
+         workflow.add_task(
+            command,
+            depends = mergers_file_path+[os.path.join(output_folder, readcounts_rds),
+                TrackedExecutable("R", version_command="echo '" +  version_script + "' `" + version_script + "`")],
             targets = [read_counts_steps_path, seqtab_file_path, seqs_fasta_path],
             args = [output_folder, filtered_dir],
             vars = [script_path, threads, readcounts_rds, asv_tsv ],
@@ -314,7 +658,104 @@ def const_seq_table(workflow, output_folder, filtered_dir,  mergers_file_path, t
          return seqtab_file_path, read_counts_steps_path, seqs_fasta_path
 
 
-def assign_taxonomy(workflow, output_folder, seqtab_file_path, ref_path, threads):
+def dada2_version():
+    """ Get the version of the dada2 r package """
+
+    version_script = utilities.get_package_file("dada2_version", "Rscript")
+    try:
+        return subprocess.check_output([version_script]).decode("utf-8").strip().split(" ")[-1].strip('"')
+    except (subprocess.CalledProcessError, EnvironmentError):
+        raise EnvironmentError("Unable to get the dada2 version for the cache")
+
+def taxonomy_cache_file(cache_folder, refdb_path, refdb_species_path):
+    """ Get the taxonomy cache file for the reference databases (keyed on their checksums) and dada2 version """
+
+    key = []
+    for database in [refdb_path, refdb_species_path]:
+        key.append(utilities.file_checksum(database) if os.path.isfile(database) else os.path.basename(database))
+    key += ["dada2="+dada2_version(), "minBoot="+str(TAXONOMY_MIN_BOOT)]
+    key = os.path.basename(refdb_path).split(".")[0]+"_"+hashlib.md5("\t".join(key).encode("utf-8")).hexdigest()
+
+    return os.path.join(os.path.abspath(cache_folder), key, TAXONOMY_CACHE_FILE)
+
+def read_taxonomy_cache(cache_file):
+    """ Read the taxonomy for each sequence hash from the cache """
+
+    columns=[]
+    taxonomy={}
+    if os.path.isfile(cache_file):
+        with open(cache_file) as file_handle:
+            for line in file_handle:
+                data=line.rstrip("\n").split("\t")
+                if line.startswith("#"):
+                    columns=data[1:]
+                elif len(data) == len(columns)+1:
+                    taxonomy[data[0]]=data[1:]
+    return columns, taxonomy
+
+def split_sequences(task, refdb_path, refdb_species_path, cache_folder=None):
+    """ Split the sequences, without taxonomy in the cache, into chunks for taxonomy assignment
+    
+        Args:
+            task (anadama2.task): an instance of the task class (the depends is the fasta file
+                of sequences and the targets are the fasta files for the chunks)
+            refdb_path (string): the path to the reference database
+            refdb_species_path (string): the path to the reference species database
+            cache_folder (string): the taxonomy cache folder (optional)
+    """
+
+    cached = {}
+    if cache_folder:
+        cached = read_taxonomy_cache(taxonomy_cache_file(cache_folder, refdb_path, refdb_species_path))[1]
+
+    sequences = [[seq_id, sequence] for seq_id, sequence in utilities.read_fasta(task.depends[0].name) if not utilities.sequence_hash(sequence) in cached]
+
+    chunk_size = max(1, -(-len(sequences) // len(task.targets)))
+    for i, target in enumerate(task.targets):
+        with open(target.name, "w") as file_handle:
+            for seq_id, sequence in sequences[i*chunk_size:(i+1)*chunk_size]:
+                file_handle.write(">"+seq_id+"\n"+sequence+"\n")
+
+def gather_taxonomy(task, refdb_path, refdb_species_path, cache_folder=None):
+    """ Gather the taxonomy assigned for each chunk (and the cache) for all sequences,
+        adding the new assignments to the cache
+    
+        Args:
+            task (anadama2.task): an instance of the task class (the depends are the fasta file
+                of sequences and then the taxonomy for each chunk, the target is the taxonomy file)
+            refdb_path (string): the path to the reference database
+            refdb_species_path (string): the path to the reference species database
+            cache_folder (string): the taxonomy cache folder (optional)
+    """
+
+    columns, cached, cache_file = [], {}, None
+    if cache_folder:
+        cache_file = taxonomy_cache_file(cache_folder, refdb_path, refdb_species_path)
+        columns, cached = read_taxonomy_cache(cache_file)
+
+    # read the taxonomy assigned for the new sequences
+    assigned = {}
+    for chunk in task.depends[1:]:
+        with open(chunk.name) as file_handle:
+            header = file_handle.readline().rstrip("\n").split("\t")
+            if len(header) > 1:
+                columns = header[1:]
+            for line in file_handle:
+                data = line.rstrip("\n").split("\t")
+                assigned[utilities.sequence_hash(data[0])] = data[1:]
+
+    # add the new assignments to the cache
+    if cache_file and assigned:
+        utilities.append_to_cache(cache_file, ["\t".join([key]+values) for key, values in assigned.items()],
+            header="\t".join(["#sequence_hash"]+columns))
+
+    with open(task.targets[0].name, "w") as file_handle:
+        file_handle.write("\t".join([""]+columns)+"\n")
+        for seq_id, sequence in utilities.read_fasta(task.depends[0].name):
+            key = utilities.sequence_hash(sequence)
+            file_handle.write("\t".join([sequence]+assigned.get(key, cached.get(key, [])))+"\n")
+
+def assign_taxonomy(workflow, output_folder, seqtab_file_path, ref_path, threads, seqs_fasta_path=None, chunks=1, cache_folder=None):
     
          """ Assigns taxonomy using green genes, silva, or rdp database, creates closed reference file
             
@@ -324,6 +765,9 @@ def assign_taxonomy(workflow, output_folder, seqtab_file_path, ref_path, threads
                 seqtab_file_path (string): path to rds file that contains ASV data
                 ref_path (string): reference database name
                 threads (int):
+                seqs_fasta_path (string): path to fasta file with all sequences (required with chunks or cache)
+                chunks (int): the number of gridable tasks to assign taxonomy to new sequences
+                cache_folder (string): the folder of taxonomy assigned in prior runs (optional)
                 
             Requires:
                 dada2 r package
@@ -349,16 +793,62 @@ def assign_taxonomy(workflow, output_folder, seqtab_file_path, ref_path, threads
              refdb_species_path = "None"
 
          script_path = utilities.get_package_file("assign_taxonomy", "Rscript")
-             
-         workflow.add_task(
-            "[vars[2]] \
+
+         command = "[vars[2]] \
               --output_dir=[args[0]]\
               --refdb_path=[vars[0]]\
               --refdb_species_path=[vars[1]]\
               --seqtab_file_path=[depends[0]]\
               --otu_closed_ref_path=[targets[0]]\
-              --threads=[vars[3]]",
-            depends = [seqtab_file_path],
+              --threads=[vars[3]]"
+         depends = [seqtab_file_path]
+
+         # assign taxonomy to the sequences not in the cache in chunks
+         if seqs_fasta_path and (chunks > 1 or cache_folder):
+             taxonomy_folder = os.path.join(os.path.abspath(output_folder), "taxonomy_chunks")
+             utilities.create_folders(taxonomy_folder)
+             chunk_fastas = [os.path.join(taxonomy_folder, "chunk_"+str(i)+".fasta") for i in range(chunks)]
+             chunk_taxonomy = [os.path.join(taxonomy_folder, "chunk_"+str(i)+"_taxonomy.tsv") for i in range(chunks)]
+             taxonomy_path = os.path.join(taxonomy_folder, "taxonomy.tsv")
+
+             workflow.add_task(
+                utilities.partial_function(split_sequences, refdb_path=refdb_path, refdb_species_path=refdb_species_path, cache_folder=cache_folder),
+                depends = [seqs_fasta_path],
+                targets = chunk_fastas,
+                name = "split_sequences_for_taxonomy"
+                )
+
+             for i, (chunk_fasta, chunk_tsv) in enumerate(zip(chunk_fastas, chunk_taxonomy)):
+                 workflow.add_task_gridable(
+                    "[vars[2]] \
+                      --fasta_path=[depends[0]]\
+                      --refdb_path=[vars[0]]\
+                      --refdb_species_path=[vars[1]]\
+                      --taxonomy_path=[targets[0]]\
+                      --min_boot=[vars[4]]\
+                      --threads=[vars[3]]",
+                    depends = [chunk_fasta],
+                    targets = [chunk_tsv],
+                    vars = [refdb_path, refdb_species_path, utilities.get_package_file("assign_taxonomy_chunk", "Rscript"), threads, TAXONOMY_MIN_BOOT],
+                    time = "int(10+2*60*1024*file_size('[depends[0]]'))", # 10 minutes plus 2 hours per MB of sequences
+                    mem = "16*1024 if file_size('[depends[0]]') > 0 else 1024", # 16 GB to load the database
+                    cores = threads,
+                    name = "assign_taxonomy_chunk_"+str(i)
+                    )
+
+             workflow.add_task(
+                utilities.partial_function(gather_taxonomy, refdb_path=refdb_path, refdb_species_path=refdb_species_path, cache_folder=cache_folder),
+                depends = [seqs_fasta_path]+chunk_taxonomy,
+                targets = [taxonomy_path],
+                name = "gather_taxonomy"
+                )
+
+             command += " --taxonomy_path=[depends[1]]"
+             depends.append(taxonomy_path)
+             
+         workflow.add_task(
+            command,
+            depends = depends,
             targets = [otu_closed_ref_path],                              
             args = [output_folder],
             vars =[refdb_path, refdb_species_path, script_path, threads],
@@ -28,17 +28,34 @@ import os
 import subprocess
 import itertools
 
-from anadama2.tracked import TrackedExecutable, TrackedDirectory
+from anadama2.tracked import TrackedExecutable, TrackedDirectory, TrackedFile
 
 from biobakery_workflows import utilities
 from biobakery_workflows import files
 from biobakery_workflows import data
+from biobakery_workflows import alignments
 
 # constants
 BOWTIE2_EXTENSION=".1.bt2"
+GROUP_INDEX_EXTENSION=".index"
+COMPRESSED_SAM_EXTENSION=alignments.COMPRESSED_SAM_EXTENSION
+
+# the resources for strainphlan clade tasks (time in minutes, memory in MB)
+STRAINPHLAN_CLADE_TIME=6*60
+STRAINPHLAN_MIN_MEMORY=4*1024
+STRAINPHLAN_MAX_MEMORY=50*1024
+STRAINPHLAN_MEMORY_PER_SAMPLE_MARKER_MB=20
+STRAINPHLAN_DEFAULT_MARKERS_MB=1
+STRAINPHLAN_EMPTY_CLADE_TIME=5
+STRAINPHLAN_EMPTY_CLADE_MEMORY=1024
+
+# the clade markers are cached in the markers folder by database version and clade
+STRAINPHLAN_DATABASE="mpa_v20_m200.pkl"
+STRAINPHLAN_MARKER_CACHE="clade_markers"
 
 def kneaddata(workflow, input_files, extension, output_folder, threads, paired=None, 
-    databases=None, pair_identifier=None, additional_options=None, remove_intermediate_output=None):
+    databases=None, pair_identifier=None, additional_options=None, remove_intermediate_output=None,
+    wait_for=None):
     """Run kneaddata
     
     This set of tasks will run kneaddata on the input files provided. It will run with
@@ -58,6 +75,9 @@ def kneaddata(workflow, input_files, extension, output_folder, threads, paired=N
             the first pair in the set (optional).
         additional_options (string): Additional options when running kneaddata (optional).
         remove_intermediate_output (bool): Remove intermediate output files.
+        wait_for (list): Tasks that must finish before kneaddata tasks start (optional).
+            This is used to limit the number of samples in progress at once. These are
+            task dependencies, so if one of these tasks is rerun kneaddata is also rerun.
         
     Requires:
         kneaddata v0.6.1+: A tool to perform quality control on metagenomic and
@@ -148,7 +168,7 @@ def kneaddata(workflow, input_files, extension, output_folder, threads, paired=N
     for sample, depends, targets, intermediate_file in zip(sample_names, input_files, kneaddata_output_files, kneaddata_output_repeats_removed_fastq):
         workflow.add_task_gridable(
             "kneaddata --input [depends[0]] --output [args[0]] --threads [args[1]] --output-prefix [args[2]] "+second_input_option+optional_arguments+" "+additional_options+rename_final_output,
-            depends=utilities.add_to_list(depends,TrackedExecutable("kneaddata")),
+            depends=utilities.add_to_list(depends,TrackedExecutable("kneaddata"))+(wait_for or []),
             targets=targets,
             args=[kneaddata_output_folder, threads, sample, intermediate_file],
             time=time_equation, # 6 hours or more depending on file size
@@ -158,10 +178,12 @@ def kneaddata(workflow, input_files, extension, output_folder, threads, paired=N
     
     return kneaddata_output_fastq, kneaddata_output_logs
 
-def kneaddata_read_count_table(workflow, input_files, output_folder):
-    """Run kneaddata_read_count_table
+def kneaddata_read_count_table(workflow, input_files, output_folder, threads=1):
+    """Create a table of read counts from the kneaddata logs
     
-    This task will run kneaddata_read_count_table on the input files provided.
+    This task will create a table of read counts from the input files provided, matching
+    the output of kneaddata_read_count_table. The logs are read in parallel and the
+    counts are cached so only new (or changed) logs are read on reruns.
     
     Args:
         workflow (anadama2.workflow): An instance of the workflow class.
@@ -169,10 +191,7 @@ def kneaddata_read_count_table(workflow, input_files, output_folder):
             All input files are expected to be in the same folder and all should
             have the log extension. 
         output_folder (string): The path of the output folder.
-        
-    Requires:
-        kneaddata v0.6.1+: A tool to perform quality control on metagenomic and
-            metatranscriptomic sequencing data
+        threads (int): The number of processes to read the log files.
         
     Returns:
         string: The path to the read count table written.
@@ -199,10 +218,10 @@ def kneaddata_read_count_table(workflow, input_files, output_folder):
     kneaddata_read_count_file = files.ShotGun.path("kneaddata_read_counts",output_folder,create_folder=True)
     
     # add the task (which is not gridable as this task should take under 5 minutes)
-    workflow.add_task("kneaddata_read_count_table --input [args[0]] --output [targets[0]]",
+    workflow.add_task("get_counts_from_kneaddata_logs.py --input [args[0]] --output [targets[0]] --threads [args[1]]",
         depends=input_files,
         targets=kneaddata_read_count_file,
-        args=[input_folder],
+        args=[input_folder, threads],
         name="kneaddata_read_count_table")
     
     return kneaddata_read_count_file
@@ -270,12 +289,244 @@ def quality_control(workflow, input_files, extension, output_folder, threads, da
         remove_intermediate_output)
     
     # create the read count table
-    kneaddata_read_count_file=kneaddata_read_count_table(workflow, kneaddata_output_logs, output_folder)
+    kneaddata_read_count_file=kneaddata_read_count_table(workflow, kneaddata_output_logs, output_folder, threads)
     
     return kneaddata_output_fastq, kneaddata_read_count_file
 
 
-def taxonomic_profile(workflow,input_files,output_folder,threads,input_extension,already_profiled=False):
+def sample_pipeline(workflow, input_files, extension, output_folder, threads, max_samples, databases=None,
+    pair_identifier=None, qc_options=None, taxonomic_profiling=True, functional_profiling=True, functional_options=None,
+    compress_sam=False):
+    """Quality control, taxonomic and functional profiling as a chain of tasks per sample
+    
+    This set of tasks runs kneaddata, metaphlan2 and humann2 for each sample with
+    the tasks added one sample at a time. Of the samples still to be profiled,
+    kneaddata for a sample will not start until the final task for the sample 
+    max_samples before it has finished. This limits the number of samples in progress
+    (and the intermediate files on disk, which are removed as each sample finishes) at
+    once while letting each sample finish as soon as possible. The order is set with
+    task dependencies which would rerun the kneaddata task if the task it waits for
+    is rerun, so only kneaddata tasks without outputs (which will run anyway) wait. The
+    merged tables are created afterwards with taxonomic_profile and functional_profile
+    with the already_profiled option set.
+    
+    Args:
+        workflow (anadama2.workflow): An instance of the workflow class.
+        input_files (list): A list of paths to fastq files for input to kneaddata.
+        extension (string): The extension for all files.
+        output_folder (string): The path of the output folder.
+        threads (int): The number of threads/cores for each task to use.
+        max_samples (int): The max number of samples in progress at once.
+        databases (string/list): The databases to use with kneaddata (optional).
+        pair_identifier (string): The string in the file basename to identify
+            the first pair in the set (optional).
+        qc_options (string): Additional options when running kneaddata (optional).
+        taxonomic_profiling (bool): Run metaphlan2 for each sample.
+        functional_profiling (bool): Run humann2 for each sample.
+        functional_options (string): Additional options when running humann2 (optional).
+        compress_sam (bool): Write the metaphlan2 sam files compressed and indexed by marker.
+        
+    Requires:
+        kneaddata v0.6.1+: A tool to perform quality control on metagenomic and
+            metatranscriptomic sequencing data
+        metaphlan2 v2.5.0+: A tool to profile the composition of microbial communities.
+        humann2 v0.9.6+: A tool for functional profiling.
+        
+    Returns:
+        list: A list of the filtered fastq files created by kneaddata.
+        string: The path to the read count table written.
+        list: A list of the taxonomic profiles, one per sample.
+        list: A list of the sam files generated by metaphlan2.
+    """
+    
+    # check for paired input files
+    if pair_identifier:
+        input_pair1, input_pair2 = utilities.paired_files(input_files, extension, pair_identifier)
+    else:
+        input_pair1 = []
+        
+    paired = bool(input_pair1)
+    if paired:
+        sample_inputs = [[[pair1],[pair2]] for pair1, pair2 in zip(input_pair1, input_pair2)]
+    else:
+        sample_inputs = [[file] for file in input_files]
+        
+    # the kneaddata output files will not be compressed
+    qc_extension = extension.replace(".gz","").replace(".bz2","")
+    
+    # the tasks that create each target (for the final tasks of the samples)
+    target_tasks = {}
+    
+    qc_output_files, qc_logs, taxonomic_profiles, sam_files, final_tasks = [], [], [], [], []
+    for sample_input in sample_inputs:
+        # wait for the sample max_samples before this one (of those still to be profiled) to finish,
+        # only if kneaddata has not been run for this sample so waiting does not cause a rerun
+        sample_name = utilities.sample_names(sample_input[0], extension, pair_identifier)[0] if paired else utilities.sample_names(sample_input, extension)[0]
+        qc_done = os.path.isfile(utilities.name_files(sample_name, output_folder, subfolder=os.path.join("kneaddata","main"), extension="fastq"))
+        wait_for = [final_tasks[-max_samples]] if len(final_tasks) >= max_samples and not qc_done else []
+        
+        first_task = len(workflow.tasks)
+        sample_fastq, sample_logs = kneaddata(workflow, sample_input, extension, output_folder, threads,
+            paired, databases, pair_identifier, qc_options, True, wait_for=wait_for)
+        sample_outputs = sample_fastq
+        
+        sample_profiles = None
+        if taxonomic_profiling:
+            sample_profiles, sample_sams = metaphlan2(workflow, sample_fastq, output_folder, threads, qc_extension, compress_sam)
+            taxonomic_profiles+=sample_profiles
+            sam_files+=sample_sams
+            sample_outputs = sample_profiles
+            
+        if functional_profiling:
+            sample_outputs = humann2(workflow, sample_fastq, qc_extension, output_folder, threads,
+                sample_profiles, True, functional_options)[0]
+        
+        for task in workflow.tasks[first_task:]:
+            for target in task.targets:
+                target_tasks[target.name] = task
+        
+        qc_output_files+=sample_fastq
+        qc_logs+=sample_logs
+        # samples already profiled are not included in the order (their tasks will be skipped)
+        if not all(os.path.isfile(file) for file in sample_outputs):
+            final_tasks.append(target_tasks[os.path.abspath(sample_outputs[0])])
+        
+    # create the read count table
+    kneaddata_read_count_file=kneaddata_read_count_table(workflow, qc_logs, output_folder, threads)
+    
+    return qc_output_files, kneaddata_read_count_file, taxonomic_profiles, sam_files
+
+def incremental_store(merged_file):
+    """ Get the folder for the column-chunked store for the merged table """
+    
+    return os.path.join(os.path.dirname(merged_file),"chunks",os.path.basename(merged_file).replace(".tsv",""))
+
+def incremental_join_tables(task):
+    """Join tables adding only new (or changed) tables to the column-chunked store
+    
+    Args:
+        task (anadama2.task): An instance of the task class. The depends are the
+            tables to join and the target is the merged table.
+    """
+    
+    from biobakery_workflows import tables
+    
+    store=incremental_store(task.targets[0].name)
+    tables.update_store(store, [depend.name for depend in task.depends])
+    tables.materialize_store(store, task.targets[0].name)
+
+def incremental_count_features(task, **keywords):
+    """Count the features for each sample in a merged table, only counting the new columns
+    
+    Args:
+        task (anadama2.task): An instance of the task class. The depend is a
+            merged table written by incremental_join_tables and the target
+            is the counts file.
+        keywords: The options for the features to count (see tables.count_store_features)
+    """
+    
+    from biobakery_workflows import tables
+    
+    tables.count_store_features(incremental_store(task.depends[0].name), task.targets[0].name, **keywords)
+
+def add_join_task(workflow, depends, target, name, file_name=None, incremental=False):
+    """Add a task to join tables
+    
+    Args:
+        workflow (anadama2.workflow): An instance of the workflow class.
+        depends (list): The tables to join (all in the same folder).
+        target (string): The merged table to write.
+        name (string): The name of the task.
+        file_name (string): Only join tables in the folder with this string in the name (optional).
+        incremental (bool): Only join new tables using a column-chunked store.
+    """
+    
+    if incremental:
+        workflow.add_task(
+            incremental_join_tables,
+            depends=depends,
+            targets=target,
+            name=name)
+    else:
+        workflow.add_task(
+            "humann2_join_tables --input [args[0]] --output [targets[0]]"+(" --file_name [args[1]]" if file_name else ""),
+            depends=depends,
+            targets=target,
+            args=[os.path.dirname(depends[0]), file_name],
+            name=name)
+
+def humann2_mapping_file(groups):
+    """Get the humann2 utility mapping file for the groups (ie uniref90_level4ec)
+    
+    Args:
+        groups (string): The groups option for humann2_regroup_table.
+        
+    Requires:
+        humann2 v0.9.6+: The utility mapping database location is read from the config.
+    """
+    
+    try:
+        from humann2 import config
+    except ImportError:
+        sys.exit("ERROR: Unable to import humann2 to find the utility mapping database")
+    
+    features, group = groups.split("_",1)
+    mapping_file=os.path.join(config.utility_mapping_database,"map_"+group+"_"+features+".txt.gz")
+    if not os.path.isfile(mapping_file):
+        sys.exit("ERROR: Unable to find the humann2 utility mapping file: " + mapping_file)
+    return mapping_file
+
+def group_index(task):
+    """Convert the humann2 utility mapping file for the groups to an index
+    
+    If an index newer than the mapping file is in the database folder it is
+    linked instead of rebuilt. Otherwise the new index is also added to the
+    database folder (if writeable) for later runs.
+    
+    Args:
+        task (anadama2.task): An instance of the task class. The depend is the
+            mapping file (see humann2_mapping_file) and the target is the index.
+    """
+    
+    from biobakery_workflows import tables
+    
+    mapping_file=task.depends[0].name
+    database_index=mapping_file.replace(".txt.gz","")+GROUP_INDEX_EXTENSION
+    if os.path.isfile(database_index) and os.path.getmtime(database_index) >= os.path.getmtime(mapping_file):
+        utilities.link_file(database_index, task.targets[0].name)
+    else:
+        tables.write_group_index(mapping_file, task.targets[0].name)
+        try:
+            utilities.link_file(task.targets[0].name, database_index)
+        except EnvironmentError:
+            pass
+
+def renorm_join_tables(task, incremental=False):
+    """Normalize tables to relative abundance and join the original and normalized tables in-process
+    
+    Args:
+        task (anadama2.task): An instance of the task class. The depends are the
+            tables. The targets are the merged table, the merged normalized
+            table, and then the normalized tables (one per depend).
+        incremental (bool): Only normalize and join new (or changed) tables using column-chunked stores.
+    """
+    
+    from biobakery_workflows import tables
+    
+    input_tables=[depend.name for depend in task.depends]
+    relab_tables=[target.name for target in task.targets[2:]]
+    if incremental:
+        for table, relab_table in zip(input_tables, relab_tables):
+            if not os.path.isfile(relab_table) or os.path.getmtime(relab_table) < os.path.getmtime(table):
+                tables.renorm_table(table, relab_table)
+        for merged_table, store_tables in zip(task.targets[:2], [input_tables, relab_tables]):
+            store=incremental_store(merged_table.name)
+            tables.update_store(store, store_tables)
+            tables.materialize_store(store, merged_table.name)
+    else:
+        tables.renorm_join_tables(input_tables, relab_tables, task.targets[0].name, task.targets[1].name)
+
+def taxonomic_profile(workflow,input_files,output_folder,threads,input_extension,already_profiled=False,incremental=False,compress_sam=False):
     """Taxonomic profile for whole genome shotgun sequences
     
     This set of tasks performs taxonomic profiling on whole genome shotgun
@@ -290,6 +541,9 @@ def taxonomic_profile(workflow,input_files,output_folder,threads,input_extension
         input_extension (string): The extension for the input files.
         already_profiled (bool): Indicates if the input files need to be run through metaphlan2.
             If not, just join profiles and count species.
+        incremental (bool): Keep the merged profiles in a column-chunked store so
+            only new samples are joined and counted.
+        compress_sam (bool): Write the sam files compressed and indexed by marker.
         
     Requires:
         metaphlan2 v2.5.0+: A tool to profile the composition of microbial communities.
@@ -322,62 +576,116 @@ def taxonomic_profile(workflow,input_files,output_folder,threads,input_extension
         * Add option to provide paired input files which are merged then run.
     """
     
-    # get the sample names from the input files
-    sample_names=utilities.sample_names(input_files,input_extension)
-    
-    # get a list of metaphlan2 output files, one for each input file
-    metaphlan2_profile_tag="taxonomic_profile"
-    main_folder=os.path.join("metaphlan2","main")
-    metaphlan2_output_files_profile = utilities.name_files(sample_names, output_folder, subfolder=main_folder, tag=metaphlan2_profile_tag, extension="tsv", create_folder=True)
-    metaphlan2_output_files_sam = utilities.name_files(sample_names, output_folder, subfolder=main_folder, tag="bowtie2", extension="sam")
-    metaphlan2_output_folder = os.path.dirname(metaphlan2_output_files_profile[0])
-    
-    # determine the input file type based on the extension
-    if input_extension in ["fasta","fasta.gz","fa","fa.gz"]:
-        input_type="fasta"
-    else:
-        input_type="fastq"
-    
     # run metaphlan2 on each of the kneaddata output files
+    metaphlan2_profile_tag="taxonomic_profile"
     if not already_profiled:
-        for sample, depend_fastq, target_profile, target_sam in zip(sample_names, input_files, metaphlan2_output_files_profile, metaphlan2_output_files_sam):
-            workflow.add_task_gridable(
-                "metaphlan2.py [depends[0]] --input_type [args[2]] --output_file [targets[0]] --samout [targets[1]] --nproc [args[0]] --no_map --tmp_dir [args[1]]",
-                depends=[depend_fastq,TrackedExecutable("metaphlan2.py")],
-                targets=[target_profile,target_sam],
-                args=[threads,metaphlan2_output_folder,input_type],
-                time="2*4*60 if file_size('[depends[0]]') < 25 else 5*3*60", # 3 hours or more depending on input file size
-                mem="12*1024 if file_size('[depends[0]]') < 25 else 4*12*1024", # 12 GB or more depending on input file size
-                cores=threads, # time/mem based on 8 cores
-                name=utilities.name_task(sample,"metaphlan2"))
+        metaphlan2_output_files_profile, metaphlan2_output_files_sam = metaphlan2(workflow,
+            input_files,output_folder,threads,input_extension,compress_sam)
     else:
         # set the names of the already profiled outputs
+        sample_names=utilities.sample_names(input_files,input_extension)
         metaphlan2_output_files_profile = input_files
-        metaphlan2_output_folder = os.path.dirname(input_files[0])
+        metaphlan2_output_files_sam = metaphlan2_sam_files(sample_names, output_folder, compress_sam)
     
     # merge all of the metaphlan taxonomy tables
     metaphlan2_merged_output = files.ShotGun.path("taxonomic_profile", output_folder)
     
     # run the humann2 join script to merge all of the metaphlan2 profiles
-    workflow.add_task(
-        "humann2_join_tables --input [args[0]] --output [targets[0]] --file_name [args[1]]",
-        depends=metaphlan2_output_files_profile,
-        targets=metaphlan2_merged_output,
-        args=[metaphlan2_output_folder, metaphlan2_profile_tag],
-        name="metaphlan2_join_taxonomic_profiles")
+    add_join_task(workflow, metaphlan2_output_files_profile, metaphlan2_merged_output,
+        "metaphlan2_join_taxonomic_profiles", metaphlan2_profile_tag, incremental)
    
     # get the name for the file to write the species counts
     metaphlan2_species_counts_file = files.ShotGun.path("species_counts",output_folder,create_folder=True)
 
     # create a file of species counts
-    workflow.add_task(
-    "count_features.py --input [depends[0]] --output [targets[0]] --include s__ --filter t__ --reduce-sample-name",
-    depends=metaphlan2_merged_output,
-    targets=metaphlan2_species_counts_file,
-    name="metaphlan2_count_species") 
+    if incremental:
+        workflow.add_task(
+            utilities.partial_function(incremental_count_features, include="s__", filter="t__", reduce_sample_names=True),
+            depends=metaphlan2_merged_output,
+            targets=metaphlan2_species_counts_file,
+            name="metaphlan2_count_species")
+    else:
+        workflow.add_task(
+        "count_features.py --input [depends[0]] --output [targets[0]] --include s__ --filter t__ --reduce-sample-name",
+        depends=metaphlan2_merged_output,
+        targets=metaphlan2_species_counts_file,
+        name="metaphlan2_count_species") 
 
     return metaphlan2_merged_output, metaphlan2_output_files_profile, metaphlan2_output_files_sam
 
+def metaphlan2_sam_files(sample_names, output_folder, compress_sam=False):
+    """Get the names of the metaphlan2 sam files, one per sample
+    
+    Args:
+        sample_names (list): The names of the samples.
+        output_folder (string): The path of the output folder.
+        compress_sam (bool): The sam files are compressed and indexed by marker.
+    """
+    
+    sam_files=utilities.name_files(sample_names, output_folder, subfolder=os.path.join("metaphlan2","main"), tag="bowtie2", extension="sam")
+    if compress_sam:
+        sam_files=[file+COMPRESSED_SAM_EXTENSION for file in sam_files]
+    return sam_files
+
+def plain_sam_file(sam_file):
+    """Get the name of the uncompressed sam file for a (possibly compressed) sam file"""
+    
+    if sam_file.endswith(COMPRESSED_SAM_EXTENSION):
+        return sam_file[:-len(COMPRESSED_SAM_EXTENSION)]
+    return sam_file
+
+def metaphlan2(workflow,input_files,output_folder,threads,input_extension,compress_sam=False):
+    """Run metaphlan2 on each of the input files
+    
+    Args:
+        workflow (anadama2.workflow): An instance of the workflow class.
+        input_files (list): A list of paths to fastq files already run through quality control.
+        output_folder (string): The path of the output folder.
+        threads (int): The number of threads/cores for metaphlan2 to use.
+        input_extension (string): The extension for the input files.
+        compress_sam (bool): Compress the sam files into blocks sorted by marker
+            with an index so subsets of markers can be read without a full scan.
+        
+    Requires:
+        metaphlan2 v2.5.0+: A tool to profile the composition of microbial communities.
+        
+    Returns:
+        list: A list of the taxonomic profiles, one per sample.
+        list: A list of the sam files generated by metaphlan2.
+    """
+    
+    # get the sample names from the input files
+    sample_names=utilities.sample_names(input_files,input_extension)
+    
+    # get a list of metaphlan2 output files, one for each input file
+    main_folder=os.path.join("metaphlan2","main")
+    metaphlan2_output_files_profile = utilities.name_files(sample_names, output_folder, subfolder=main_folder, tag="taxonomic_profile", extension="tsv", create_folder=True)
+    metaphlan2_output_files_sam = metaphlan2_sam_files(sample_names, output_folder, compress_sam)
+    metaphlan2_output_folder = os.path.dirname(metaphlan2_output_files_profile[0])
+    
+    # determine the input file type based on the extension
+    if input_extension in ["fasta","fasta.gz","fa","fa.gz"]:
+        input_type="fasta"
+    else:
+        input_type="fastq"
+    
+    command="metaphlan2.py [depends[0]] --input_type [args[2]] --output_file [targets[0]] --samout [args[3]] --nproc [args[0]] --no_map --tmp_dir [args[1]]"
+    if compress_sam:
+        command+=" && compress_sam.py --input [args[3]] --output [targets[1]] --remove-input"
+    
+    for sample, depend_fastq, target_profile, target_sam in zip(sample_names, input_files, metaphlan2_output_files_profile, metaphlan2_output_files_sam):
+        workflow.add_task_gridable(
+            command,
+            depends=[depend_fastq,TrackedExecutable("metaphlan2.py")],
+            targets=[target_profile,target_sam]+([alignments.index_file(target_sam)] if compress_sam else []),
+            args=[threads,metaphlan2_output_folder,input_type,plain_sam_file(target_sam)],
+            time="2*4*60 if file_size('[depends[0]]') < 25 else 5*3*60", # 3 hours or more depending on input file size
+            mem="12*1024 if file_size('[depends[0]]') < 25 else 4*12*1024", # 12 GB or more depending on input file size
+            cores=threads, # time/mem based on 8 cores
+            name=utilities.name_task(sample,"metaphlan2"))
+            
+    return metaphlan2_output_files_profile, metaphlan2_output_files_sam
+
 def merge_pairs(workflow,input_files,extension,pair_identifier,output_folder):
     """ Merge the paired files into a single file 
     
@@ -424,55 +732,34 @@ def merge_pairs(workflow,input_files,extension,pair_identifier,output_folder):
     return merged_files, output_extension
           
 
-def functional_profile(workflow,input_files,extension,output_folder,threads,taxonomic_profiles=None, remove_intermediate_output=None,
-    options=None):
-    """Functional profile for whole genome shotgun sequences
-    
-    This set of tasks performs functional profiling on whole genome shotgun
-    input files. For paired-end files, first merge and provide a single file per sample.
-    Input files should first be run through quality control. Optionally the taxonomic
-    profiles can be provided for the samples.
+def humann2(workflow,input_files,extension,output_folder,threads,taxonomic_profiles=None,remove_intermediate_output=None,
+    options=None,already_profiled=False):
+    """Run humann2 on each of the input files
     
     Args:
         workflow (anadama2.workflow): An instance of the workflow class.
         input_files (list): A list of paths to fastq (or fasta) files already run through quality control.
         extension (string): The extension for all files.
         output_folder (string): The path of the output folder.
-        threads (int): The number of threads/cores for kneaddata to use.
+        threads (int): The number of threads/cores for humann2 to use.
         taxonomic_profiles (list): A set of taxonomic profiles, one per sample (optional).
         remove_intermediate_output (bool): Remove intermediate output files.
+        options (string): Additional options when running humann2 (optional).
+        already_profiled (bool): Only return the output file names as the humann2
+            tasks have already been added.
         
     Requires:
         humann2 v0.9.6+: A tool for functional profiling.
         
     Returns:
-        string: A file of the merged gene families (relative abundance) for all samples.
-        string: A file of the merged ecs (relative abundance) for all samples.
-        string: A file of the merged pathway abundances (relative abundance) for all samples.
-        
-    Example:
-        from anadama2 import Workflow
-        from biobakery_workflows.tasks import shotgun
-        
-        # create an anadama2 workflow instance
-        workflow=Workflow()
-        
-        # add quality control tasks for the fastq files
-        filtered_fastq = shotgun.quality_control(workflow,
-            ["demo.fastq","demo2.fastq"], 1)
-        
-        # run functional profiling
-        genefamilies_file, ecs_file, pathabundance_file = shotgun.functional_profile(
-            workflow, filtered_fastq, 1) 
-            
-        # run the workflow
-        workflow.go()
+        list: A list of the gene families files, one per sample.
+        list: A list of the pathway abundance files, one per sample.
+        list: A list of the pathway coverage files, one per sample.
+        list: A list of the log files, one per sample.
     """
     
     # get the sample names from the input files
     sample_names=utilities.sample_names(input_files,extension)
-    
-    ### Step 1: Run humann2 on all input files ###
 
     # get a list of output files, one for each input file, with the humann2 output file names
     main_folder=os.path.join("humann2","main")
@@ -482,8 +769,9 @@ def functional_profile(workflow,input_files,extension,output_folder,threads,taxo
 
     # get the list of the log files that will be created, one for each input file, set to the same folder as the main output files
     log_files = utilities.name_files(sample_names, output_folder, subfolder=main_folder, extension="log")
-    # get the name for the file of read and species counts created from the humann2 log outputs
-    log_counts = files.ShotGun.path("humann2_read_counts",output_folder,create_folder=True)
+
+    if already_profiled:
+        return genefamiles, pathabundance, pathcoverage, log_files
 
     humann2_output_folder = os.path.dirname(genefamiles[0])
     
@@ -514,12 +802,78 @@ def functional_profile(workflow,input_files,extension,output_folder,threads,taxo
             cores=threads,
             name=utilities.name_task(sample,"humann2"))
 
+    return genefamiles, pathabundance, pathcoverage, log_files
+
+def functional_profile(workflow,input_files,extension,output_folder,threads,taxonomic_profiles=None, remove_intermediate_output=None,
+    options=None, already_profiled=False, incremental=False, in_process=False):
+    """Functional profile for whole genome shotgun sequences
+    
+    This set of tasks performs functional profiling on whole genome shotgun
+    input files. For paired-end files, first merge and provide a single file per sample.
+    Input files should first be run through quality control. Optionally the taxonomic
+    profiles can be provided for the samples.
+    
+    Args:
+        workflow (anadama2.workflow): An instance of the workflow class.
+        input_files (list): A list of paths to fastq (or fasta) files already run through quality control.
+        extension (string): The extension for all files.
+        output_folder (string): The path of the output folder.
+        threads (int): The number of threads/cores for kneaddata to use.
+        taxonomic_profiles (list): A set of taxonomic profiles, one per sample (optional).
+        remove_intermediate_output (bool): Remove intermediate output files.
+        options (string): Additional options when running humann2 (optional).
+        already_profiled (bool): The humann2 tasks for the input files have already been
+            added to the workflow, only add the tasks to regroup, normalize and merge.
+        incremental (bool): Keep the merged tables in column-chunked stores so
+            only new samples are joined and counted.
+        in_process (bool): Regroup, normalize and merge the tables with the tables module
+            instead of running the humann2 table tools for each file. If incremental,
+            only the new samples are normalized.
+        
+    Requires:
+        humann2 v0.9.6+: A tool for functional profiling.
+        
+    Returns:
+        string: A file of the merged gene families (relative abundance) for all samples.
+        string: A file of the merged ecs (relative abundance) for all samples.
+        string: A file of the merged pathway abundances (relative abundance) for all samples.
+        
+    Example:
+        from anadama2 import Workflow
+        from biobakery_workflows.tasks import shotgun
+        
+        # create an anadama2 workflow instance
+        workflow=Workflow()
+        
+        # add quality control tasks for the fastq files
+        filtered_fastq = shotgun.quality_control(workflow,
+            ["demo.fastq","demo2.fastq"], 1)
+        
+        # run functional profiling
+        genefamilies_file, ecs_file, pathabundance_file = shotgun.functional_profile(
+            workflow, filtered_fastq, 1) 
+            
+        # run the workflow
+        workflow.go()
+    """
+    
+    # get the sample names from the input files
+    sample_names=utilities.sample_names(input_files,extension)
+    
+    ### Step 1: Run humann2 on all input files ###
+    genefamiles, pathabundance, pathcoverage, log_files = humann2(workflow,input_files,extension,output_folder,
+        threads,taxonomic_profiles,remove_intermediate_output,options,already_profiled)
+    humann2_output_folder = os.path.dirname(genefamiles[0])
+
+    # get the name for the file of read and species counts created from the humann2 log outputs
+    log_counts = files.ShotGun.path("humann2_read_counts",output_folder,create_folder=True)
+
     # create a task to get the read and species counts for each humann2 run from the log files
     workflow.add_task(
-        "get_counts_from_humann2_logs.py --input [args[0]] --output [targets[0]]",
+        "get_counts_from_humann2_logs.py --input [args[0]] --output [targets[0]] --threads [args[1]]",
         depends=log_files,
         targets=log_counts,
-        args=humann2_output_folder,
+        args=[humann2_output_folder, threads],
         name="humann2_count_alignments_species")
     
     ### STEP #2: Regroup UniRef90 gene families to ecs ###
@@ -530,14 +884,32 @@ def functional_profile(workflow,input_files,extension,output_folder,threads,taxo
         extension="tsv", create_folder=True)
     
     # get ec files for all of the gene families files
-    workflow.add_task_group_gridable(
-        "humann2_regroup_table --input [depends[0]] --output [targets[0]] --groups uniref90_level4ec",
-        depends=genefamiles,
-        targets=ec_files,
-        time=10, # 10 minutes
-        mem=5*1024, # 5 GB
-        cores=1,
-        name=map(lambda sample: utilities.name_task(sample,"humann2_regroup_UniRef2EC"), sample_names))
+    if in_process:
+        # convert the mapping to an index once, then regroup each file with a lookup pass
+        ec_index=os.path.join(output_folder,"humann2","uniref90_level4ec"+GROUP_INDEX_EXTENSION)
+        workflow.add_task(
+            group_index,
+            depends=[humann2_mapping_file("uniref90_level4ec"),TrackedExecutable("humann2")],
+            targets=ec_index,
+            name="humann2_index_UniRef2EC")
+        
+        workflow.add_task_group_gridable(
+            "regroup_table.py --input [depends[0]] --index [depends[1]] --output [targets[0]]",
+            depends=[[genefamilies_file, ec_index] for genefamilies_file in genefamiles],
+            targets=ec_files,
+            time=10, # 10 minutes
+            mem=5*1024, # 5 GB
+            cores=1,
+            name=map(lambda sample: utilities.name_task(sample,"humann2_regroup_UniRef2EC"), sample_names))
+    else:
+        workflow.add_task_group_gridable(
+            "humann2_regroup_table --input [depends[0]] --output [targets[0]] --groups uniref90_level4ec",
+            depends=genefamiles,
+            targets=ec_files,
+            time=10, # 10 minutes
+            mem=5*1024, # 5 GB
+            cores=1,
+            name=map(lambda sample: utilities.name_task(sample,"humann2_regroup_UniRef2EC"), sample_names))
 
     
     ### STEP #3: Merge gene families, ecs, and pathway abundance files
@@ -547,66 +919,76 @@ def functional_profile(workflow,input_files,extension,output_folder,threads,taxo
     merged_ecs = files.ShotGun.path("ecs", output_folder)
     merged_pathabundance = files.ShotGun.path("pathabundance", output_folder)
     
-    # merge the ec, gene families, and pathway abundance files
-    all_depends=[genefamiles, ec_files, pathabundance]
-    all_targets=[merged_genefamilies, merged_ecs, merged_pathabundance]
-    file_basenames=["genefamilies","ecs","pathabundance"]
-    for depends, targets, basename in zip(all_depends, all_targets, file_basenames):
-        workflow.add_task(
-            "humann2_join_tables --input [args[0]] --output [targets[0]] --file_name [args[1]]",
-            depends=depends,
-            targets=targets,
-            args=[os.path.dirname(depends[0]),basename],
-            name="humann2_join_tables_"+basename)
-    
-    ### STEP #4: Normalize gene families, ecs, and pathway abundance to relative abundance (then merge files) ###
-    
     # get a list of files for normalized ec, gene families, and pathway abundance
     relab_folder=os.path.join("humann2","relab")
     norm_genefamily_files = utilities.name_files(genefamiles, output_folder, subfolder=os.path.join(relab_folder,"genes"), tag="relab", create_folder=True)
     norm_ec_files = utilities.name_files(ec_files, output_folder,  subfolder=os.path.join(relab_folder,"ecs"), tag="relab", create_folder=True)
     norm_pathabundance_files = utilities.name_files(pathabundance, output_folder,  subfolder=os.path.join(relab_folder,"pathways"), tag="relab", create_folder=True)
     
-    # normalize the genefamily, ec, and pathabundance files
-    # do not include special features (ie UNMAPPED, UNINTEGRATED, UNGROUPED) in norm computation
-    renorm_task_names=len(norm_genefamily_files)*["genes"] + len(norm_ec_files)*["ecs"] + len(norm_pathabundance_files)*["pathways"]
-    renorm_task_names=[utilities.name_task(sample,"humann2_renorm_"+type+"_relab") for sample, type in zip(itertools.cycle(sample_names),renorm_task_names)]
-    workflow.add_task_group_gridable(
-        "humann2_renorm_table --input [depends[0]] --output [targets[0]] --units relab --special n",
-        depends=genefamiles + ec_files + pathabundance,
-        targets=norm_genefamily_files + norm_ec_files + norm_pathabundance_files,
-        time=15, # 15 minutes
-        mem=5*1024, # 5 GB
-        cores=1,
-        name=renorm_task_names)
-
-    
     # get a list of merged files for ec, gene families, and pathway abundance
     merged_genefamilies_relab = files.ShotGun.path("genefamilies_relab", output_folder)
     merged_ecs_relab = files.ShotGun.path("ecs_relab", output_folder)
     merged_pathabundance_relab = files.ShotGun.path("pathabundance_relab", output_folder)
     
-    # merge the ec, gene families, and pathway abundance files
-    all_depends=[norm_genefamily_files, norm_ec_files, norm_pathabundance_files]
-    all_targets=[merged_genefamilies_relab, merged_ecs_relab, merged_pathabundance_relab]
-    all_types=["genes_relab","ecs_relab","pathways_relab"]
-    for depends, targets, input_type in zip(all_depends, all_targets, all_types):
-        workflow.add_task(
-            "humann2_join_tables --input [args[0]] --output [targets[0]]",
-            depends=depends,
-            targets=targets,
-            args=[os.path.dirname(depends[0])],
-            name="humann2_join_tables_"+input_type)
+    if in_process:
+        ### STEP #4: Normalize and merge each type of file in a single task, reading each file once ###
+        all_depends=[genefamiles, ec_files, pathabundance]
+        all_targets=[[merged_genefamilies, merged_genefamilies_relab] + norm_genefamily_files,
+            [merged_ecs, merged_ecs_relab] + norm_ec_files,
+            [merged_pathabundance, merged_pathabundance_relab] + norm_pathabundance_files]
+        all_types=["genes","ecs","pathways"]
+        for depends, targets, input_type in zip(all_depends, all_targets, all_types):
+            workflow.add_task(
+                utilities.partial_function(renorm_join_tables, incremental=incremental),
+                depends=depends,
+                targets=targets,
+                name="humann2_renorm_join_tables_"+input_type)
+    else:
+        # merge the ec, gene families, and pathway abundance files
+        all_depends=[genefamiles, ec_files, pathabundance]
+        all_targets=[merged_genefamilies, merged_ecs, merged_pathabundance]
+        file_basenames=["genefamilies","ecs","pathabundance"]
+        for depends, targets, basename in zip(all_depends, all_targets, file_basenames):
+            add_join_task(workflow, depends, targets, "humann2_join_tables_"+basename, basename, incremental)
+        
+        ### STEP #4: Normalize gene families, ecs, and pathway abundance to relative abundance (then merge files) ###
+        
+        # normalize the genefamily, ec, and pathabundance files
+        # do not include special features (ie UNMAPPED, UNINTEGRATED, UNGROUPED) in norm computation
+        renorm_task_names=len(norm_genefamily_files)*["genes"] + len(norm_ec_files)*["ecs"] + len(norm_pathabundance_files)*["pathways"]
+        renorm_task_names=[utilities.name_task(sample,"humann2_renorm_"+type+"_relab") for sample, type in zip(itertools.cycle(sample_names),renorm_task_names)]
+        workflow.add_task_group_gridable(
+            "humann2_renorm_table --input [depends[0]] --output [targets[0]] --units relab --special n",
+            depends=genefamiles + ec_files + pathabundance,
+            targets=norm_genefamily_files + norm_ec_files + norm_pathabundance_files,
+            time=15, # 15 minutes
+            mem=5*1024, # 5 GB
+            cores=1,
+            name=renorm_task_names)
+        
+        # merge the ec, gene families, and pathway abundance files
+        all_depends=[norm_genefamily_files, norm_ec_files, norm_pathabundance_files]
+        all_targets=[merged_genefamilies_relab, merged_ecs_relab, merged_pathabundance_relab]
+        all_types=["genes_relab","ecs_relab","pathways_relab"]
+        for depends, targets, input_type in zip(all_depends, all_targets, all_types):
+            add_join_task(workflow, depends, targets, "humann2_join_tables_"+input_type, incremental=incremental)
 
     # get feature counts for the ec, gene families, and pathways
     genefamilies_counts = files.ShotGun.path("genefamilies_relab_counts", output_folder)
     ecs_counts = files.ShotGun.path("ecs_relab_counts", output_folder)
     pathabundance_counts = files.ShotGun.path("pathabundance_relab_counts", output_folder)
-    workflow.add_task_group(
-        "count_features.py --input [depends[0]] --output [targets[0]] --reduce-sample-name --ignore-un-features --ignore-stratification",
-        depends=[merged_genefamilies_relab, merged_ecs_relab, merged_pathabundance_relab],
-        targets=[genefamilies_counts, ecs_counts, pathabundance_counts],
-        name=["humann2_count_features_genes","humann2_count_features_ecs","humann2_count_features_pathways"])
+    if incremental:
+        workflow.add_task_group(
+            utilities.partial_function(incremental_count_features, reduce_sample_names=True, ignore_un_features=True, ignore_stratification=True),
+            depends=[merged_genefamilies_relab, merged_ecs_relab, merged_pathabundance_relab],
+            targets=[genefamilies_counts, ecs_counts, pathabundance_counts],
+            name=["humann2_count_features_genes","humann2_count_features_ecs","humann2_count_features_pathways"])
+    else:
+        workflow.add_task_group(
+            "count_features.py --input [depends[0]] --output [targets[0]] --reduce-sample-name --ignore-un-features --ignore-stratification",
+            depends=[merged_genefamilies_relab, merged_ecs_relab, merged_pathabundance_relab],
+            targets=[genefamilies_counts, ecs_counts, pathabundance_counts],
+            name=["humann2_count_features_genes","humann2_count_features_ecs","humann2_count_features_pathways"])
     
     # merge the feature counts into a single file
     all_feature_counts = files.ShotGun.path("feature_counts", output_folder)
@@ -670,7 +1052,7 @@ def norm_ratio(workflow, wms_genes, wms_ecs, wms_paths, wts_genes, wts_ecs, wts_
         
     return norm_ratio_genes, norm_ratio_ecs, norm_ratio_pathway
 
-def strainphlan(task,threads,clade_number,clade_list,reference_folder,marker_folder,options):
+def strainphlan(task,threads,clade_number,clade_list,reference_folder,clade_markers,options):
     """ Run strainphlan for the specific clade
     
     Args:
@@ -679,7 +1061,7 @@ def strainphlan(task,threads,clade_number,clade_list,reference_folder,marker_fol
         clade_number: (int): The number of clade to run.
         clade_list: (string): The path to the clade list.
         reference_folder (string): The folder containing the reference files.
-        marker_folder (string): The folder containing the marker files.
+        clade_markers (string): The file of the marker file for each clade.
         options (string): Options to apply when running strainphlan.
 
     Requires:
@@ -688,38 +1070,18 @@ def strainphlan(task,threads,clade_number,clade_list,reference_folder,marker_fol
     """        
     
     # find the name of the clade in the list
-    with open(clade_list) as file_handle:
-        clades=[line.strip().split(" ")[0] for line in filter(lambda line: line.startswith("s__") or line.startswith("g__"), file_handle.readlines())]
-        try:
-            profile_clade=clades[clade_number]
-        except IndexError:
-            profile_clade=None
+    clades=read_clade_list(clade_list)
+    try:
+        profile_clade=clades[clade_number]
+    except IndexError:
+        profile_clade=None
             
     if profile_clade:
         command = "strainphlan.py --ifn_samples [args[0]]/*.markers --output_dir [args[1]] "+\
             "--clades [args[2]] --nprocs_main [args[3]] --keep_alignment_files "+options
             
-        # add the marker files to the command
-        all_marker_file=os.path.join(marker_folder,"all_markers.fasta")
-        marker_file=os.path.join(marker_folder,profile_clade+".markers.fasta")
-        
-        # generate the marker file if it does not already exist
-        if not os.path.isfile(marker_file):
-            # get the pkl file relative to the strainphlan install
-            try:
-                strainphlan_pkl=os.path.join(os.path.dirname(subprocess.check_output(["which","strainphlan.py"])),"metaphlan_databases","mpa_v20_m200.pkl")
-            except subprocess.CalledProcessError:
-                raise EnvironmentError("Unable to find strainphlan install.")
-            
-            marker_command="extract_markers.py --mpa_pkl [depends[0]] "+\
-                "--ifn_markers [depends[1]] --clade [args[0]] "+\
-                "--ofn_markers [targets[0]]"
-                
-            # create the marker file in the output folder
-            marker_file=os.path.join(os.path.dirname(task.targets[0].name),profile_clade+".markers.fasta")
-                
-            return_code = utilities.run_task(marker_command,depends=[strainphlan_pkl,all_marker_file], 
-                targets=[marker_file],args=[profile_clade])
+        # get the marker file (extracted for all clades in one pass)
+        marker_file=read_clade_marker_files(clade_markers).get(profile_clade,"")
         
         # check that the marker file exists
         if not os.path.isfile(marker_file):
@@ -759,6 +1121,182 @@ def strainphlan(task,threads,clade_number,clade_list,reference_folder,marker_fol
         args=[os.path.dirname(task.depends[0].name),os.path.dirname(task.targets[0].name),profile_clade,threads])
     
 
+def read_clade_list(clade_list):
+    """ Read the clades from a list (in the same format as the strainphlan clade list) """
+    
+    with open(clade_list) as file_handle:
+        return [line.strip().split(" ")[0] for line in filter(lambda line: line.startswith("s__") or line.startswith("g__"), file_handle.readlines())]
+
+def strainphlan_database(marker_folder):
+    """ Get the MetaPhlAn2 database used by StrainPhlAn, from the markers folder
+        or relative to the strainphlan install """
+    
+    pkl_file=os.path.join(marker_folder,STRAINPHLAN_DATABASE)
+    if not os.path.isfile(pkl_file):
+        try:
+            pkl_file=os.path.join(os.path.dirname(subprocess.check_output(["which","strainphlan.py"]).decode("utf-8").strip()),"metaphlan_databases",STRAINPHLAN_DATABASE)
+        except subprocess.CalledProcessError:
+            raise EnvironmentError("Unable to find strainphlan install.")
+    
+    return pkl_file
+
+def strainphlan_marker_cache(marker_folder, output_folder):
+    """ Get the clade marker cache folder for the database (keyed on the checksum of the
+        database file), in the markers folder if it can be written to otherwise in the output folder """
+    
+    version=utilities.file_checksum(strainphlan_database(marker_folder))
+    for folder in [marker_folder, output_folder]:
+        cache_folder=os.path.join(folder,STRAINPHLAN_MARKER_CACHE,version)
+        utilities.create_folders(cache_folder)
+        if os.access(cache_folder, os.W_OK):
+            return cache_folder
+    
+    raise EnvironmentError("Unable to create the StrainPhlAn clade marker cache.")
+
+def read_clade_marker_files(clade_markers):
+    """ Read the marker file for each clade """
+    
+    marker_files={}
+    with open(clade_markers) as file_handle:
+        for line in file_handle:
+            clade, marker_file = line.rstrip("\n").split("\t")
+            marker_files[clade]=marker_file
+    return marker_files
+
+def strainphlan_extract_markers(task, clade_list, max_species, marker_folder):
+    """ Extract the markers for the clades to profile, using the clade marker cache
+    
+    Marker files provided in the markers folder are used first, then those in the
+    cache. The markers for all of the remaining clades are extracted in one pass
+    over the markers file and added to the cache.
+    
+    Args:
+        task (anadama2.task): An instance of the task class. The target is the
+            file of the marker file for each clade.
+        clade_list (string): The path to the ordered clade list.
+        max_species (int): The maximum number of clades to profile.
+        marker_folder (string): The folder containing the marker files.
+    """
+    
+    clade_markers=task.targets[0].name
+    cache_folder=strainphlan_marker_cache(marker_folder, os.path.dirname(clade_markers))
+    
+    marker_files=[]
+    extract_files={}
+    for clade in read_clade_list(clade_list)[:max_species]:
+        marker_file=os.path.join(marker_folder,clade+".markers.fasta")
+        if not os.path.isfile(marker_file):
+            marker_file=os.path.join(cache_folder,clade+".markers.fasta")
+            if not os.path.isfile(marker_file):
+                extract_files[clade]=marker_file
+        marker_files.append((clade, marker_file))
+        
+    if extract_files:
+        utilities.extract_clade_markers(strainphlan_database(marker_folder),
+            os.path.join(marker_folder,"all_markers.fasta"), extract_files)
+    
+    with open(clade_markers,"w") as file_handle:
+        for clade, marker_file in marker_files:
+            file_handle.write(clade+"\t"+marker_file+"\n")
+
+def strainphlan_clade_resources(clade, total_samples, marker_file):
+    """ Get the time (minutes) and memory (MB) to request for a strainphlan clade task
+    
+    The memory scales with the number of samples times the size of the markers
+    for the clade (the size of the marker alignments), with a minimum of 4 GB
+    and at most 50 GB. Clades past the end of the list request minimal resources.
+    
+    Args:
+        clade (string): The name of the clade (or None if there is not a clade).
+        total_samples (int): The number of samples.
+        marker_file (string): The markers for the clade.
+    """
+    
+    if not clade:
+        return STRAINPHLAN_EMPTY_CLADE_TIME, STRAINPHLAN_EMPTY_CLADE_MEMORY
+    
+    # use the size of the clade markers if they have been extracted, otherwise an estimate
+    markers_mb=os.path.getsize(marker_file)/(1024.0**2) if os.path.isfile(marker_file) else STRAINPHLAN_DEFAULT_MARKERS_MB
+    
+    memory=STRAINPHLAN_MIN_MEMORY+int(total_samples*markers_mb*STRAINPHLAN_MEMORY_PER_SAMPLE_MARKER_MB)
+    return STRAINPHLAN_CLADE_TIME, min(memory, STRAINPHLAN_MAX_MEMORY)
+
+def strainphlan_clade_plan(task, clade_list, clade_markers, total_samples):
+    """ Write the clade and resources for each strainphlan clade task
+    
+    Args:
+        task (anadama2.task): An instance of the task class. The targets are the
+            plan files, one per clade task.
+        clade_list (string): The path to the ordered clade list.
+        clade_markers (string): The file of the marker file for each clade.
+        total_samples (int): The number of samples.
+    """
+    
+    clades=read_clade_list(clade_list)
+    marker_files=read_clade_marker_files(clade_markers)
+    for clade_number, target in enumerate(task.targets):
+        clade=clades[clade_number] if clade_number < len(clades) else None
+        time, memory = strainphlan_clade_resources(clade, total_samples, marker_files.get(clade,""))
+        with open(target.name,"w") as file_handle:
+            file_handle.write("\t".join([clade or "",str(time),str(memory)])+"\n")
+
+def upstream_files(workflow, files):
+    """ Get the files (and executables) the files are created from by the tasks in the
+        workflow, following the depends of each task back to the inputs of the workflow """
+
+    tasks=dict((target.name, task) for task in workflow.tasks for target in task.targets)
+    upstream=set()
+    pending=[os.path.abspath(file) for file in files]
+    while pending:
+        file=pending.pop()
+        if file in upstream:
+            continue
+        upstream.add(file)
+        for depend in (tasks[file].depends if file in tasks else []):
+            if hasattr(depend, "task_no"):
+                pending+=[target.name for target in depend.targets if isinstance(target, TrackedFile)]
+            elif isinstance(depend, (TrackedFile, TrackedExecutable)):
+                pending.append(depend.name)
+    return sorted(upstream)
+
+def ranked_list_size(ranked_file, inputs, read, max_items, workflow=None):
+    """Get the number of tasks to add for the items in a ranked list written by a task
+    
+    If the ranked list is newer than all of the files it is created from it will not
+    change when the workflow runs, so tasks are only added for the items in the list.
+    Otherwise the list is not known until the workflow runs so tasks are added for
+    the max number of items (those past the end of the list request minimal resources).
+    
+    The count is fixed when the tasks are added, from the times the files were modified.
+    If the workflow is provided, all of the files the inputs are created from (ie the
+    profiles and the input files for each sample) are also checked so the count is the
+    max number of items if any task upstream of the list will run again because its
+    depends have changed. Tasks run again for other reasons (like a change in options)
+    are not found, so remove the ranked list to add tasks for the max number of items.
+    
+    Args:
+        ranked_file (string): The path to the ranked list.
+        inputs (list): The paths to the files the ranked list is created from.
+        read (function): The function to read the items from the ranked list.
+        max_items (int): The max number of items.
+        workflow (anadama2.workflow): The workflow with the tasks that create the inputs (optional).
+        
+    Returns:
+        int: The number of tasks to add.
+    """
+    
+    if workflow:
+        inputs=upstream_files(workflow, inputs)
+
+    try:
+        ranked_mtime=os.path.getmtime(ranked_file)
+        if all(os.path.getmtime(file) <= ranked_mtime for file in inputs):
+            return min(max_items, len(read(ranked_file)))
+    except EnvironmentError:
+        pass
+    
+    return max_items
+
 def strain_profile(workflow,sam_files,output_folder,threads,reference_folder,marker_folder,abundance_file,options="",max_species=20,strain_list="",min_depth=10):
     """Strain profile for whole genome shotgun sequences
     
@@ -768,7 +1306,8 @@ def strain_profile(workflow,sam_files,output_folder,threads,reference_folder,mar
     
     Args:
         workflow (anadama2.workflow): An instance of the workflow class.
-        sam_files (list): A list of paths to sam files generated by MetaPhlAn2.
+        sam_files (list): A list of paths to sam files generated by MetaPhlAn2 (or
+            compressed and indexed sam files).
         output_folder (string): The path of the output folder.
         threads (int): The number of threads/cores to use.
         reference_folder (string): The folder containing the reference files.
@@ -788,16 +1327,25 @@ def strain_profile(workflow,sam_files,output_folder,threads,reference_folder,mar
 
     ### STEP #1: Identify markers for each of the samples
     # name the marker files based on the sam files
-    strainphlan_markers = utilities.name_files(sam_files, output_folder, subfolder="strainphlan", extension="markers", create_folder=True)
+    strainphlan_markers = utilities.name_files(list(map(plain_sam_file,sam_files)), output_folder, subfolder="strainphlan", extension="markers", create_folder=True)
      
     # create a marker file from each sam file, require min depth
     for sam, markers in zip(sam_files, strainphlan_markers):
-        sample_name=os.path.basename(sam).replace("_bowtie2.sam","")
+        sample_name=os.path.basename(plain_sam_file(sam)).replace("_bowtie2.sam","")
+        command="sample2markers.py --ifn_samples [depends[0]] --input_type sam --output_dir [args[0]] --nprocs [args[1]] --min_read_depth [args[2]]"
+        depends=sam
+        if sam.endswith(COMPRESSED_SAM_EXTENSION):
+            # sample2markers reads uncompressed sam files (named for the sample), stream the indexed alignments
+            # to it through a named pipe that is removed when the task exits (stopping the stream if it fails)
+            command="( trap 'rm -f [args[3]]' EXIT; rm -f [args[3]] && mkfifo [args[3]] || exit 1; "+\
+                "compress_sam.py --decompress --input [depends[0]] --output /dev/stdout > [args[3]] & "+\
+                command.replace("[depends[0]]","[args[3]]")+" || { kill $! 2>/dev/null; exit 1; }; wait $! )"
+            depends=[sam,alignments.index_file(sam)]
         workflow.add_task_gridable(
-            "sample2markers.py --ifn_samples [depends[0]] --input_type sam --output_dir [args[0]] --nprocs [args[1]] --min_read_depth [args[2]]",
-            depends=sam,
+            command,
+            depends=depends,
             targets=markers,
-            args=[os.path.dirname(markers),threads,min_depth],
+            args=[os.path.dirname(markers),threads,min_depth,os.path.join(os.path.dirname(markers),os.path.basename(plain_sam_file(sam)))],
             time=3*60, # 3 hours
             mem=5*1024, # 5 GB
             cores=threads,
@@ -825,51 +1373,110 @@ def strain_profile(workflow,sam_files,output_folder,threads,reference_folder,mar
         ordered_clade_list = strain_list
     
     ### STEP #3: Run strainphlan on the top set of clades identified
-    clade_logs = utilities.name_files(map(str,range(max_species)), output_folder, tag="clade", subfolder="strainphlan", extension="log")
-    clade_tree = utilities.name_files(map(str,range(max_species)), output_folder, tag="clade", subfolder="strainphlan", extension="tree")
+    # if the list of strains is provided, only add tasks for the strains in the list
+    if strain_list and os.path.isfile(strain_list):
+        max_species=min(max_species, len(read_clade_list(strain_list)))
+    elif not strain_list:
+        # if the ordered list is up to date (ie on reruns), only add tasks for the clades in the list
+        max_species=ranked_list_size(ordered_clade_list, sam_files+strainphlan_markers+[clade_list, abundance_file],
+            read_clade_list, max_species, workflow)
+    
+    # write the clade and resources for each task once the clade list is ordered
+    clade_numbers=list(map(str,range(max_species)))
+    clade_logs = utilities.name_files(clade_numbers, output_folder, tag="clade", subfolder="strainphlan", extension="log")
+    clade_tree = utilities.name_files(clade_numbers, output_folder, tag="clade", subfolder="strainphlan", extension="tree")
+    clade_plans = utilities.name_files(clade_numbers, output_folder, tag="clade", subfolder="strainphlan", extension="plan")
+    clade_markers = utilities.name_files("clade_markers.txt", output_folder, subfolder="strainphlan")
+    if clade_plans:
+        # extract the markers for all of the clades in one pass (or reuse them from the cache)
+        workflow.add_task(
+            utilities.partial_function(strainphlan_extract_markers,clade_list=ordered_clade_list,
+                max_species=max_species,marker_folder=os.path.abspath(marker_folder)),
+            depends=[ordered_clade_list],
+            targets=clade_markers,
+            name="strainphlan_extract_markers")
+        
+        workflow.add_task(
+            utilities.partial_function(strainphlan_clade_plan,clade_list=ordered_clade_list,
+                clade_markers=clade_markers,total_samples=len(strainphlan_markers)),
+            depends=[ordered_clade_list,clade_markers],
+            targets=clade_plans,
+            name="strainphlan_clade_plan")
+    
+    # the time and memory are read from the plan when the task is submitted, so clades
+    # past the end of the list (which only create empty outputs) request minimal resources
+    plan_index=len(strainphlan_markers)+1
     for clade_number in range(max_species):
         workflow.add_task_gridable(
             utilities.partial_function(strainphlan,threads=threads,clade_number=clade_number,
-                clade_list=ordered_clade_list,reference_folder=os.path.abspath(reference_folder),marker_folder=os.path.abspath(marker_folder),
+                clade_list=ordered_clade_list,reference_folder=os.path.abspath(reference_folder),clade_markers=clade_markers,
                 options=options),
-            depends=strainphlan_markers+[ordered_clade_list],
-            targets=[clade_logs[clade_number-1],clade_tree[clade_number-1]], 
-            time=6*60, # 6 hours
-            mem=50*1024, # 50 GB
+            depends=strainphlan_markers+[ordered_clade_list,clade_plans[clade_number],clade_markers],
+            targets=[clade_logs[clade_number],clade_tree[clade_number]], 
+            time="int(open('[depends[{0}]]').read().split()[-2])".format(plan_index), # 6 hours for each clade
+            mem="int(open('[depends[{0}]]').read().split()[-1])".format(plan_index), # 4 to 50 GB depending on samples and markers
             cores=threads,
             name="strainphlan_clade_"+str(clade_number))
 
-def get_panphlan_species_name(abundance_file, species_number, panphlan_db):
-    """ Get the panphlan species name based on the abundance file """
-
-    species_ranked = utilities.rank_species_average_abundance(abundance_file)
+def panphlan_species_name(species):
+    """ Get the panphlan species name (ie s__Escherichia_coli to ecoli) """
     
-    try:
-        selected_species_info = species_ranked[species_number].split("_")
-        selected_species = selected_species_info[-2].lower()[0]+selected_species_info[-1].lower()
-    except IndexError:
-        selected_species = None
-        selected_species_with_version = None
+    species_info = species.split("_")
+    return species_info[-2].lower()[0]+species_info[-1].lower()
 
-    if selected_species:
-        # get the version number based on the files found
-        possible_dbs=[]
-        for file in os.listdir(panphlan_db):
-            if file.startswith("panphlan_"+selected_species) and file.endswith(BOWTIE2_EXTENSION):
-                possible_dbs.append(file)
-
-        if not possible_dbs:
-            raise EnvironmentError("Unable to find panphlan database "+selected_species+" in folder "+panphlan_db)
+def panphlan_databases(panphlan_db):
+    """ List the species databases in the panphlan database folder """
+    
+    return sorted(set(file.split(".")[0].replace("panphlan_","",1) for file in os.listdir(panphlan_db)
+        if file.startswith("panphlan_") and file.endswith(BOWTIE2_EXTENSION)))
 
-        selected_species_with_version = sorted(possible_dbs)[-1].split(".")[0]
+def read_panphlan_species(species_file):
+    """ Read the panphlan database for each species from the file of species (see panphlan_species) """
+    
+    with open(species_file) as file_handle:
+        return [line.rstrip("\n").split("\t")[-1] for line in file_handle if line.strip()]
 
-    return selected_species_with_version
+def panphlan_species(task, panphlan_db, max_species):
+    """ Rank the species by average abundance and write the panphlan database for
+        each of the top species, skipping those species without a database
+    
+    Args:
+        task (anadama2.task): An instance of the task class. The depends is the
+            merged abundance file and the target is the file of species.
+        panphlan_db (string): The folder containing the database files.
+        max_species (int): The maximum number of species to profile.
+    """
+    
+    # list the databases in the folder once
+    databases=panphlan_databases(panphlan_db)
+    
+    with open(task.targets[0].name,"w") as file_handle:
+        total=0
+        for species in utilities.rank_species_average_abundance(task.depends[0].name):
+            if total >= max_species:
+                break
+            # use the latest version of the database for the species
+            species_name=panphlan_species_name(species)
+            possible_dbs=[database for database in databases if database.startswith(species_name)]
+            if possible_dbs:
+                file_handle.write(species+"\t"+possible_dbs[-1]+"\n")
+                total+=1
+
+def get_panphlan_species_name(species_file, species_number):
+    """ Get the panphlan species name for the clade number from the file of species """
+
+    databases=read_panphlan_species(species_file)
+    
+    try:
+        return databases[species_number]
+    except IndexError:
+        return None
 
 def panphlan_map(task,species_number,threads,panphlan_db,output_file):
     """ Run the panphlan map step for the input file and the database selected """
 
     # get the species for this task
-    selected_species = get_panphlan_species_name(task.depends[0].name, species_number, panphlan_db)
+    selected_species = get_panphlan_species_name(task.depends[0].name, species_number)
 
     if selected_species:
         # get a single folder for this species database
@@ -889,7 +1496,7 @@ def panphlan_profile(task,species_number,panphlan_db):
     """ Run panphlan profile on the set of input files and species """
 
     # get the species for this task
-    selected_species = get_panphlan_species_name(task.depends[0].name, species_number, panphlan_db)
+    selected_species = get_panphlan_species_name(task.depends[0].name, species_number)
 
     if selected_species:
         # get a single folder for this species database
@@ -908,6 +1515,13 @@ def panphlan_profile(task,species_number,panphlan_db):
         utilities.run_task("touch [targets[0]]", targets=task.targets)
 
 
+def panphlan_resources(species_number, time, mem):
+    """ Get the time and memory equations for a panphlan task, requesting
+        minimal resources if there is not a species for the clade number """
+    
+    selected="len(open('[depends[0]]').readlines()) > {0}".format(species_number)
+    return "{0} if {1} else 5".format(time, selected), "{0} if {1} else 1024".format(mem, selected)
+
 def strain_gene_profile(workflow,qc_files,abundance_file,output,threads,panphlan_db,max_species):
     """Strain profile, gene-based for whole genome shotgun sequences
    
@@ -931,7 +1545,25 @@ def strain_gene_profile(workflow,qc_files,abundance_file,output,threads,panphlan
         None
     """
 
-    ### STEP #1: Run panphlan map on all of the samples for each of the top species
+    # the species databases are counted when the tasks are added so check the database folder first
+    if not os.path.isdir(panphlan_db):
+        sys.exit("ERROR: Unable to find the PanPhlAn database folder: " + panphlan_db)
+    if not panphlan_databases(panphlan_db):
+        sys.exit("ERROR: Unable to find any PanPhlAn species databases in the folder: " + panphlan_db)
+
+    ### STEP #1: Rank the species and find the database for each of the top species
+    species_file = utilities.name_files("panphlan_species.tsv", output, subfolder="panphlan", create_folder=True)
+    workflow.add_task(
+        utilities.partial_function(panphlan_species,panphlan_db=os.path.abspath(panphlan_db),max_species=max_species),
+        depends=abundance_file,
+        targets=species_file,
+        name="panphlan_species")
+
+    # only add tasks for the species with databases (or those in the file of species if it is up to date)
+    max_species=min(max_species, len(panphlan_databases(panphlan_db)))
+    max_species=ranked_list_size(species_file, [abundance_file, panphlan_db], read_panphlan_species, max_species, workflow)
+
+    ### STEP #2: Run panphlan map on all of the samples for each of the top species
     out_files = workflow.name_output_files(name=qc_files, tag="panphlan_map", extension="csv.bz2")
     log_files = workflow.name_output_files(name=qc_files, tag="panphlan_map", extension="log")
     for clade_number in range(max_species):
@@ -943,27 +1575,30 @@ def strain_gene_profile(workflow,qc_files,abundance_file,output,threads,panphlan
         if not os.path.isdir(subfolder):
             os.makedirs(subfolder)
 
+        # clades without a species (if fewer species have databases) request minimal resources
+        map_time, map_mem = panphlan_resources(clade_number, time=2*60, mem=5*1024) # 2 hours, 5 GB
         for input_file, output_file, sample_map_out, sample_log_out in zip(qc_files, out_files, map_out, log_out):
             file_sample = os.path.split(output_file)[-1].split(".")[0]
             workflow.add_task_gridable(
                 utilities.partial_function(panphlan_map,species_number=clade_number,
                     threads=threads, panphlan_db=os.path.abspath(panphlan_db),output_file=sample_map_out),
-                depends=[abundance_file, input_file],
+                depends=[species_file, input_file],
                 targets=[sample_log_out],
-                time=2*60, # 2 hours
-                mem=5*1024, # 5 GB
+                time=map_time,
+                mem=map_mem,
                 cores=threads,
                 name=file_sample+"_clade_"+str(clade_number))
 
-        ### STEP #2: Run panphlan profile on each clade
+        ### STEP #3: Run panphlan profile on each clade
         profile_output_log = os.path.join(output,"panphlan","clade_"+str(clade_number)+".log")
+        profile_time, profile_mem = panphlan_resources(clade_number, time=60, mem=5*1024) # 1 hour, 5 GB
         workflow.add_task_gridable(
             utilities.partial_function(panphlan_profile,species_number=clade_number,
                 panphlan_db=os.path.abspath(panphlan_db)),
-            depends=[abundance_file]+log_out,
+            depends=[species_file]+log_out,
             targets=profile_output_log,
-            mem=5*1024, # 5 GB
-            time=60, # 1 hour
+            mem=profile_mem,
+            time=profile_time,
             cores=1,
             name="panphlan_profile_clade_"+str(clade_number))
 
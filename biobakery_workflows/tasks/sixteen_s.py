@@ -24,12 +24,28 @@ THE SOFTWARE.
 """
 
 import os
+import re
+import itertools
+import hashlib
+import shutil
 
 from anadama2.tracked import TrackedExecutable
 
 from biobakery_workflows import utilities
 from biobakery_workflows import files
 
+# the reference alignments are cached for each centroid sequence, keyed by the
+# method, the database checksum, the percent identity, and the top hit option
+ALIGNMENT_CACHE_FILE="alignments.tsv"
+UC_QUERY_INDEX=8
+
+# the number of reads from each sample for the quality report (when processing each sample)
+QUALITY_REPORT_READS=10000
+
+# align to the reference alignment profile (if provided) if there are at least this many sequences
+PROFILE_ALIGNMENT_MIN_SEQUENCES=5000
+# without a reference alignment, the profile is the alignment of this many of the first sequences
+PROFILE_SEED_SEQUENCES=1000
     
 def quality_control(workflow, method, fastq_file, output_folder, threads, maxee, trunc_len):
     """ Create a quality report, filter fastq, and then truncate fasta files
@@ -61,6 +77,187 @@ def quality_control(workflow, method, fastq_file, output_folder, threads, maxee,
     
     return filtered_truncated_fasta, truncated_fastas[0], fasta
 
+def quality_control_per_sample(workflow, method, sample_files, output_folder, threads, maxee, trunc_len):
+    """ Create a quality report from a subsample of the reads and then filter, truncate,
+    and dereplicate each sample, combining the dereplicated sequences for all samples
+    
+    Args:
+        workflow (anadama2.workflow): An instance of the workflow class.
+        method (string): tools for sequence analysis - usearch(default) or vsearch
+        sample_files (list): The paths to the fastq files for each sample.
+        output_folder (string): The path of the output folder.
+        threads (int): The number of threads for each task.
+        maxee (int): The maxee value to use for filtering.
+        trunc_len (int): The value to use for max length.
+        
+    Requires:
+        usearch or vsearch
+        
+    Returns:
+        string: A path to the fasta file of filtered, truncated, and dereplicated sequences
+        list: Paths to the fasta files of truncated reads for each sample
+        string: A path to the table of original read counts for each sample
+    """
+    
+    # generate a qc report from the first reads of each sample
+    subsample_fastq = utilities.name_files("all_samples_subsample.fastq", output_folder)
+    workflow.add_task(
+        utilities.partial_function(subsample_fastq_files, reads=QUALITY_REPORT_READS),
+        depends=sample_files,
+        targets=subsample_fastq,
+        name="subsample_fastq")
+    qc_report = quality_report(workflow, method, subsample_fastq, output_folder, threads)
+    
+    sample_names = [os.path.basename(file).replace("_renamed.fastq","") for file in sample_files]
+    filtered_files = utilities.name_files(sample_names, output_folder, subfolder="per_sample", tag="filtered", extension="fasta", create_folder=True)
+    discarded_files = utilities.name_files(sample_names, output_folder, subfolder="per_sample", tag="discarded", extension="fasta")
+    read_count_files = utilities.name_files(sample_names, output_folder, subfolder="per_sample", tag="read_count", extension="tsv")
+    truncated_files = utilities.name_files(sample_names, output_folder, subfolder="per_sample", tag="truncated", extension="fasta")
+    dereplicated_files = utilities.name_files(sample_names, output_folder, subfolder="per_sample", tag="dereplicated", extension="fasta")
+    
+    if method == "vsearch":
+        filter_command = "vsearch -fastq_filter [depends[0]] -fastq_maxee [args[1]] -fastaout [targets[0]] -threads [args[0]] -fastaout_discarded [targets[1]] -fastq_trunclen [args[2]]"
+        truncate_command = "vsearch --fastx_filter [depends[0]]  --fastq_trunclen [args[0]]  -fastaout [targets[0]]"
+        derep_command = "vsearch --derep_fulllength [depends[0]] --output [targets[0]] --sizeout --threads [args[0]]"
+    else:
+        filter_command = "usearch -fastq_filter [depends[0]] -fastq_maxee [args[1]] -fastaout [targets[0]] -threads [args[0]] -fastaout_discarded [targets[1]] -fastq_trunclen [args[2]] -fastq_qmax 45"
+        truncate_command = "usearch -fastx_truncate [depends[0]] -trunclen [args[0]] -fastaout [targets[0]]"
+        derep_command = "usearch -derep_fulllength [depends[0]] -fastaout [targets[0]] -sizeout -threads [args[0]]"
+    
+    # count the original reads for the sample (the filtered and discarded reads) by the sample id of the reads
+    count_command = "cat [targets[0]] [targets[1]] | awk '/^>/ { if (!reads) { sample=substr($1,2); sub(/\\.[^.]*$/,\"\",sample) } reads++ } "+\
+        "END { if (reads) print sample\"\\t\"reads }' > [targets[2]]"
+    
+    for sample, fastq, filtered, discarded, read_count, truncated, dereplicated in zip(sample_names, sample_files,
+        filtered_files, discarded_files, read_count_files, truncated_files, dereplicated_files):
+        workflow.add_task_gridable(
+            "export OMP_NUM_THREADS=[args[0]]; "+filter_command+" && "+count_command,
+            depends=[fastq, TrackedExecutable(method)],
+            targets=[filtered, discarded, read_count],
+            args=[threads, maxee, trunc_len],
+            time="int(10+60*file_size('[depends[0]]'))", # 10 minutes plus 1 hour per GB of reads
+            mem=1024, # 1 GB
+            cores=threads,
+            name=utilities.name_task(sample, method+"_fastq_filter"))
+        
+        workflow.add_task_gridable(
+            truncate_command,
+            depends=[fastq, TrackedExecutable(method)],
+            targets=truncated,
+            args=trunc_len,
+            time="int(10+60*file_size('[depends[0]]'))", # 10 minutes plus 1 hour per GB of reads
+            mem=1024, # 1 GB
+            cores=1,
+            name=utilities.name_task(sample, method+"_fastx_truncate"))
+        
+        workflow.add_task_gridable(
+            "export OMP_NUM_THREADS=[args[0]]; "+derep_command,
+            depends=[filtered, TrackedExecutable(method)],
+            targets=dereplicated,
+            args=threads,
+            time="int(10+60*file_size('[depends[0]]'))", # 10 minutes plus 1 hour per GB of reads
+            mem="int(1024+4*1024*file_size('[depends[0]]'))", # 1 GB plus 4 GB per GB of reads
+            cores=threads,
+            name=utilities.name_task(sample, method+"_derep_fulllength"))
+    
+    # combine the files for all samples
+    dereplicated_fasta = utilities.name_files("all_samples_dereplicated.fasta", output_folder)
+    workflow.add_task(
+        combine_dereplicated,
+        depends=dereplicated_files,
+        targets=dereplicated_fasta,
+        name="combine_dereplicated")
+    
+    read_counts = utilities.name_files("all_samples_original_read_counts.tsv", output_folder)
+    workflow.add_task(
+        gather_read_counts,
+        depends=read_count_files,
+        targets=read_counts,
+        name="gather_read_counts")
+    
+    return dereplicated_fasta, truncated_files, read_counts
+
+def gather_read_counts(task):
+    """ Gather the original read counts for each sample into a table
+    
+    Args:
+        task (anadama2.task): An instance of the task class (the depends are the read count
+            files for each sample and the target is the read count table).
+        
+    Requires:
+        None
+        
+    Returns:
+        None
+    """
+    
+    with open(task.targets[0].name, "w") as file_handle:
+        file_handle.write("# sample\toriginal read count\n")
+        for read_count in task.depends:
+            with open(read_count.name) as read_count_handle:
+                file_handle.write(read_count_handle.read())
+
+def subsample_fastq_files(task, reads):
+    """ Write the first reads from each fastq file to a single file (for a quality report)
+    
+    Args:
+        task (anadama2.task): An instance of the task class (the depends are the fastq
+            files and the target is the subsample fastq file).
+        reads (int): The max number of reads from each file.
+        
+    Requires:
+        None
+        
+    Returns:
+        None
+    """
+    
+    with open(task.targets[0].name, "w") as file_handle:
+        for fastq in task.depends:
+            with open(fastq.name) as fastq_handle:
+                for line in itertools.islice(fastq_handle, reads*4):
+                    file_handle.write(line)
+
+def combine_dereplicated(task):
+    """ Combine the dereplicated sequences for all samples, summing the sizes of
+    sequences found in more than one sample
+    
+    Args:
+        task (anadama2.task): An instance of the task class (the depends are the dereplicated
+            fasta files with size annotations and the target is the combined fasta file).
+        
+    Requires:
+        None
+        
+    Returns:
+        None
+    """
+    
+    sequences = {}
+    order = []
+    for dereplicated in task.depends:
+        label, sequence = None, ""
+        with open(dereplicated.name) as file_handle:
+            for line in itertools.chain(file_handle, [">"]):
+                line = line.strip()
+                if line.startswith(">"):
+                    if label is not None:
+                        size_annotation = re.search(";size=([0-9]+);?", label)
+                        size = int(size_annotation.group(1)) if size_annotation else 1
+                        if not sequence in sequences:
+                            order.append(sequence)
+                            sequences[sequence] = [re.sub(";size=[0-9]+;?", "", label), 0]
+                        sequences[sequence][1] += size
+                    label, sequence = line[1:], ""
+                else:
+                    sequence += line
+    
+    # write the sequences by decreasing size (as from dereplication)
+    with open(task.targets[0].name, "w") as file_handle:
+        for sequence in sorted(order, key=lambda sequence: -sequences[sequence][1]):
+            label, size = sequences[sequence]
+            file_handle.write(">"+label+";size="+str(size)+"\n"+sequence+"\n")
+
 def merge_samples_and_rename(workflow, method, input_files, extension, output_folder, pair_identifier, threads):
     """ Merge the files, first if pairs, then rename sequence ids to match sample id
          Then merge all files into a single fastq file
@@ -364,7 +561,7 @@ def truncate(workflow, method, input_files, output_folder, threads, trunc_len):
 
     return output_files
   
-def pick_otus(workflow, method, fasta_file, reference_fasta, output_folder, threads, min_size):
+def pick_otus(workflow, method, fasta_file, reference_fasta, output_folder, threads, min_size, dereplicated=False):
     """ Dereplicate, sort by size, and then cluster otus
     
     Args:
@@ -374,6 +571,7 @@ def pick_otus(workflow, method, fasta_file, reference_fasta, output_folder, thre
         output_folder (string): The path of the output folder.
         threads (int): The number of threads for each task.
         min_size (int): Min size of the reads to filter.
+        dereplicated (bool): The fasta file is already dereplicated (with size annotations).
         
     Requires:
         usearch or vsearch
@@ -382,7 +580,7 @@ def pick_otus(workflow, method, fasta_file, reference_fasta, output_folder, thre
         list: Path to the otu fasta file
     """
     
-    dereplicated_fasta = dereplicate(workflow, method, fasta_file, output_folder, threads)
+    dereplicated_fasta = fasta_file if dereplicated else dereplicate(workflow, method, fasta_file, output_folder, threads)
     
     sorted_fasta = sort_by_size(workflow, method, dereplicated_fasta, output_folder, min_size)
     
@@ -512,15 +710,18 @@ def cluster_otus(workflow, method, fasta_file, reference_fasta, output_folder):
   
   
 def taxonomic_profile(workflow, method, filtered_fasta_file, truncated_fasta_file, original_fasta_file, output_folder, threads, percent_identity,
-    reference_usearch, reference_fasta, reference_taxonomy, min_size, bypass_msa=False):
+    reference_usearch, reference_fasta, reference_taxonomy, min_size, bypass_msa=False, alignment_shards=1, alignment_cache=None, dereplicated=False,
+    msa_reference=None, msa_chunks=1):
     """ Pick otus, cluster centroids, otu mapping, reference mapping to create open/closed reference taxonomy files
     
     Args:
         workflow (anadama2.workflow): An instance of the workflow class.
         method (string): tools for sequence analysis - usearhc(default) or vsearch
         filtered_fasta_file (string): The path to the fasta file (filtered and dereplicated).
-        truncated_fasta_file (string): The path to the fasta file (truncated not qced).
-        original_fasta_file (string): The path to the fasta file (not qc or truncated).
+        truncated_fasta_file (string): The path to the fasta file (truncated not qced), or a list
+            of the truncated fasta files for each sample.
+        original_fasta_file (string): The path to the fasta file (not qc or truncated), or to
+            a table of the original read counts for each sample.
         output_folder (string): The path of the output folder.
         threads (int): The number of threads for each task.
         percent_identity (float): The percent identity to use for alignments.
@@ -529,6 +730,11 @@ def taxonomic_profile(workflow, method, filtered_fasta_file, truncated_fasta_fil
         reference_taxonomy (string): The path to the reference taxonomy file.
         min_size (int): Min size of the reads to filter.
         bypass_msa (bool): Bypass msa clustering and tree generation.        
+        alignment_shards (int): The number of shards to split each global alignment into.
+        alignment_cache (string): The folder of otu to reference alignments from prior runs (optional).
+        dereplicated (bool): The filtered fasta file is already dereplicated.
+        msa_reference (string): The reference alignment to align large sets of otus to (optional).
+        msa_chunks (int): The number of chunks to align to the reference alignment in parallel.
 
     Requires:
         usearch(as of usearch v9: has built-in de novo chimera filtering) or vsearch
@@ -540,23 +746,28 @@ def taxonomic_profile(workflow, method, filtered_fasta_file, truncated_fasta_fil
     """      
     
     # first pick otus
-    otu_fasta = pick_otus(workflow, method, filtered_fasta_file, reference_fasta, output_folder, threads, min_size)
+    otu_fasta = pick_otus(workflow, method, filtered_fasta_file, reference_fasta, output_folder, threads, min_size, dereplicated)
     
     # centroid OTU sequence alignment
     # get the name of the output files
     if not bypass_msa:
         centroid_fasta = files.SixteenS.path("msa_nonchimera", output_folder)
-        centroid_alignment(workflow, otu_fasta, centroid_fasta, threads, task_name="clustalo_nonchimera")
+        centroid_alignment(workflow, otu_fasta, centroid_fasta, threads, task_name="clustalo_nonchimera",
+            reference_alignment=msa_reference, chunks=msa_chunks)
     
     # align the reads to the otus
     otu_alignment_uc = utilities.name_files("all_samples_otu_mapping_results.uc", output_folder)
     otu_alignment_tsv = utilities.name_files("all_samples_otu_mapping_results.tsv", output_folder)
-    global_alignment(workflow, method, truncated_fasta_file, otu_fasta, percent_identity, threads, otu_alignment_uc, otu_alignment_tsv)
+    global_alignment(workflow, method, truncated_fasta_file, otu_fasta, percent_identity, threads, otu_alignment_uc, otu_alignment_tsv, shards=alignment_shards)
     
     # align the otus to the reference database
     reference_alignment_uc = utilities.name_files("all_samples_green_genes_mapping_results.uc", output_folder)
-    reference_alignment_tsv = utilities.name_files("all_samples_green_genes_mapping_results.tsv", output_folder)
-    global_alignment(workflow, method, otu_fasta, reference_usearch, percent_identity, threads, reference_alignment_uc, reference_alignment_tsv, top_hit_only=True)
+    if alignment_cache:
+        cached_global_alignment(workflow, method, otu_fasta, reference_usearch, percent_identity, threads, reference_alignment_uc,
+            alignment_cache, top_hit_only=True, shards=alignment_shards)
+    else:
+        reference_alignment_tsv = utilities.name_files("all_samples_green_genes_mapping_results.tsv", output_folder)
+        global_alignment(workflow, method, otu_fasta, reference_usearch, percent_identity, threads, reference_alignment_uc, reference_alignment_tsv, top_hit_only=True, shards=alignment_shards)
     
     # create the open/cosed reference tables
     closed_reference_tsv, closed_ref_fasta = build_otu_tables(workflow, reference_taxonomy, reference_fasta, reference_alignment_uc, otu_alignment_uc, otu_fasta, original_fasta_file, output_folder)
@@ -565,12 +776,13 @@ def taxonomic_profile(workflow, method, filtered_fasta_file, truncated_fasta_fil
     if not bypass_msa:
         centroid_closed_fasta = files.SixteenS.path("msa_closed_reference", output_folder)
         closed_tree = utilities.name_files("closed_reference.tre", output_folder)
-        centroid_alignment(workflow, closed_ref_fasta, centroid_closed_fasta, threads, task_name="clustalo_closed_reference")
-        create_tree(workflow, centroid_closed_fasta, closed_tree)    
+        centroid_alignment(workflow, closed_ref_fasta, centroid_closed_fasta, threads, task_name="clustalo_closed_reference",
+            reference_alignment=msa_reference, chunks=msa_chunks)
+        create_tree(workflow, centroid_closed_fasta, closed_tree, threads)    
 
     return closed_reference_tsv, closed_ref_fasta
 
-def centroid_alignment(workflow, fasta_file, output_fasta, threads, task_name=None):
+def centroid_alignment(workflow, fasta_file, output_fasta, threads, task_name=None, reference_alignment=None, chunks=1):
     """ Run clustalo for centroid alignment
     
     Args:
@@ -579,6 +791,11 @@ def centroid_alignment(workflow, fasta_file, output_fasta, threads, task_name=No
         output_fasta (string): The path of the output file.
         threads (int): The number of threads/cores for each task.
         task_name (string): The custom name of the task.
+        reference_alignment (string): The path to a reference alignment (optional). If there are at
+            least PROFILE_ALIGNMENT_MIN_SEQUENCES sequences, they are aligned to the reference
+            alignment profile in chunks instead of to each other. Without a reference alignment,
+            the profile is the alignment of the first PROFILE_SEED_SEQUENCES sequences.
+        chunks (int): The number of chunks to align to the reference alignment profile in parallel.
         
     Requires:
         clustal omega: multiple sequence alignment for proteins 
@@ -588,22 +805,171 @@ def centroid_alignment(workflow, fasta_file, output_fasta, threads, task_name=No
 
     """     
     
-    # remove existing output file if already exists as clustalo will not overwrite
+    task_name = task_name if task_name else "clustalo"
+    clustalo = TrackedExecutable("clustalo",version_command="echo 'clustalo' `clustalo --version`")
+
+    # choose the alignment from the number of sequences if the file exists, otherwise add the
+    # tasks for both alignments and the profile tasks only run if there are enough sequences
+    total_sequences = len(utilities.read_fasta(fasta_file, id_only=True)) if os.path.isfile(fasta_file) else None
+    if total_sequences is not None and total_sequences < PROFILE_ALIGNMENT_MIN_SEQUENCES:
+        # remove existing output file if already exists as clustalo will not overwrite
+        workflow.add_task_gridable(
+            "remove_if_exists.py [targets[0]] ; "
+            "clustalo -i [depends[0]] -o [targets[0]] --threads [args[0]]",
+            depends=[fasta_file,clustalo],
+            targets=output_fasta,
+            args=threads,
+            time="int(10+4*60*1024*file_size('[depends[0]]'))", # 10 minutes plus 4 hours per MB of sequences
+            mem="int(2*1024+4*1024*1024*file_size('[depends[0]]'))", # 2 GB plus 4 GB per MB of sequences
+            cores=threads,
+            name=task_name)
+        return
+
+    # if the number of sequences is known, always align in chunks (in case the sequences change before the task runs)
+    min_sequences = PROFILE_ALIGNMENT_MIN_SEQUENCES if total_sequences is None else 0
+
+    chunks_folder = os.path.join(os.path.dirname(os.path.abspath(output_fasta)), "alignment_chunks")
+    utilities.create_folders(chunks_folder)
+    chunk_name = os.path.join(chunks_folder, task_name+"_chunk_")
+    chunk_files = [(chunk_name+str(i)+".fasta", chunk_name+str(i)+"_aligned.fasta") for i in range(max(1, chunks))]
+
+    # without a reference alignment, align the first sequences to each other to use as the profile
+    if not reference_alignment:
+        seed_fasta = os.path.join(chunks_folder, task_name+"_reference.fasta")
+        reference_alignment = os.path.join(chunks_folder, task_name+"_reference_aligned.fasta")
+        workflow.add_task(
+            utilities.partial_function(profile_seed_fasta, seed_sequences=PROFILE_SEED_SEQUENCES, min_sequences=min_sequences),
+            depends=fasta_file,
+            targets=seed_fasta,
+            name=task_name+"_reference")
+
+        workflow.add_task_gridable(
+            "remove_if_exists.py [targets[0]] ; "
+            "if [ -s [depends[0]] ]; then clustalo -i [depends[0]] -o [targets[0]] --threads [args[0]]; else touch [targets[0]]; fi",
+            depends=[seed_fasta, clustalo],
+            targets=reference_alignment,
+            args=threads,
+            time="int(10+4*60*1024*file_size('[depends[0]]'))", # 10 minutes plus 4 hours per MB of sequences
+            mem="int(2*1024+4*1024*1024*file_size('[depends[0]]'))", # 2 GB plus 4 GB per MB of sequences
+            cores=threads,
+            name=task_name+"_reference_alignment")
+
+    # split the sequences into chunks (these are empty if there are too few sequences for the profile alignment)
+    workflow.add_task(
+        utilities.partial_function(split_fasta, min_sequences=min_sequences),
+        depends=fasta_file,
+        targets=[chunk_fasta for chunk_fasta, chunk_aligned in chunk_files],
+        name=task_name+"_split")
+
+    # align each chunk to the reference alignment profile
+    for i, (chunk_fasta, chunk_aligned) in enumerate(chunk_files):
+        workflow.add_task_gridable(
+            "remove_if_exists.py [targets[0]] ; "
+            "if [ -s [depends[0]] ]; then clustalo --profile1 [depends[1]] -i [depends[0]] -o [targets[0]] --threads [args[0]]; else touch [targets[0]]; fi",
+            depends=[chunk_fasta, reference_alignment, clustalo],
+            targets=chunk_aligned,
+            args=threads,
+            time="int(10+10*60*1024*file_size('[depends[0]]'))", # 10 minutes plus 10 hours per MB of sequences
+            mem="8*1024 if file_size('[depends[0]]') > 0 else 1024", # 8 GB for the profile alignment
+            cores=threads,
+            name=utilities.name_task(str(i), task_name+"_profile"))
+
+    depends = [reference_alignment]
+    if min_sequences:
+        # if there are too few sequences (so the first chunk is empty), align all of the sequences to each other
+        all_aligned = os.path.join(chunks_folder, task_name+"_all_aligned.fasta")
+        workflow.add_task_gridable(
+            "remove_if_exists.py [targets[0]] ; "
+            "if [ -s [depends[1]] ]; then touch [targets[0]]; else clustalo -i [depends[0]] -o [targets[0]] --threads [args[0]]; fi",
+            depends=[fasta_file, chunk_files[0][0], clustalo],
+            targets=all_aligned,
+            args=threads,
+            time="int(10+4*60*1024*file_size('[depends[0]]')) if file_size('[depends[1]]') == 0 else 10", # 10 minutes plus 4 hours per MB of sequences
+            mem="int(2*1024+4*1024*1024*file_size('[depends[0]]')) if file_size('[depends[1]]') == 0 else 1024", # 2 GB plus 4 GB per MB of sequences
+            cores=threads,
+            name=task_name+"_all")
+        depends.append(all_aligned)
+
+    # merge the chunks (or use the alignment of all of the sequences)
     workflow.add_task(
-        "remove_if_exists.py [targets[0]] ; "
-        "clustalo -i [depends[0]] -o [targets[0]] --threads [args[0]]",
-        depends=[fasta_file,TrackedExecutable("clustalo",version_command="echo 'clustalo' `clustalo --version`")],
+        utilities.partial_function(merge_profile_alignments, all_aligned=bool(min_sequences)),
+        depends=depends+[chunk_aligned for chunk_fasta, chunk_aligned in chunk_files],
         targets=output_fasta,
-        args=threads,
-        name=task_name if task_name else "clustalo")
+        name=task_name)
+
+def profile_seed_fasta(task, seed_sequences, min_sequences=0):
+    """ Write the first sequences (the most abundant for the otu and asv files) to align to each
+    other as the reference alignment profile. The ids are prefixed with "reference_" so these
+    sequences are removed from the aligned chunks when they are merged.
+
+    Args:
+        task (anadama2.task): An instance of the task class (the depends is the fasta file
+            and the target is the fasta file of the reference sequences).
+        seed_sequences (int): The number of sequences to write.
+        min_sequences (int): If there are fewer sequences, write an empty file.
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
 
-def create_tree(workflow, msa_file, tree_file):
+    sequences = utilities.read_fasta(task.depends[0].name)
+    if len(sequences) < min_sequences:
+        sequences = []
+
+    with open(task.targets[0].name, "w") as file_handle:
+        for seq_id, sequence in sequences[:seed_sequences]:
+            file_handle.write(">reference_"+seq_id+"\n"+sequence+"\n")
+
+def merge_profile_alignments(task, all_aligned=False):
+    """ Merge the chunks aligned to the reference alignment profile, removing the reference
+    sequences and the columns inserted for each chunk (gaps in all reference sequences) so the
+    chunks share the columns of the reference alignment.
+
+    Args:
+        task (anadama2.task): An instance of the task class (the depends are the reference alignment,
+            the alignment of all sequences if set, and the aligned chunks and the target is the alignment).
+        all_aligned (bool): The second depend is the alignment of all of the sequences to each other,
+            which is used if it is not empty (as there were too few sequences to align in chunks).
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
+
+    if all_aligned:
+        if os.path.getsize(task.depends[1].name) > 0:
+            shutil.copyfile(task.depends[1].name, task.targets[0].name)
+            return
+        chunks = task.depends[2:]
+    else:
+        chunks = task.depends[1:]
+
+    reference_ids = set(seq_id for seq_id, sequence in utilities.read_fasta(task.depends[0].name, id_only=True))
+
+    with open(task.targets[0].name, "w") as file_handle:
+        for chunk in chunks:
+            aligned = utilities.read_fasta(chunk.name)
+            if not aligned:
+                continue
+            reference = [sequence for seq_id, sequence in aligned if seq_id.split()[0] in reference_ids]
+            columns = [i for i in range(len(aligned[0][1])) if any(sequence[i] not in "-." for sequence in reference)]
+            for seq_id, sequence in aligned:
+                if not seq_id.split()[0] in reference_ids:
+                    file_handle.write(">"+seq_id+"\n"+"".join(sequence[i] for i in columns)+"\n")
+
+def create_tree(workflow, msa_file, tree_file, threads=1):
     """ Run fasttree to generate phylogenetic tree
     
     Args:
         workflow (anadama2.workflow): An instance of the workflow class.
         msa_file (string): The path to the multiple sequence alignment file.
         tree_file (string): The path of the output tree file.
+        threads (int): The number of threads (if more than one, the multithreaded FastTreeMP is used if installed).
 
     Requires:
         fasttree: phylogenetic trees from alignments of nucleotide or protein sequences
@@ -613,25 +979,250 @@ def create_tree(workflow, msa_file, tree_file):
     """
 
     # run fasttree on msa file with default settings
+    if int(threads) > 1:
+        workflow.add_task(
+            "export OMP_NUM_THREADS=[args[0]]; `command -v FastTreeMP || echo FastTree` -gtr -nt [depends[0]] > [targets[0]]",
+            depends=msa_file,
+            targets=tree_file,
+            args=threads,
+            name="fasttree")
+    else:
+        workflow.add_task(
+            "FastTree -gtr -nt [depends[0]] > [targets[0]]",
+            depends=msa_file,
+            targets=tree_file,
+            name="fasttree")
+
+def split_fasta(task, min_sequences=0):
+    """ Split a fasta file into shards, writing about the same number of sequences to each
+    
+    Args:
+        task (anadama2.task): An instance of the task class (the depends is the fasta file
+            and the targets are the shard files).
+        min_sequences (int): If there are fewer sequences, write empty shards.
+        
+    Requires:
+        None
+        
+    Returns:
+        None
+    """
+    
+    with open(task.depends[0].name) as file_handle:
+        total_sequences = sum(1 for line in file_handle if line.startswith(">"))
+    shard_size = max(1, -(-total_sequences // len(task.targets)))
+    
+    shards = [open(target.name, "w") for target in task.targets]
+    if total_sequences < min_sequences:
+        for shard in shards:
+            shard.close()
+        return
+    sequence_number = -1
+    with open(task.depends[0].name) as file_handle:
+        for line in file_handle:
+            if line.startswith(">"):
+                sequence_number += 1
+            if sequence_number >= 0:
+                shards[sequence_number // shard_size].write(line)
+    for shard in shards:
+        shard.close()
+
+def merge_alignments(task):
+    """ Merge the alignment results for each shard, concatenating the uc files
+    and summing the counts in the otu tables
+    
+    Args:
+        task (anadama2.task): An instance of the task class (the depends are the uc files
+            and then the otu tables for each shard and the targets are the merged uc and otu table).
+        
+    Requires:
+        None
+        
+    Returns:
+        None
+    """
+    
+    total_shards = len(task.depends) // 2
+    
+    with open(task.targets[0].name, "w") as file_handle:
+        for shard_uc in task.depends[:total_shards]:
+            with open(shard_uc.name) as shard_handle:
+                for line in shard_handle:
+                    file_handle.write(line)
+    
+    header = "#OTU ID"
+    samples = []
+    otus = []
+    counts = {}
+    for shard_tsv in task.depends[total_shards:total_shards*2]:
+        with open(shard_tsv.name) as shard_handle:
+            shard_samples = shard_handle.readline().rstrip("\n").split("\t")
+            if not shard_samples[0]:
+                continue
+            header = shard_samples.pop(0)
+            for sample in shard_samples:
+                if not sample in samples:
+                    samples.append(sample)
+            for line in shard_handle:
+                data = line.rstrip("\n").split("\t")
+                if not data[0] in counts:
+                    otus.append(data[0])
+                    counts[data[0]] = {}
+                for sample, count in zip(shard_samples, data[1:]):
+                    counts[data[0]][sample] = counts[data[0]].get(sample, 0) + int(float(count))
+    
+    with open(task.targets[1].name, "w") as file_handle:
+        file_handle.write("\t".join([header]+samples)+"\n")
+        for otu in otus:
+            file_handle.write("\t".join([otu]+[str(counts[otu].get(sample, 0)) for sample in samples])+"\n")
+
+def alignment_cache_file(cache_folder, method, database_file, id, top_hit_only):
+    """ Get the alignment cache file for the method, database, and alignment options """
+
+    key = "\t".join([method, utilities.file_checksum(database_file), str(id), str(bool(top_hit_only))])
+    key = os.path.basename(database_file).split(".")[0]+"_"+hashlib.md5(key.encode("utf-8")).hexdigest()
+    return os.path.join(os.path.abspath(cache_folder), key, ALIGNMENT_CACHE_FILE)
+
+def read_alignment_cache(cache_file):
+    """ Read the uc lines for each sequence hash from the cache """
+
+    alignments={}
+    if os.path.isfile(cache_file):
+        with open(cache_file) as file_handle:
+            for line in file_handle:
+                data=line.rstrip("\n").split("\t")
+                alignments.setdefault(data[0],[]).append(data[1:])
+    return alignments
+
+def split_cached_alignments(task, method, id, top_hit_only, cache_folder):
+    """ Write the sequences without alignments in the cache to a fasta file
+    
+    Args:
+        task (anadama2.task): An instance of the task class (the depends are the fasta file and
+            the database and the target is the fasta file of sequences to align).
+        method (string): tools for sequence analysis - usearch or vsearch
+        id (float): The percent identity for alignment
+        top_hit_only (bool): If set, only get the top hits.
+        cache_folder (string): The alignment cache folder.
+        
+    Requires:
+        None
+        
+    Returns:
+        None
+    """
+    
+    cached = read_alignment_cache(alignment_cache_file(cache_folder, method, task.depends[1].name, id, top_hit_only))
+    with open(task.targets[0].name, "w") as file_handle:
+        for seq_id, sequence in utilities.read_fasta(task.depends[0].name, id_only=True):
+            if not utilities.sequence_hash(sequence) in cached:
+                file_handle.write(">"+seq_id+"\n"+sequence+"\n")
+
+def merge_cached_alignments(task, method, id, top_hit_only, cache_folder):
+    """ Merge the cached alignments with those for the new sequences, writing the uc lines
+    in the order of the sequences (as for an alignment of all sequences), and add the new
+    alignments to the cache
+    
+    Args:
+        task (anadama2.task): An instance of the task class (the depends are the fasta file, the 
+            database, and the uc file for the new sequences and the target is the uc file).
+        method (string): tools for sequence analysis - usearch or vsearch
+        id (float): The percent identity for alignment
+        top_hit_only (bool): If set, only get the top hits.
+        cache_folder (string): The alignment cache folder.
+        
+    Requires:
+        None
+        
+    Returns:
+        None
+    """
+    
+    cache_file = alignment_cache_file(cache_folder, method, task.depends[1].name, id, top_hit_only)
+    cached = read_alignment_cache(cache_file)
+    
+    # read the alignments for the new sequences
+    aligned = {}
+    with open(task.depends[2].name) as file_handle:
+        for line in file_handle:
+            data = line.rstrip("\n").split("\t")
+            if len(data) > UC_QUERY_INDEX:
+                aligned.setdefault(data[UC_QUERY_INDEX],[]).append(data)
+    
+    new_alignments = []
+    with open(task.targets[0].name, "w") as file_handle:
+        for seq_id, sequence in utilities.read_fasta(task.depends[0].name, id_only=True):
+            key = utilities.sequence_hash(sequence)
+            if key in cached:
+                lines = [data[:UC_QUERY_INDEX]+[seq_id]+data[UC_QUERY_INDEX+1:] for data in cached[key]]
+            else:
+                lines = aligned.get(seq_id, [])
+                new_alignments += [[key]+data[:UC_QUERY_INDEX]+["*"]+data[UC_QUERY_INDEX+1:] for data in lines]
+            for data in lines:
+                file_handle.write("\t".join(data)+"\n")
+    
+    # add the new alignments to the cache
+    if new_alignments:
+        utilities.append_to_cache(cache_file, ["\t".join(data) for data in new_alignments])
+
+def cached_global_alignment(workflow, method, fasta_file, database_file, id, threads, output_file_uc, cache_folder, top_hit_only=None, shards=1):
+    """ Run global alignment with the database provided for only the sequences not in the cache 
+    
+    Args:
+        workflow (anadama2.workflow): An instance of the workflow class.
+        method (string): tools for sequence analysis - usearch(default) or vsearch
+        fasta_file (string): The path to the fasta file.
+        database_file (string): Path to the database file (fasta or usearch format)
+        id (float): The percent identity for alignment
+        threads (int): The number of threads/cores for each task
+        output_file_uc (string): The name for the uc output file (the alignments of the new
+            sequences are written to files with the same name ending in "_new_sequences")
+        cache_folder (string): The folder of alignments from prior runs
+        top_hit_only (bool): If set, only get the top hits.
+        shards (int): The number of shards to split the alignment into.
+        
+    Requires:
+        usearch or vsearch
+        
+    Returns:
+        None
+
+    """    
+    
+    new_fasta = output_file_uc.rsplit(".",1)[0]+"_new_sequences.fasta"
+    new_uc = output_file_uc.rsplit(".",1)[0]+"_new_sequences.uc"
+    new_tsv = output_file_uc.rsplit(".",1)[0]+"_new_sequences.tsv"
+    
+    workflow.add_task(
+        utilities.partial_function(split_cached_alignments, method=method, id=id, top_hit_only=top_hit_only, cache_folder=cache_folder),
+        depends=[fasta_file, database_file],
+        targets=new_fasta,
+        name=utilities.name_task(os.path.basename(output_file_uc).rsplit(".",1)[0], "split_cached_alignments"))
+    
+    global_alignment(workflow, method, new_fasta, database_file, id, threads, new_uc, new_tsv, top_hit_only=top_hit_only, shards=shards)
+    
     workflow.add_task(
-        "FastTree -gtr -nt [depends[0]] > [targets[0]]",
-        depends=msa_file,
-        targets=tree_file,
-        name="fasttree")
+        utilities.partial_function(merge_cached_alignments, method=method, id=id, top_hit_only=top_hit_only, cache_folder=cache_folder),
+        depends=[fasta_file, database_file, new_uc],
+        targets=output_file_uc,
+        name=utilities.name_task(os.path.basename(output_file_uc).rsplit(".",1)[0], "merge_cached_alignments"))
 
-def global_alignment(workflow, method, fasta_file, database_file, id, threads, output_file_uc, output_file_tsv, top_hit_only=None):
+def global_alignment(workflow, method, fasta_file, database_file, id, threads, output_file_uc, output_file_tsv, top_hit_only=None, shards=1):
     """ Run global alignment with the database provided 
     
     Args:
         workflow (anadama2.workflow): An instance of the workflow class.
         method (string): tools for sequence analysis - usearch(default) or vsearch
-        fasta_file (string): The path to the fasta file (filtered and dereplicated).
+        fasta_file (string): The path to the fasta file (filtered and dereplicated), or a list
+            of fasta files (ie one for each sample) which are aligned in parallel and then merged.
         database_file (string): Path to the database file (fasta or usearch format)
         id (float): The percent identity for alignment
         threads (int): The number of threads/cores for each task
         output_file_uc (string): The name for the uc output file 
         output_file_tsv (string): The name for the tsv output file 
         top_hit_only (bool): If set, only get the top hits.
+        shards (int): If more than one, split the fasta file into shards which are aligned
+            in parallel and then merged (not used if a list of fasta files is provided).
         
     Requires:
         usearch or vsearch
@@ -647,29 +1238,53 @@ def global_alignment(workflow, method, fasta_file, database_file, id, threads, o
     if method == "vsearch":
         if top_hit_only:
             optional_flags = " -top_hits_only"
-        workflow.add_task_gridable(
-            "export OMP_NUM_THREADS=[args[0]]; " + \
-            "vsearch -usearch_global [depends[0]] -db [depends[1]] -strand plus -id [args[1]] -uc [targets[0]] -otutabout [targets[1]] -threads [args[0]]" + optional_flags,
-            depends=[fasta_file, database_file, TrackedExecutable("vsearch")],
-            targets=[output_file_uc, output_file_tsv],
-            args=[threads, id],
-            name="vsearch_global",
-            time=60,  # 60 minutes
-            mem=2 * 1024,  # 2 GB
-            cores=threads)  # time/mem based on 8 cores
+        command = "vsearch -usearch_global [depends[0]] -db [depends[1]] -strand plus -id [args[1]] -uc [targets[0]] -otutabout [targets[1]] -threads [args[0]]"
     else:
         if top_hit_only:
             optional_flags = " -top_hit_only"
+        command = "usearch -usearch_global [depends[0]] -db [depends[1]] -strand 'both' -id [args[1]] -uc [targets[0]] -otutabout [targets[1]] -threads [args[0]]"
+    
+    # align each of the fasta files provided, or split the fasta file into shards, to align in parallel
+    merge_shards = isinstance(fasta_file, list) or shards > 1
+    if merge_shards:
+        shards_folder = os.path.join(os.path.dirname(output_file_uc), "alignment_shards")
+        utilities.create_folders(shards_folder)
+        shard_name = os.path.join(shards_folder, os.path.basename(output_file_uc).rsplit(".",1)[0]+"_shard_")
+    
+    if isinstance(fasta_file, list):
+        shard_files = [(file, shard_name+os.path.basename(file).rsplit(".",1)[0]+".uc", shard_name+os.path.basename(file).rsplit(".",1)[0]+".tsv")
+            for file in fasta_file]
+    elif shards > 1:
+        shard_files = [(shard_name+str(i)+".fasta", shard_name+str(i)+".uc", shard_name+str(i)+".tsv") for i in range(shards)]
+        
+        workflow.add_task(
+            split_fasta,
+            depends=fasta_file,
+            targets=[shard_fasta for shard_fasta, shard_uc, shard_tsv in shard_files],
+            name=utilities.name_task(os.path.basename(output_file_uc).rsplit(".",1)[0], "split_fasta"))
+    else:
+        shard_files = [(fasta_file, output_file_uc, output_file_tsv)]
+    
+    # write empty results without running the alignment if there are no sequences
+    # (ie if all of the sequences are in the alignment cache or there are more shards than sequences)
+    for i, (shard_fasta, shard_uc, shard_tsv) in enumerate(shard_files):
         workflow.add_task_gridable(
-            "export OMP_NUM_THREADS=[args[0]]; "+\
-            "usearch -usearch_global [depends[0]] -db [depends[1]] -strand 'both' -id [args[1]] -uc [targets[0]] -otutabout [targets[1]] -threads [args[0]]"+optional_flags,
-            depends=[fasta_file, database_file, TrackedExecutable("usearch")],
-            targets=[output_file_uc, output_file_tsv],
+            "if [ -s [depends[0]] ]; then export OMP_NUM_THREADS=[args[0]]; "+command+optional_flags+"; "+\
+                "else : > [targets[0]] ; : > [targets[1]] ; fi",
+            depends=[shard_fasta, database_file, TrackedExecutable(method)],
+            targets=[shard_uc, shard_tsv],
             args=[threads, id],
-            name="usearch_global",
-            time=60, # 60 minutes
+            name=utilities.name_task(os.path.basename(shard_uc).rsplit(".",1)[0], method+"_global") if merge_shards else method+"_global",
+            time="int(60+8*60*file_size('[depends[0]]')) if file_size('[depends[0]]') > 0 else 5", # 60 minutes plus 8 hours per GB of sequences
             mem=2*1024, # 2 GB
             cores=threads) # time/mem based on 8 cores
+    
+    if merge_shards:
+        workflow.add_task(
+            merge_alignments,
+            depends=[shard_uc for shard_fasta, shard_uc, shard_tsv in shard_files]+[shard_tsv for shard_fasta, shard_uc, shard_tsv in shard_files],
+            targets=[output_file_uc, output_file_tsv],
+            name=utilities.name_task(os.path.basename(output_file_uc).rsplit(".",1)[0], "merge_"+method+"_global"))
    
    
 def build_otu_tables(workflow, reference_taxonomy, reference_fasta, reference_mapping_results_uc, otu_mapping_results_uc, otu_fasta, original_fasta, output_folder):
@@ -682,7 +1297,8 @@ def build_otu_tables(workflow, reference_taxonomy, reference_fasta, reference_ma
         reference_mapping_results_uc (string): The path to the reference mapping uc results file.
         otu_mapping_results_uc (string): The path to the otu mapping uc results file.
         otu_fasta (string): The path to the fasta file of otu sequences.
-        original_fasta (string): The path to the fasta file (not qc or truncated).
+        original_fasta (string): The path to the fasta file (not qc or truncated), or to
+            a table of the original read counts for each sample.
         output_folder (string): The path of the output folder.
         
     Requires:
@@ -710,26 +1326,24 @@ def build_otu_tables(workflow, reference_taxonomy, reference_fasta, reference_ma
     
     return closed_ref_tsv, closed_ref_fasta
 
-def run_picrust2(task, threads, otus=False):
-    """ Run picrust2, first changing sequence ids to avoid all numeric (as per picrust2 tutorial) """
-
-    picrust2_input_dir = os.path.dirname(task.depends[0].name)
-    picrust2_output_dir = os.path.dirname(task.targets[0].name)
-
-    if otus:
-        reformat_input_fasta = utilities.name_files(task.depends[0].name, picrust2_input_dir, tag="picrust_reformatted_input", create_folder=True)
-        with open(task.depends[0].name) as file_handle:
-            with open(reformat_input_fasta, "w") as file_handle_write:
-                for line in file_handle:
-                    if line.startswith(">"):
-                        line=line.replace(">",">seq")
-                    file_handle_write.write(line)
-    else:
-        reformat_input_fasta = task.depends[0].name
+def reformat_picrust2_input(task, otus=False):
+    """ Reformat the picrust2 inputs, changing sequence ids to avoid all numeric (as per picrust2 tutorial)
+    and removing the taxonomy column from the table 
+    
+    Args:
+        task (anadama2.task): An instance of the task class (the depends are the fasta file and
+            the table and the targets are the reformatted table and, if otus, fasta file).
+        otus (bool): Are the inputs from OTUs (so all numerical ids).
+        
+    Requires:
+        None
+        
+    Returns:
+        None
+    """
 
-    reformat_input_tsv = utilities.name_files(task.depends[1].name, picrust2_input_dir, tag="picrust_reformatted_input")
     with open(task.depends[1].name) as file_handle:
-        with open(reformat_input_tsv, "w") as file_handle_write:
+        with open(task.targets[0].name, "w") as file_handle_write:
             header = file_handle.readline()
             file_handle_write.write(header)
             for line in file_handle:
@@ -738,10 +1352,106 @@ def run_picrust2(task, threads, otus=False):
                 line="\t".join(line.split("\t")[:-1])+"\n"
                 file_handle_write.write(line)
 
-    utilities.run_task("remove_if_exists.py [args[0]] --is-folder ; picrust2_pipeline.py -s [args[1]] -i [args[2]] -o [args[0]] -p [args[3]]",
-        depends=task.depends,
-        targets=task.depends,
-        args=[picrust2_output_dir, reformat_input_fasta, reformat_input_tsv, threads])
+    if otus:
+        with open(task.depends[0].name) as file_handle:
+            with open(task.targets[1].name, "w") as file_handle_write:
+                for line in file_handle:
+                    if line.startswith(">"):
+                        line=line.replace(">",">seq")
+                    file_handle_write.write(line)
+
+def run_picrust2(workflow, closed_reference_tsv, closed_reference_fasta, threads, output_folder, otus):
+    """ Run the picrust2 stages as separate tasks (sequence placement, hidden-state
+    prediction for each trait, metagenome prediction, and pathway inference) so each
+    stage only runs if its outputs are missing or out of date
+    
+    Args:
+        workflow (anadama2.workflow): An instance of the workflow class.
+        closed_reference_tsv (string): The path to the closed reference tsv file.
+        closed_reference_fasta (string): The path to the closed reference fasta file.
+        threads (int): The number of threads/cores for each task.
+        output_folder (string): The path of the output folder.
+        otus (bool): Are the inputs from OTUs (so all numerical ids).
+        
+    Requires:
+        Picrust v2
+        
+    Returns:
+        string: The path to the predicted pathway abundances.
+    """
+
+    picrust2_folder = os.path.join(os.path.abspath(output_folder), "picrust2")
+    utilities.create_folders(picrust2_folder)
+
+    # reformat the inputs
+    input_folder = os.path.dirname(closed_reference_tsv)
+    reformat_input_tsv = utilities.name_files(closed_reference_tsv, input_folder, tag="picrust_reformatted_input")
+    reformat_input_fasta = closed_reference_fasta
+    targets = [reformat_input_tsv]
+    if otus:
+        reformat_input_fasta = utilities.name_files(closed_reference_fasta, input_folder, tag="picrust_reformatted_input")
+        targets.append(reformat_input_fasta)
+    workflow.add_task(
+        utilities.partial_function(reformat_picrust2_input, otus=otus),
+        depends=[closed_reference_fasta, closed_reference_tsv],
+        targets=targets,
+        name="picrust2_reformat_input")
+
+    # place the sequences in the reference tree
+    placed_tree = os.path.join(picrust2_folder, "out.tre")
+    workflow.add_task_gridable(
+        "place_seqs.py -s [depends[0]] -o [targets[0]] -p [args[0]] --intermediate [args[1]]",
+        depends=[reformat_input_fasta, TrackedExecutable("place_seqs.py")],
+        targets=placed_tree,
+        args=[threads, os.path.join(picrust2_folder, "intermediate", "place_seqs")],
+        time=6*60, # 6 hours
+        mem=16*1024, # 16 GB
+        cores=threads,
+        name="picrust2_place_seqs")
+
+    # predict the marker copy numbers (with nsti) and each trait in parallel
+    predicted = {}
+    for trait in ["16S", "EC", "KO"]:
+        predicted[trait] = os.path.join(picrust2_folder, "marker_predicted_and_nsti.tsv.gz" if trait == "16S" else trait+"_predicted.tsv.gz")
+        workflow.add_task_gridable(
+            "hsp.py -i [args[1]] -t [depends[0]] -o [targets[0]] -p [args[0]]"+(" -n" if trait == "16S" else ""),
+            depends=[placed_tree, TrackedExecutable("hsp.py")],
+            targets=predicted[trait],
+            args=[threads, trait],
+            time=6*60, # 6 hours
+            mem=16*1024, # 16 GB
+            cores=threads,
+            name=utilities.name_task(trait, "picrust2_hsp"))
+
+    # predict the metagenomes for each trait
+    metagenomes = {}
+    for trait in ["EC", "KO"]:
+        metagenome_folder = os.path.join(picrust2_folder, trait+"_metagenome_out")
+        metagenomes[trait] = os.path.join(metagenome_folder, "pred_metagenome_unstrat.tsv.gz")
+        workflow.add_task_gridable(
+            "metagenome_pipeline.py -i [depends[0]] -m [depends[1]] -f [depends[2]] -o [args[0]]",
+            depends=[reformat_input_tsv, predicted["16S"], predicted[trait], TrackedExecutable("metagenome_pipeline.py")],
+            targets=metagenomes[trait],
+            args=metagenome_folder,
+            time=2*60, # 2 hours
+            mem=8*1024, # 8 GB
+            cores=1,
+            name=utilities.name_task(trait, "picrust2_metagenome_pipeline"))
+
+    # infer the pathway abundances
+    pathways_folder = os.path.join(picrust2_folder, "pathways_out")
+    pathways = os.path.join(pathways_folder, "path_abun_unstrat.tsv.gz")
+    workflow.add_task_gridable(
+        "pathway_pipeline.py -i [depends[0]] -o [args[0]] -p [args[1]] --intermediate [args[2]]",
+        depends=[metagenomes["EC"], TrackedExecutable("pathway_pipeline.py")],
+        targets=pathways,
+        args=[pathways_folder, threads, os.path.join(picrust2_folder, "intermediate", "pathways")],
+        time=2*60, # 2 hours
+        mem=8*1024, # 8 GB
+        cores=threads,
+        name="picrust2_pathway_pipeline")
+
+    return pathways
 
 
 def functional_profile(workflow, closed_reference_tsv, closed_reference_fasta, picrust_version, threads, output_folder, otus):
@@ -787,12 +1497,7 @@ def functional_profile(workflow, closed_reference_tsv, closed_reference_fasta, p
 
     else:
         # run the v2 pipeline
-        functional_data_predicted_tre = utilities.name_files("out.tre", output_folder, subfolder="picrust2")
-        workflow.add_task(
-            utilities.partial_function(run_picrust2,threads=threads,otus=otus),
-            depends=[closed_reference_fasta, closed_reference_tsv],
-            targets=functional_data_predicted_tre)
-        return functional_data_predicted_tre
+        return run_picrust2(workflow, closed_reference_tsv, closed_reference_fasta, threads, output_folder, otus)
 
 def picrust(workflow,otu_table_biom,output_folder):
     """ Runs picrust normalize, then predict
@@ -30,13 +30,8 @@ import functools
 import time
 import collections
 
-from anadama2.tracked import TrackedDirectory
-
-# try to import urllib.request.urlretrieve for python3
-try:
-    from urllib.request import urlretrieve
-except ImportError:
-    from urllib import urlretrieve
+# only the standard library is imported at the module level, anadama2 and
+# numpy are imported in the functions that require them to keep imports fast
 
 def get_package_file(basename, type="template"):
     """ Get the full path to a file included in the installed python package.
@@ -389,6 +384,12 @@ def download_file(url, download_file):
     Create folder for downloaded file if it does not exist
     """
 
+    # try to import urllib.request.urlretrieve for python3
+    try:
+        from urllib.request import urlretrieve
+    except ImportError:
+        from urllib import urlretrieve
+
     create_folders(os.path.dirname(download_file))
 
     try:
@@ -399,6 +400,212 @@ def download_file(url, download_file):
     except EnvironmentError:
         print("WARNING: Unable to download "+url)
 
+def file_checksum(file, block_size=1024*1024):
+    """ Compute the md5 checksum of a file reading in blocks
+
+    Args:
+        file (string): The path to the file
+        block_size (int): The number of bytes to read at a time
+
+    Returns:
+        (string): The hex digest of the file contents
+    """
+
+    import hashlib
+
+    checksum=hashlib.md5()
+    with open(file,"rb") as file_handle:
+        for block in iter(lambda: file_handle.read(block_size), b""):
+            checksum.update(block)
+
+    return checksum.hexdigest()
+
+def read_fasta(file, id_only=False):
+    """ Read the ids and sequences from a fasta file (allowing for sequences on multiple lines)
+
+    Args:
+        file (string): The path to the fasta file
+        id_only (bool): If set, only include the id (the header up to the first space)
+
+    Returns:
+        (list): The id and sequence for each sequence in the file
+    """
+
+    sequences=[]
+    with open(file) as file_handle:
+        for line in file_handle:
+            line=line.strip()
+            if line.startswith(">"):
+                sequences.append([(line[1:].split() or [""])[0] if id_only else line[1:],[]])
+            elif line and sequences:
+                sequences[-1][1].append(line)
+    return [[seq_id, "".join(sequence)] for seq_id, sequence in sequences]
+
+def sequence_hash(sequence):
+    """ Get the md5 hash of a sequence (ignoring case) to use as a cache key
+
+    Args:
+        sequence (string): The sequence
+
+    Returns:
+        (string): The hex digest of the sequence
+    """
+
+    import hashlib
+
+    return hashlib.md5(sequence.upper().encode("utf-8")).hexdigest()
+
+def append_to_cache(cache_file, lines, header=None):
+    """ Append lines to a cache file, writing all of the lines at once so runs can share the cache
+
+    Args:
+        cache_file (string): The path to the cache file (the folder is created if needed)
+        lines (list): The lines to add (without new lines)
+        header (string): The header to write if the cache file does not exist (optional)
+
+    Returns:
+        None
+    """
+
+    create_folders(os.path.dirname(cache_file))
+    if header and not os.path.isfile(cache_file):
+        lines=[header]+list(lines)
+    with open(cache_file, "a") as file_handle:
+        file_handle.write("".join(line+"\n" for line in lines))
+
+def read_manifest(file):
+    """ Read a database manifest of relative paths and checksums
+
+    Args:
+        file (string): The manifest file (tab-delimited path and checksum)
+
+    Returns:
+        (dict): The checksum for each relative path
+    """
+
+    manifest={}
+    with open(file) as file_handle:
+        for line in file_handle:
+            if line.startswith("#") or not line.strip():
+                continue
+            path, checksum = line.rstrip("\n").split("\t")[0:2]
+            manifest[path]=checksum
+
+    return manifest
+
+def write_manifest(manifest, file):
+    """ Write a database manifest of relative paths and checksums
+
+    Args:
+        manifest (dict): The checksum for each relative path
+        file (string): The manifest file to write
+    """
+
+    if os.path.dirname(file):
+        create_folders(os.path.dirname(file))
+    with open(file,"w") as file_handle:
+        file_handle.write("# path\tmd5\n")
+        for path in sorted(manifest.keys()):
+            file_handle.write(path+"\t"+manifest[path]+"\n")
+
+def link_file(source, destination):
+    """ Provision a file by hardlink, reflink, or as a last resort copy.
+        Hardlinks and reflinks share the same data blocks (and page cache)
+        with the source so large database files are only stored once.
+
+    Args:
+        source (string): The existing file
+        destination (string): The new file to create (replaced if it exists)
+
+    Returns:
+        (string): The method used (hardlink, reflink, or copy)
+    """
+
+    import shutil
+    import subprocess
+
+    if os.path.dirname(destination):
+        create_folders(os.path.dirname(destination))
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    try:
+        os.link(source, destination)
+        return "hardlink"
+    except (OSError, AttributeError):
+        pass
+
+    # hardlinks can fail on the same filesystem (eg at the link limit), try a copy-on-write clone
+    # (which also requires the same filesystem, so files across filesystems are copied)
+    try:
+        with open(os.devnull,"w") as devnull:
+            subprocess.check_call(["cp","--reflink=always",source,destination],
+                stdout=devnull, stderr=devnull)
+        return "reflink"
+    except (subprocess.CalledProcessError, EnvironmentError):
+        if os.path.exists(destination):
+            os.remove(destination)
+
+    shutil.copy2(source, destination)
+    return "copy"
+
+def parse_files(parse_function, files, cache_file=None, threads=1):
+    """ Parse files in parallel, reusing the results cached for the files
+        that have not changed (by size and modification time) since the
+        last time they were parsed.
+
+    Args:
+        parse_function (function): A module level function to parse a file,
+            the result must be json serializable
+        files (list): The paths to the files to parse
+        cache_file (string): The json file of results from prior runs (optional)
+        threads (int): The number of processes to parse the files
+
+    Returns:
+        (list): The result for each file
+    """
+
+    import json
+
+    cache={}
+    if cache_file and os.path.isfile(cache_file):
+        try:
+            with open(cache_file) as file_handle:
+                cache=json.load(file_handle)
+        except (EnvironmentError, ValueError):
+            cache={}
+
+    signatures={}
+    for file in files:
+        stat=os.stat(file)
+        signatures[file]=[stat.st_size, repr(stat.st_mtime)]
+
+    new_files=[file for file in files if not (file in cache and cache[file][0] == signatures[file])]
+    if threads > 1 and len(new_files) > 1:
+        import multiprocessing
+        pool=multiprocessing.Pool(min(threads, len(new_files)))
+        try:
+            results=pool.map(parse_function, new_files, chunksize=max(1, len(new_files)//(threads*4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results=[parse_function(file) for file in new_files]
+
+    for file, result in zip(new_files, results):
+        cache[file]=[signatures[file], result]
+
+    # only keep the results for the current files in the cache
+    if cache_file:
+        try:
+            with open(cache_file+".tmp","w") as file_handle:
+                json.dump(dict((file, cache[file]) for file in files), file_handle)
+            os.rename(cache_file+".tmp", cache_file)
+        except EnvironmentError:
+            print("Warning: Unable to write cache file: " + cache_file)
+
+    return [cache[file][1] for file in files]
+
 def try_log10(value):
     """ Try to convert value to log10 """
     
@@ -1629,6 +1836,102 @@ def order_clade_list(task,clade_list,abundance_file,output_file):
                 file_handle.write(taxon+"\n")
     
 
+def read_clade_markers(pkl_file, clades):
+    """ Read the names of the markers for each clade from the MetaPhlAn2 database
+    
+    Args:
+        pkl_file (string): The path to the MetaPhlAn2 database (bz2 compressed pickle).
+        clades (list): The clades to find markers for.
+        
+    Requires:
+        none
+        
+    Returns:
+        (dict): The clade for each marker (only for the clades provided)
+    """
+    
+    import bz2
+    import pickle
+    
+    clades=set(clades)
+    with bz2.BZ2File(pkl_file) as file_handle:
+        try:
+            # the database is written with python2
+            database=pickle.load(file_handle, encoding="latin1")
+        except TypeError:
+            database=pickle.load(file_handle)
+    
+    return dict((marker, info["clade"]) for marker, info in database["markers"].items() if info["clade"] in clades)
+
+def extract_clade_markers(pkl_file, markers_file, clade_files):
+    """ Extract the marker sequences for a set of clades in one pass over the markers file
+    
+    The marker files for each clade are written the same as with the StrainPhlAn
+    extract_markers.py script. Each file is written to a temp file first and then
+    renamed so partial files are not left in the output location.
+    
+    Args:
+        pkl_file (string): The path to the MetaPhlAn2 database (bz2 compressed pickle).
+        markers_file (string): The fasta file of all markers.
+        clade_files (dict): The file to write for each clade.
+        
+    Requires:
+        none
+        
+    Returns:
+        (dict): The number of markers written for each clade
+    """
+    
+    import tempfile
+    
+    marker_clades=read_clade_markers(pkl_file, clade_files.keys())
+    
+    # write unique temp files in the same folders so concurrent runs do not share partial files
+    temp_files={}
+    file_handles={}
+    for clade, file in clade_files.items():
+        file_descriptor, temp_files[clade]=tempfile.mkstemp(prefix=os.path.basename(file)+".",
+            suffix=".tmp", dir=os.path.dirname(os.path.abspath(file)))
+        file_handles[clade]=os.fdopen(file_descriptor,"w")
+    counts=dict((clade, 0) for clade in clade_files)
+    
+    def write_sequence(clade, header, sequence):
+        sequence="".join(sequence)
+        file_handles[clade].write(header+"\n")
+        for i in range(0, len(sequence), 60):
+            file_handles[clade].write(sequence[i:i+60]+"\n")
+        counts[clade]+=1
+    
+    try:
+        clade=None
+        header=""
+        sequence=[]
+        with open(markers_file) as file_handle:
+            for line in file_handle:
+                if line.startswith(">"):
+                    if clade:
+                        write_sequence(clade, header, sequence)
+                    header=line.rstrip()
+                    sequence=[]
+                    clade=marker_clades.get(header[1:].split(" ")[0].split("\t")[0])
+                elif clade:
+                    sequence.append(line.strip())
+            if clade:
+                write_sequence(clade, header, sequence)
+    except Exception:
+        for clade, file_handle in file_handles.items():
+            file_handle.close()
+            os.remove(temp_files[clade])
+        raise
+    
+    for clade, file in clade_files.items():
+        file_handles[clade].close()
+        # mkstemp creates the file readable only by the owner
+        os.chmod(temp_files[clade], 0o644)
+        os.rename(temp_files[clade], file)
+        
+    return counts
+
 def sort_fastq_file(task):
     """Sorts a FASTQ file by name (sequence identifier contents).
 
@@ -1641,6 +1944,8 @@ def sort_fastq_file(task):
     Returns:
         None
     """
+    from anadama2.tracked import TrackedDirectory
+
     sample_name = os.path.basename(task.depends[0].name)
     output_dir = os.path.dirname(task.targets[0].name)
     temp_dir = os.path.join(output_dir, "%s.tmp" % sample_name)
@@ -1679,6 +1984,8 @@ def extract_orphan_reads(task):
     Returns:
         None
     """
+    from anadama2.tracked import TrackedDirectory
+
     sample_name = os.path.basename(os.path.dirname(task.depends[0].name))
     orphans_dir = os.path.dirname(task.targets[0].name)
 
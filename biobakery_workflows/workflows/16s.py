@@ -39,8 +39,8 @@ workflow = Workflow(version="0.1", description="A workflow for 16S sequencing da
 workflow_config = config.SixteenS()
 workflow.add_argument("method", desc="method to process 16s workflow", default="vsearch", choices=["usearch","dada2","vsearch","its"])
 workflow.add_argument("dada-db", desc="reference database for dada2 workflow", default="silva", choices=["gg","rdp","silva","unite"])
-workflow.add_argument("usearch-db", desc="full paths for the reference databases (fna and taxonomy, comma delimited) for the usearch workflow",
-    default=",".join([workflow_config.greengenes_fasta,workflow_config.greengenes_taxonomy]))
+workflow.add_argument("usearch-db", desc="full paths for the reference databases (fna and taxonomy, comma delimited) for the usearch workflow [DEFAULT: the installed GreenGenes databases]",
+    default="")
 workflow.add_argument("bypass-functional-profiling", desc="bypass the functional profiling tasks", action="store_true")
 workflow.add_argument("barcode-file", desc="the barcode file", default="")
 workflow.add_argument("dual-barcode-file", desc="the string to identify the dual barcode file", default="")
@@ -60,10 +60,27 @@ workflow.add_argument("maxmismatch", desc="the max mismatch required to merge pa
 workflow.add_argument("percent-identity", desc="the percent identity to use for alignments", default=0.97)
 workflow.add_argument("bypass-msa", desc="bypass running multiple sequence alignment and tree generation", action="store_true")
 workflow.add_argument("picrust-version", desc="the picrust version to use", default="1")
+workflow.add_argument("error-model", desc="the forward and reverse error rates (rds files, comma delimited) to use for the dada2 workflow instead of learning the error rates")
+workflow.add_argument("error-model-cache", desc="the folder to cache the error rates learned for the dada2 workflow (reused for filtered reads from the same sequencing run)")
+workflow.add_argument("alignment-shards", desc="the number of gridable tasks to split each global alignment into for the usearch/vsearch workflow", type=int, default=1)
+workflow.add_argument("alignment-cache", desc="the folder to cache the alignments of the otus to the reference database for the usearch/vsearch workflow (only new otus are aligned)")
+workflow.add_argument("msa-reference", desc="a reference alignment (fasta) to align large sets of sequences to in chunks\n(default: an alignment of the most abundant sequences)")
+workflow.add_argument("msa-chunks", desc="the number of gridable tasks to align large sets of sequences to the reference alignment", type=int, default=10)
+workflow.add_argument("taxonomy-chunks", desc="the number of gridable tasks to assign taxonomy for the dada2 workflow", type=int, default=1)
+workflow.add_argument("taxonomy-cache", desc="the folder to cache the taxonomy assigned to each sequence for the dada2 workflow (only new sequences are assigned)")
+workflow.add_argument("scatter-samples", desc="run the dada2 sample inference and merge step as a gridable task for each sample\n(or filter and dereplicate each sample for the usearch/vsearch workflow)", action="store_true")
 
 # get the arguments from the command line
 args = workflow.parse_args()
 
+# only resolve the default usearch databases if they are needed for the method selected
+if not args.usearch_db and args.method in ["usearch","vsearch"]:
+    workflow_config.validate_all(["greengenes_fasta","greengenes_taxonomy"])
+    args.usearch_db = ",".join([workflow_config.greengenes_fasta,workflow_config.greengenes_taxonomy])
+
+# use the full path to the reference alignment (if provided)
+msa_reference = os.path.abspath(args.msa_reference) if args.msa_reference else None
+
 # get all input files with the input extension provided on the command line
 # return an error if no files are found
 input_files = utilities.find_files(args.input, extension=args.input_extension, exit_if_not_found=True)
@@ -98,6 +115,7 @@ else:
     demultiplex_output_folder=args.input
 
 if args.method == "dada2" or args.method == "its":
+    input_depends=None
 
     # if its workflow remove primers first and set reference db to 'unite'
     if args.method == "its":
@@ -106,26 +124,45 @@ if args.method == "dada2" or args.method == "its":
 
         if not args.bypass_primers_removal:
             if args.fwd_primer and args.rev_primer:
-                cutadapt_folder=dadatwo.remove_primers(
-                    workflow,args.fwd_primer,args.rev_primer,demultiplex_output_folder,args.output,args.pair_identifier,args.threads)
+                cutadapt_folder, cutadapt_files=dadatwo.remove_primers(
+                    workflow,args.fwd_primer,args.rev_primer,demultiplex_output_folder,args.output,args.pair_identifier,args.threads,
+                    demultiplexed_files)
                 demultiplex_output_folder=cutadapt_folder
+                input_depends=cutadapt_files
             else:
                 print("ITS workflow primers rmoval task requires fwd_primer and rev_primer arguments.")
                 exit()
 
+    # get the samples and their input files if running tasks for each sample
+    samples, sample_input_files = None, None
+    if args.scatter_samples:
+        samples = dadatwo.sample_names(demultiplexed_files, args.pair_identifier)
+        sample_input_files = [[os.path.join(demultiplex_output_folder,os.path.basename(file)) for file in pair]
+            for pair in dadatwo.paired_sample_files(demultiplexed_files, args.pair_identifier)]
+        # each sample only depends on its own files (with primers removed)
+        input_depends = None
+
     # call dada2 workflow tasks
     # filter reads and trim
     read_counts_file_path,  filtered_dir = dadatwo.filter_trim(
             workflow, demultiplex_output_folder,
-            args.output,args.maxee,args.trunc_len_max,args.pair_identifier,args.threads)
+            args.output,args.maxee,args.trunc_len_max,args.pair_identifier,args.threads,
+            samples, sample_input_files, input_depends)
     
-    # learn error rates
+    # learn error rates (or use those provided)
+    error_model = None
+    if args.error_model:
+        error_model = [os.path.abspath(file) for file in args.error_model.split(",")]
+        if len(error_model) != 2:
+            sys.exit("ERROR: Please provide the forward and reverse error rates files (comma delimited) with the option --error-model")
     error_ratesF_path, error_ratesR_path = dadatwo.learn_error(
-            workflow, args.output, filtered_dir, read_counts_file_path, args.threads)
+            workflow, args.output, filtered_dir, read_counts_file_path, args.threads, error_model, args.error_model_cache,
+            samples, args.input_extension)
     
-    # merge pairs
+    # merge pairs (for each sample if scattering samples)
     mergers_file_path = dadatwo.merge_paired_ends(
-            workflow, args.output, filtered_dir, error_ratesF_path, error_ratesR_path, args.threads, args.minoverlap, args.maxmismatch)
+            workflow, args.output, filtered_dir, error_ratesF_path, error_ratesR_path, args.threads, args.minoverlap, args.maxmismatch,
+            samples, args.input_extension)
 
     # construct otu
     seqtab_file_path,read_counts_steps_path, seqs_fasta_path = dadatwo.const_seq_table(
@@ -134,15 +171,17 @@ if args.method == "dada2" or args.method == "its":
     # centroid alignment
     centroid_fasta = files.SixteenS.path("msa_nonchimera", args.output)
     sixteen_s.centroid_alignment(workflow,
-            seqs_fasta_path, centroid_fasta, args.threads, task_name="clustalo_nonchimera")
+            seqs_fasta_path, centroid_fasta, args.threads, task_name="clustalo_nonchimera",
+            reference_alignment=msa_reference, chunks=args.msa_chunks)
 
     # phylogenetic tree
     closed_tree = utilities.name_files("closed_reference.tre", args.output)
-    sixteen_s.create_tree(workflow, centroid_fasta, closed_tree)
+    sixteen_s.create_tree(workflow, centroid_fasta, closed_tree, args.threads)
 
     # assign taxonomy
     closed_reference_tsv = dadatwo.assign_taxonomy(
-            workflow, args.output, seqtab_file_path, args.dada_db, args.threads)
+            workflow, args.output, seqtab_file_path, args.dada_db, args.threads,
+            seqs_fasta_path, args.taxonomy_chunks, args.taxonomy_cache)
     
     # functional profiling
     # check for picrust1 as not an option with this workflow
@@ -155,12 +194,20 @@ if args.method == "dada2" or args.method == "its":
 else:
     # call vsearch or usearch workflow tasks
     #  merge pairs, if paired-end, then rename so sequence id matches sample name then merge to single fastq file
-    all_samples_fastq = sixteen_s.merge_samples_and_rename(
-    	       workflow, args.method, demultiplexed_files, args.input_extension, args.output, args.pair_identifier, args.threads)
-
+    #  (unless processing each sample)
 	# add quality control tasks: generate qc report, filter by maxee, and truncate
-    filtered_truncated_fasta, truncated_fasta, original_fasta = sixteen_s.quality_control(
-            workflow, args.method, all_samples_fastq, args.output, args.threads, args.maxee, args.trunc_len_max)
+    if args.scatter_samples:
+        # filter, truncate, and dereplicate each sample then combine the unique sequences
+        # (without merging the samples into a single fastq file)
+        sample_fastqs = sixteen_s.merge_pairs_and_rename(
+                workflow, args.method, demultiplexed_files, args.input_extension, args.output, args.pair_identifier, args.threads)
+        filtered_truncated_fasta, truncated_fasta, original_fasta = sixteen_s.quality_control_per_sample(
+                workflow, args.method, sample_fastqs, args.output, args.threads, args.maxee, args.trunc_len_max)
+    else:
+        all_samples_fastq = sixteen_s.merge_samples_and_rename(
+                workflow, args.method, demultiplexed_files, args.input_extension, args.output, args.pair_identifier, args.threads)
+        filtered_truncated_fasta, truncated_fasta, original_fasta = sixteen_s.quality_control(
+                workflow, args.method, all_samples_fastq, args.output, args.threads, args.maxee, args.trunc_len_max)
 
     # taxonomic profiling (pick otus and then align creating otu tables, closed and open reference)
     try:
@@ -171,7 +218,8 @@ else:
     closed_reference_tsv, closed_ref_fasta = sixteen_s.taxonomic_profile(
             workflow, args.method, filtered_truncated_fasta, truncated_fasta, original_fasta, args.output,
             args.threads, args.percent_identity, usearch_fna_db, usearch_fna_db,
-            usearch_taxon_tsv, args.min_size, args.bypass_msa)
+            usearch_taxon_tsv, args.min_size, args.bypass_msa, args.alignment_shards, args.alignment_cache,
+            dereplicated=args.scatter_samples, msa_reference=msa_reference, msa_chunks=args.msa_chunks)
 
     # functional profiling
     if not args.bypass_functional_profiling:
@@ -81,7 +81,8 @@ if not args.exclude_workflow_info:
 # for dada2/its workflow
 if os.path.isfile(files.SixteenS.path("error_ratesF", args.input, error_if_not_found=False)):
     method = "dada2"
-    if os.path.isdir(files.SixteenS.path("filtN", args.input, error_if_not_found=False)):
+    if os.path.isdir(files.SixteenS.path("filtN", args.input, error_if_not_found=False)) or \
+        os.path.isdir(files.SixteenS.path("primers", args.input, error_if_not_found=False)):
         method = "its"
     doc_title = method.upper() + " 16s Report"
     input_files = {
@@ -51,11 +51,15 @@ workflow.add_argument("threads", desc="number of threads/cores for each task to
 workflow.add_argument("pair-identifier", desc="the string to identify the first file in a pair", default=".R1")
 workflow.add_argument("interleaved", desc="indicates whether or not sequence files are interleaved", default=False, action="store_true")
 workflow.add_argument("bypass-quality-control", desc="do not run the quality control tasks", action="store_true")
-workflow.add_argument("contaminate-databases", desc="the path (or comma-delimited paths) to the contaminate\nreference databases for QC", 
-    default=",".join([workflow_config.kneaddata_db_human_genome]))
+workflow.add_argument("contaminate-databases", desc="the path (or comma-delimited paths) to the contaminate\nreference databases for QC [DEFAULT: the installed human genome database]", 
+    default="")
 workflow.add_argument("qc-options", desc="additional options when running the QC step", default="")
 workflow.add_argument("functional-profiling-options", desc="additional options when running the functional profiling step", default="")
 workflow.add_argument("remove-intermediate-output", desc="remove intermediate output files", action="store_true")
+workflow.add_argument("pipeline-samples", desc="run quality control, taxonomic and functional profiling as a chain of tasks per sample\nwith at most this many samples in progress at once (intermediate output is removed)", default=0, type=int)
+workflow.add_argument("incremental-tables", desc="keep the merged tables in column-chunked stores so only new samples are joined and counted", action="store_true")
+workflow.add_argument("compress-sam", desc="write the metaphlan2 sam files compressed and indexed by marker\nso strain profiling can read subsets of markers without a full scan", action="store_true")
+workflow.add_argument("in-process-tables", desc="regroup, normalize and merge the functional profiles in-process instead of running the humann2 table tools for each file", action="store_true")
 workflow.add_argument("bypass-functional-profiling", desc="do not run the functional profiling tasks", action="store_true")
 workflow.add_argument("bypass-strain-profiling", desc="do not run the strain profiling tasks (StrainPhlAn)", action="store_true")
 workflow.add_argument("run-strain-gene-profiling", desc="run the gene-based strain profiling tasks (PanPhlAn)", action="store_true")
@@ -69,6 +73,19 @@ workflow.add_argument("assembly-options", desc="additional options when running
 # get the arguments from the command line
 args = workflow.parse_args()
 
+# check all of the databases required for the selected steps are installed
+required_databases=[]
+if not args.bypass_quality_control and not args.contaminate_databases and not "fasta" in args.input_extension:
+    required_databases.append("kneaddata_db_human_genome")
+if not args.bypass_strain_profiling and not args.bypass_taxonomic_profiling:
+    required_databases+=["strainphlan_db_reference","strainphlan_db_markers"]
+if args.run_strain_gene_profiling:
+    required_databases.append("panphlan_db")
+workflow_config.validate_all(required_databases)
+
+if not args.contaminate_databases and "kneaddata_db_human_genome" in required_databases:
+    args.contaminate_databases = workflow_config.kneaddata_db_human_genome
+
 # get all input files with the input extension provided on the command line
 # return an error if no files are found
 input_files = utilities.find_files(args.input, extension=args.input_extension, exit_if_not_found=True)
@@ -109,7 +126,20 @@ else:
 
 ### STEP #1: Run quality control on all input files ###
 original_extension = args.input_extension
-if args.bypass_quality_control:
+run_sample_pipeline = args.pipeline_samples > 0 and not args.bypass_quality_control and not "fasta" in args.input_extension
+if args.pipeline_samples > 0 and not run_sample_pipeline:
+    print("Warning: Quality control is not run for this input so samples will not be run as a chain of tasks per sample.")
+
+if run_sample_pipeline:
+    # run quality control, taxonomic profiling, and functional profiling one sample at a time
+    qc_output_files, filtered_read_counts, taxonomy_tsv_files, taxonomy_sam_files = shotgun.sample_pipeline(workflow,
+        demultiplexed_files, args.input_extension, args.output, args.threads, args.pipeline_samples, args.contaminate_databases,
+        args.pair_identifier, args.qc_options, not args.bypass_taxonomic_profiling, not args.bypass_functional_profiling,
+        args.functional_profiling_options, args.compress_sam)
+    args.input_extension = args.input_extension.replace(".gz","")
+    args.input_extension = args.input_extension.replace(".bz2","")
+    
+elif args.bypass_quality_control:
     # merge files if they are paired
     qc_output_files, args.input_extension = shotgun.merge_pairs(workflow,
         demultiplexed_files, args.input_extension, args.pair_identifier, args.output)
@@ -126,11 +156,16 @@ else:
     qc_output_files = demultiplexed_files
 
 ### STEP #2: Run taxonomic profiling on all of the filtered files ###
-if not args.bypass_taxonomic_profiling:
+if run_sample_pipeline and not args.bypass_taxonomic_profiling:
+    # metaphlan2 has already been run for each sample, merge the profiles
+    merged_taxonomic_profile = shotgun.taxonomic_profile(workflow,
+        taxonomy_tsv_files,args.output,args.threads,"tsv",already_profiled=True,incremental=args.incremental_tables)[0]
+
+elif not args.bypass_taxonomic_profiling:
     merged_taxonomic_profile, taxonomy_tsv_files, taxonomy_sam_files = shotgun.taxonomic_profile(workflow,
-        qc_output_files,args.output,args.threads,args.input_extension)
+        qc_output_files,args.output,args.threads,args.input_extension,incremental=args.incremental_tables,compress_sam=args.compress_sam)
 
-elif not args.bypass_functional_profiling or not args.bypass_strain_profiling:
+elif not run_sample_pipeline and (not args.bypass_functional_profiling or not args.bypass_strain_profiling):
     # get the names of the taxonomic profiling files allowing for pairs
     input_pair1, input_pair2 = utilities.paired_files(demultiplexed_files, original_extension, args.pair_identifier)
     sample_names = utilities.sample_names(input_pair1 if input_pair1 else input_files,original_extension,args.pair_identifier)
@@ -140,9 +175,11 @@ elif not args.bypass_functional_profiling or not args.bypass_strain_profiling:
         sys.exit("ERROR: Bypassing taxonomic profiling but all of the tsv taxonomy profile files are not found in the input folder. Expecting the following input files:\n"+"\n".join(tsv_profiles))
     # run taxonomic profile steps bypassing metaphlan2
     merged_taxonomic_profile, taxonomy_tsv_files, taxonomy_sam_files = shotgun.taxonomic_profile(workflow,
-        tsv_profiles,args.output,args.threads,"tsv",already_profiled=True)
+        tsv_profiles,args.output,args.threads,"tsv",already_profiled=True,incremental=args.incremental_tables)
     # look for the sam profiles
     taxonomy_sam_files = utilities.name_files(sample_names, demultiplex_output_folder, tag="bowtie2", extension="sam")
+    if args.compress_sam:
+        taxonomy_sam_files = [file+shotgun.COMPRESSED_SAM_EXTENSION for file in taxonomy_sam_files]
     # if they do not all exist, then bypass strain profiling if not already set
     if not args.bypass_strain_profiling:
         if len(taxonomy_sam_files) != len(list(filter(os.path.isfile,taxonomy_sam_files))):
@@ -153,7 +190,8 @@ elif not args.bypass_functional_profiling or not args.bypass_strain_profiling:
 if not args.bypass_functional_profiling:
     genes_relab, ecs_relab, path_relab, genes, ecs, path = shotgun.functional_profile(workflow,
         qc_output_files,args.input_extension,args.output,args.threads,taxonomy_tsv_files,args.remove_intermediate_output,
-        args.functional_profiling_options)
+        args.functional_profiling_options,already_profiled=run_sample_pipeline,incremental=args.incremental_tables,
+        in_process=args.in_process_tables)
 
 ### STEP #4: Run strain profiling
 # Provide taxonomic profiling output so top strains by abundance will be selected
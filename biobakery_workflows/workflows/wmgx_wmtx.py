@@ -52,10 +52,17 @@ workflow.add_argument("bypass-norm-ratio", desc="bypass the rna/dna normalizatio
 workflow.add_argument("qc-options", desc="additional options when running the QC step", default="")
 workflow.add_argument("remove-intermediate-output", desc="remove intermediate output files", action="store_true")
 workflow.add_argument("bypass-strain-profiling", desc="do not run the strain profiling tasks", action="store_true")
+workflow.add_argument("compress-sam", desc="write the metaphlan2 sam files compressed and indexed by marker\nso strain profiling can read subsets of markers without a full scan", action="store_true")
 
 # get the arguments from the command line
 args = workflow.parse_args()
 
+# check all of the databases required are installed
+required_databases=["kneaddata_db_human_genome","kneaddata_db_human_metatranscriptome","kneaddata_db_rrna"]
+if not args.bypass_strain_profiling:
+    required_databases+=["strainphlan_db_reference","strainphlan_db_markers"]
+workflow_config.validate_all(required_databases)
+
 # get all input files with the input extension provided on the command line
 input_files_metagenome = utilities.find_files(args.input_metagenome, extension=args.input_extension, exit_if_not_found=True)
 input_files_metatranscriptome = utilities.find_files(args.input_metatranscriptome, extension=args.input_extension, exit_if_not_found=True)
@@ -77,11 +84,11 @@ args.input_extension = args.input_extension.replace(".gz","")
 
 ### STEP #2: Run taxonomic profiling on all of the metagenome filtered files (and metatranscriptome if mapping not provided)###
 wms_taxonomic_profile, wms_taxonomy_tsv_files, wms_taxonomy_sam_files = shotgun.taxonomic_profile(workflow,
-    wms_qc_output_files,wms_output_folder,args.threads,args.input_extension)
+    wms_qc_output_files,wms_output_folder,args.threads,args.input_extension,compress_sam=args.compress_sam)
 
 if not args.input_mapping:
     wts_taxonomic_profile, wts_taxonomy_tsv_files, wts_taxonomy_sam_files = shotgun.taxonomic_profile(workflow,
-        wts_qc_output_files,wts_output_folder,args.threads,args.input_extension)   
+        wts_qc_output_files,wts_output_folder,args.threads,args.input_extension,compress_sam=args.compress_sam)   
 
 ### STEP #3: Run functional profiling on all of the filtered files ###
 
@@ -0,0 +1,3 @@
+H	0	14	100.0	+	0	0	14M	asv1	1111
+N	*	*	*	.	*	*	*	asv2	*
+H	1	10	98.0	+	0	0	10M	asv3	2222
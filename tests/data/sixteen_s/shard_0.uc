@@ -0,0 +1,2 @@
+H	0	250	99.2	+	0	0	250M	asv1;size=10	1111
+N	*	*	*	.	*	*	*	asv2;size=5	*
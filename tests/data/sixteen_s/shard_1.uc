@@ -0,0 +1 @@
+H	1	250	98.0	+	0	0	250M	asv3;size=2	2222
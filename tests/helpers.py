@@ -0,0 +1,100 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+import anadama2.util
+
+class Target(object):
+    """ A task target or depend (with a name like the anadama2 tracked files) """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+class Task(object):
+    """ A task with depends and targets (like an anadama2 task) """
+
+    def __init__(self, depends=None, targets=None, name=None, gridable=False):
+        self.depends = [depend if hasattr(depend, "name") else Target(depend) for depend in depends or []]
+        self.targets = [target if hasattr(target, "name") else Target(target) for target in targets or []]
+        self.name = name
+        self.gridable = gridable
+
+    def depend_names(self):
+        """ Get the names of the depends (or the names of the tasks for task depends) """
+
+        return [depend.name for depend in self.depends]
+
+    def target_names(self):
+        """ Get the names of the targets """
+
+        return [target.name for target in self.targets]
+
+class Workflow(object):
+    """ A workflow that records the tasks added (like an anadama2 workflow without running the tasks) """
+
+    def __init__(self):
+        self.tasks = []
+
+    def add_task(self, actions=None, depends=None, targets=None, name=None, **kwargs):
+        return self.add(depends, targets, name, False)
+
+    def add_task_gridable(self, actions=None, depends=None, targets=None, name=None, **kwargs):
+        return self.add(depends, targets, name, True)
+
+    def add(self, depends, targets, name, gridable):
+        """ Record the task (with a single depend or target as a list) """
+
+        as_list = lambda files: files if isinstance(files, list) else [files] if files else []
+        self.tasks.append(Task(as_list(depends), as_list(targets), name, gridable))
+        return self.tasks[-1]
+
+    def task(self, name):
+        """ Get the task with the name """
+
+        return [task for task in self.tasks if task.name == name][0]
+
+class TaskTestCase(unittest.TestCase):
+    """ Run each test with a temp folder for the input and output files """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="biobakery_workflows_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_file(self, name, lines):
+        """ Write the lines to a file in the temp folder """
+
+        file = os.path.join(self.folder, name)
+        with open(file, "w") as file_handle:
+            file_handle.write("".join(line + "\n" for line in lines))
+        return file
+
+    def read_lines(self, file):
+        """ Read the lines from a file without the new line """
+
+        with open(file) as file_handle:
+            return [line.rstrip("\n") for line in file_handle]
+
+    def temp_files(self, name, total):
+        """ Get a set of files in the temp folder """
+
+        return [os.path.join(self.folder, name.format(i)) for i in range(total)]
+
+    def track_executables(self, executables):
+        """ Write empty executables to the temp folder and add the folder to the path so
+            the executables can be tracked (clearing the path anadama2 has cached) """
+
+        for executable in executables:
+            os.chmod(self.write_file(executable, ["#!/bin/sh"]), 0o755)
+
+        def set_path(path):
+            os.environ["PATH"] = path
+            anadama2.util._PATH_list = None
+
+        self.addCleanup(set_path, os.environ["PATH"])
+        set_path(self.folder + os.pathsep + os.environ["PATH"])
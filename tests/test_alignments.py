@@ -0,0 +1,50 @@
+import unittest
+import tempfile
+import shutil
+import gzip
+import os
+
+from biobakery_workflows import alignments
+
+class TestAlignmentsFunctions(unittest.TestCase):
+    """ Test the functions found in the biobakery workflows alignments module """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="biobakery_workflows_test")
+        self.header = ["@HD\tVN:1.0\n", "@SQ\tSN:m1\tLN:100\n"]
+        self.lines = []
+        for i in range(200):
+            self.lines.append("\t".join(["read"+str(i), "0", "m"+str(i % 7), "1", "42", "10M", "*", "0", "0", "ACGTACGTAC", "IIIIIIIIII"])+"\n")
+        self.sam = os.path.join(self.folder, "s1_bowtie2.sam")
+        with open(self.sam, "w") as file_handle:
+            file_handle.writelines(self.header+self.lines)
+        self.compressed_sam = self.sam+alignments.COMPRESSED_SAM_EXTENSION
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_compress_sam_readable_with_gzip(self):
+        """ Test the compressed sam file can be read with gzip, sorted by reference in input order """
+
+        alignments.compress_sam(self.sam, self.compressed_sam, block_size=500, max_sort_lines=30)
+
+        with gzip.open(self.compressed_sam) as file_handle:
+            lines = [line.decode("utf-8") for line in file_handle]
+
+        expected = self.header + sorted(self.lines, key=lambda line: (line.split("\t")[2], int(line.split("\t")[0][4:])))
+        self.assertEqual(lines, expected)
+        self.assertEqual(sorted(os.listdir(self.folder)), ["s1_bowtie2.sam", "s1_bowtie2.sam.gz", "s1_bowtie2.sam.gz.idx"])
+
+    def test_read_sam_lines_references(self):
+        """ Test reading the alignments for a subset of references only reads their blocks """
+
+        alignments.compress_sam(self.sam, self.compressed_sam, block_size=500)
+        blocks, index = alignments.read_index(self.compressed_sam)
+
+        lines = list(alignments.read_sam_lines(self.compressed_sam, references=["m3"]))
+        self.assertEqual(lines, [line for line in self.lines if line.split("\t")[2] == "m3"])
+        self.assertTrue(index["m3"][1] - index["m3"][0] + 1 < len(blocks) / 2)
+
+        # the same alignments are read from the uncompressed file
+        self.assertEqual(list(alignments.read_sam_lines(self.sam, references=["m3"])), lines)
+        self.assertEqual(sorted(alignments.references(self.compressed_sam)), ["m"+str(i) for i in range(7)])
@@ -0,0 +1,58 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from biobakery_workflows import config
+
+class TestConfigFunctions(unittest.TestCase):
+    """ Test the functions found in the biobakery workflows config module """
+
+    def setUp(self):
+        self.environment = dict(os.environ)
+        self.folder = tempfile.mkdtemp(prefix="biobakery_workflows_test")
+        os.environ[config.Workflow.base_environment_variable] = self.folder
+        config.clear_database_locations()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environment)
+        shutil.rmtree(self.folder)
+        config.clear_database_locations()
+
+    def test_database_location_memoized(self):
+        """ Test the database location is only searched for once per process """
+
+        os.makedirs(os.path.join(self.folder,"panphlan_db"))
+        workflow_config = config.ShotGun()
+        location = workflow_config.panphlan_db
+
+        # the location found is reused even if the environment changes
+        os.environ["PANPHLAN_DB"] = self.folder
+        self.assertEqual(workflow_config.panphlan_db, location)
+        self.assertEqual(location, os.path.join(self.folder,"panphlan_db"))
+
+    def test_validate_all_reports_all_missing(self):
+        """ Test validate all reports all of the missing databases together """
+
+        os.makedirs(os.path.join(self.folder,"panphlan_db"))
+        workflow_config = config.ShotGun()
+
+        with self.assertRaises(SystemExit) as context:
+            workflow_config.validate_all(["panphlan_db","strainphlan_db_markers","kneaddata_db_rrna"])
+
+        message = str(context.exception)
+        self.assertIn("STRAINPHLAN_DB_MARKERS", message)
+        self.assertIn("KNEADDATA_DB_RIBOSOMAL_RNA", message)
+        self.assertNotIn("PANPHLAN_DB", message)
+
+    def test_validate_all_empty_list(self):
+        """ Test validate all with an empty list of databases does not check any databases """
+
+        workflow_config = config.ShotGun()
+
+        self.assertEqual(workflow_config.validate_all([]), None)
+
+        # without a list of databases all of the databases are checked
+        with self.assertRaises(SystemExit):
+            workflow_config.validate_all()
@@ -0,0 +1,223 @@
+import gzip
+import os
+
+from biobakery_workflows.tasks import dadatwo
+from tests.helpers import Task, Workflow, TaskTestCase
+
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "sixteen_s")
+
+class TestDadatwoTasks(TaskTestCase):
+    """ Test the functions found in the biobakery workflows dadatwo tasks module """
+
+    def setUp(self):
+        super(TestDadatwoTasks, self).setUp()
+        self.sequences = os.path.join(DATA_FOLDER, "sequences.fasta")
+        self.refdb = self.write_file("refdb.fa.gz", [">ref1", "ACGT"])
+        # use a fixed dada2 version so the tests do not require R
+        self.dada2_version = dadatwo.dada2_version
+        dadatwo.dada2_version = lambda: "1.14.0"
+
+    def tearDown(self):
+        dadatwo.dada2_version = self.dada2_version
+        super(TestDadatwoTasks, self).tearDown()
+
+    def chunk_files(self, total):
+        """ Get the fasta and taxonomy file for each chunk """
+
+        return [os.path.join(self.folder, "chunk_"+str(i)+".fasta") for i in range(total)], \
+            [os.path.join(self.folder, "chunk_"+str(i)+"_taxonomy.tsv") for i in range(total)]
+
+    def test_taxonomy_cache_file(self):
+        """ Test the taxonomy cache is keyed on the contents of the reference database """
+
+        cache_file = dadatwo.taxonomy_cache_file(self.folder, self.refdb, "None")
+        self.assertEqual(dadatwo.taxonomy_cache_file(self.folder, self.refdb, "None"), cache_file)
+
+        self.write_file("refdb.fa.gz", [">ref1", "ACGA"])
+        self.assertNotEqual(dadatwo.taxonomy_cache_file(self.folder, self.refdb, "None"), cache_file)
+
+    def test_split_sequences(self):
+        """ Test the sequences are split into chunks (with empty chunks if there are too few sequences) """
+
+        chunk_fastas, chunk_taxonomy = self.chunk_files(4)
+        dadatwo.split_sequences(Task([self.sequences], chunk_fastas), self.refdb, "None")
+
+        self.assertEqual(self.read_lines(chunk_fastas[0]), [">asv1", "ACGTACGTAACCGG"])
+        self.assertEqual(self.read_lines(chunk_fastas[1]), [">asv2", "TTGCATTGCA"])
+        self.assertEqual(self.read_lines(chunk_fastas[2]), [">asv3", "GGGCCCAAAT"])
+        self.assertEqual(self.read_lines(chunk_fastas[3]), [])
+
+    def test_gather_taxonomy_cache(self):
+        """ Test the taxonomy is gathered from the chunks and the cache, and only the
+            sequences without taxonomy in the cache are assigned on the next run """
+
+        cache_folder = os.path.join(self.folder, "cache")
+        chunk_fastas, chunk_taxonomy = self.chunk_files(2)
+        taxonomy = os.path.join(self.folder, "taxonomy.tsv")
+
+        self.write_file("chunk_0_taxonomy.tsv", ["\tKingdom\tPhylum",
+            "ACGTACGTAACCGG\tBacteria\tFirmicutes", "TTGCATTGCA\tBacteria\tNA"])
+        self.write_file("chunk_1_taxonomy.tsv", [])
+        dadatwo.gather_taxonomy(Task([self.sequences]+chunk_taxonomy, [taxonomy]), self.refdb, "None", cache_folder)
+
+        self.assertEqual(self.read_lines(taxonomy), ["\tKingdom\tPhylum",
+            "ACGTACGTAACCGG\tBacteria\tFirmicutes", "TTGCATTGCA\tBacteria\tNA", "GGGCCCAAAT"])
+
+        # the cached sequences are not split for assignment on the next run
+        dadatwo.split_sequences(Task([self.sequences], chunk_fastas), self.refdb, "None", cache_folder)
+        self.assertEqual(self.read_lines(chunk_fastas[0]), [">asv3", "GGGCCCAAAT"])
+        self.assertEqual(self.read_lines(chunk_fastas[1]), [])
+
+        self.write_file("chunk_0_taxonomy.tsv", ["\tKingdom\tPhylum", "GGGCCCAAAT\tArchaea\tNA"])
+        self.write_file("chunk_1_taxonomy.tsv", [])
+        dadatwo.gather_taxonomy(Task([self.sequences]+chunk_taxonomy, [taxonomy]), self.refdb, "None", cache_folder)
+
+        self.assertEqual(self.read_lines(taxonomy), ["\tKingdom\tPhylum",
+            "ACGTACGTAACCGG\tBacteria\tFirmicutes", "TTGCATTGCA\tBacteria\tNA", "GGGCCCAAAT\tArchaea\tNA"])
+
+    def test_reverse_complement(self):
+        """ Test the reverse complement allows for IUPAC ambiguity codes """
+
+        self.assertEqual(dadatwo.reverse_complement("ACGTn"), "NACGT")
+        self.assertEqual(dadatwo.reverse_complement("GTRYKMBVDH"), "DHBVKMRYAC")
+
+    def test_primer_hits(self):
+        """ Test the primer is found with ambiguity codes anywhere in the sequence """
+
+        sequences = ["TTACGTAA", "ACATAA", "GGGGGG", "AAACTTTT"]
+        self.assertEqual(dadatwo.primer_hits("ACRT", sequences), 2)
+        self.assertEqual(dadatwo.primer_hits("ACNT", sequences), 3)
+        self.assertEqual(dadatwo.primer_hits("GGGGGGG", sequences), 0)
+
+    def test_identify_primers(self):
+        """ Test the primers are written in the orientation found in the most reads,
+            reading the sequences (without Ns) from compressed fastq files """
+
+        fwd_primer, rev_primer = "GTGYCAG", "GGACTAC"
+        fwd_reads = os.path.join(self.folder, "sample_R1.fastq.gz")
+        rev_reads = os.path.join(self.folder, "sample_R2.fastq.gz")
+        # the forward primer is found as is, the reverse primer as the reverse complement
+        for file, sequences in [(fwd_reads, ["AAGTGCCAGTT", "GTGTCAGAAA", "CCCCNGTGCCAG"]),
+            (rev_reads, ["GTAGTCCAA", "TTGTAGTCC", "GGACTACAA"])]:
+            file_handle = gzip.open(file, "wb")
+            for i, sequence in enumerate(sequences):
+                file_handle.write(("@read"+str(i)+"\n"+sequence+"\n+\n"+"I"*len(sequence)+"\n").encode("utf-8"))
+            file_handle.close()
+        primer_files = [os.path.join(self.folder, name+".fasta") for name in ["fwd_primer", "fwd_primer_rc", "rev_primer", "rev_primer_rc"]]
+
+        dadatwo.identify_primers(Task([fwd_reads, rev_reads], primer_files), fwd_primer, rev_primer)
+
+        self.assertEqual([self.read_lines(file) for file in primer_files], [[">fwd_primer", "GTGYCAG"],
+            [">fwd_primer_rc", "CTGRCAC"], [">rev_primer", "GTAGTCC"], [">rev_primer_rc", "GGACTAC"]])
+
+    def write_fastq(self, name, reads):
+        """ Write the reads (id, sequence, and quality) to a compressed fastq file """
+
+        file = os.path.join(self.folder, name)
+        file_handle = gzip.open(file, "wb")
+        for read_id, sequence, quality in reads:
+            file_handle.write(("@"+read_id+"\n"+sequence+"\n+\n"+quality+"\n").encode("utf-8"))
+        file_handle.close()
+        return file
+
+    def test_error_rates_fingerprint(self):
+        """ Test the run ids and quality score counts are read from the first reads of each file,
+            without run ids if any read id is not an illumina read id """
+
+        sample1 = self.write_fastq("S1_F_filt.fastq.gz", [("M1:10:FC1:1:1:1:1 1:N:0:1", "ACGT", "IIII"),
+            ("M1:10:FC1:1:1:1:2 1:N:0:1", "ACGT", "II##"), ("M1:11:FC2:1:1:1:1 1:N:0:1", "ACGT", "####")])
+        sample2 = self.write_fastq("S2_F_filt.fastq.gz", [("M1:11:FC2:1:1:1:3", "AC", "I#")])
+
+        self.assertEqual(dadatwo.error_rates_fingerprint([sample1, sample2], reads=2), (["M1:10:FC1", "M1:11:FC2"], {73: 7, 35: 3}))
+
+        sample3 = self.write_fastq("S3_F_filt.fastq.gz", [("SRR1.1", "AC", "II")])
+        self.assertEqual(dadatwo.error_rates_fingerprint([sample1, sample3])[0], None)
+
+    def test_cached_error_rates(self):
+        """ Test the error rates are learned and cached, then reused for reads from the same
+            run with a similar distribution of quality scores but not for a different run """
+
+        cache_folder = os.path.join(self.folder, "cache")
+        filtered_folder = os.path.join(self.folder, "filtered")
+        os.makedirs(filtered_folder)
+        targets = [os.path.join(self.folder, name) for name in ["errF.png", "errR.png", "errF.rds", "errR.rds"]]
+        # the command writes the error rates with the options added when the cached error rates are used
+        command = "echo [args[0]] > [targets[3]] ; echo [vars[0]] > [targets[2]]"
+
+        def learn(run, qualities):
+            for direction in ["F", "R"]:
+                self.write_fastq(os.path.join("filtered", "S1_"+direction+"_filt.fastq.gz"),
+                    [("M1:"+run+":FC1:1:1:1:"+str(i), "ACGT", quality) for i, quality in enumerate(qualities)])
+            dadatwo.cached_error_rates(Task(targets=targets), command, ["R"], ["F"], cache_folder, filtered_folder)
+            return self.read_lines(targets[2])[0]
+
+        self.assertEqual(learn("10", ["IIII"]*39+["####"]), "F")
+        self.assertEqual(len(os.listdir(cache_folder)), 4)
+
+        # a similar distribution of quality scores from the same run uses the cache
+        cached = learn("10", ["IIII"]*20)
+        self.assertTrue(cached.startswith("F --error_ratesF_input="+cache_folder))
+        self.assertEqual(self.read_lines(cached.split("=")[1].split(" ")[0]), ["F"])
+
+        # a different distribution of quality scores or a different run learns the error rates
+        self.assertEqual(learn("10", ["####"]*20), "F")
+        self.assertEqual(learn("11", ["IIII"]*20), "F")
+        self.assertEqual(len(os.listdir(cache_folder)), 8)
+
+    def test_merge_paired_ends_samples(self):
+        """ Test the merge task for each sample depends on the error rates and the filtered reads for the
+            sample (or the read counts if the sample has no filtered reads) and the sequence table is
+            built from the merged reads for all samples """
+
+        self.track_executables(["R"])
+        os.makedirs(os.path.join(self.folder, "filtered_input"))
+        filtered = [self.write_file(os.path.join("filtered_input", "S1_"+read+"_filt.fastq.gz"), []) for read in ["F", "R"]]
+        read_counts = os.path.join(self.folder, "filter_read_counts", "{0}_F_filt_readcounts.tsv")
+        error_rates = [os.path.join(self.folder, "error_ratesFWD.rds"), os.path.join(self.folder, "error_ratesREV.rds")]
+
+        workflow = Workflow()
+        mergers = dadatwo.merge_paired_ends(workflow, self.folder, "filtered_input", error_rates[0], error_rates[1], 1, 12, 0,
+            samples=["S1", "S2"])
+        self.assertEqual(mergers, [os.path.join(self.folder, "mergers", sample+"_mergers.rds") for sample in ["S1", "S2"]])
+
+        merge_S1 = workflow.task("dereplicate_and_merge____S1")
+        self.assertTrue(merge_S1.gridable)
+        self.assertEqual(merge_S1.depend_names(), error_rates+[read_counts.format("S1")]+filtered)
+        self.assertEqual(merge_S1.target_names(), [mergers[0]])
+        merge_S2 = workflow.task("dereplicate_and_merge____S2")
+        self.assertEqual(merge_S2.depend_names(), error_rates+[read_counts.format("S2")])
+        self.assertEqual(merge_S2.target_names(), [mergers[1]])
+
+        dadatwo.const_seq_table(workflow, self.folder, "filtered_input", mergers, 1)
+        # the last depend is the R executable
+        self.assertEqual(workflow.task("construct_sequence_table").depend_names()[:-1],
+            mergers+[os.path.join(self.folder, "Read_counts_filt.rds")])
+
+    def test_filter_trim_samples(self):
+        """ Test the filter task for each sample depends on the input files for the sample, the read counts
+            are gathered from the read counts for each sample and the error rates are learned from the filtered reads """
+
+        input_files = [[self.write_file(sample+"_R"+read+".fastq.gz", []) for read in ["1", "2"]] for sample in ["S1", "S2"]]
+        read_counts = os.path.join(self.folder, "filter_read_counts", "{0}_F_filt_readcounts.{1}")
+
+        workflow = Workflow()
+        readcounts_tsv, filtered_dir = dadatwo.filter_trim(workflow, self.folder, self.folder, 2, 200, "_R1", 1,
+            samples=["S1", "S2"], input_files=input_files)
+
+        for sample, sample_input_files in zip(["S1", "S2"], input_files):
+            filter_task = workflow.task("filter_and_trim____"+sample)
+            self.assertTrue(filter_task.gridable)
+            self.assertEqual(filter_task.depend_names(), sample_input_files)
+            self.assertEqual(filter_task.target_names(), [read_counts.format(sample, "tsv"), read_counts.format(sample, "rds")])
+        self.assertEqual(workflow.task("gather_filter_read_counts").depend_names(),
+            [read_counts.format(sample, "rds") for sample in ["S1", "S2"]])
+        self.assertEqual(workflow.task("gather_filter_read_counts").target_names(),
+            [readcounts_tsv, os.path.join(self.folder, "Read_counts_filt.rds")])
+        self.assertEqual(workflow.task("quality_plots").depend_names(), input_files[0]+input_files[1])
+
+        # the first sample has filtered reads, the second sample has no reads after filtering
+        os.makedirs(os.path.join(self.folder, filtered_dir))
+        filtered = [self.write_file(os.path.join(filtered_dir, "S1_"+read+"_filt.fastq.gz"), []) for read in ["F", "R"]]
+        dadatwo.learn_error(workflow, self.folder, filtered_dir, readcounts_tsv, 1, samples=["S1", "S2"])
+        self.assertEqual(workflow.task("learn_error_rates").depend_names(),
+            [read_counts.format("S1", "tsv")]+filtered+[read_counts.format("S2", "tsv")])
@@ -0,0 +1,129 @@
+import unittest
+import subprocess
+import runpy
+import os
+import sys
+
+from biobakery_workflows import utilities
+from tests.helpers import TaskTestCase
+
+try:
+    import humann2
+    HUMANN2_INSTALLED = True
+except ImportError:
+    HUMANN2_INSTALLED = False
+
+PACKAGE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(utilities.__file__)))
+SCRIPTS_FOLDER = os.path.join(PACKAGE_FOLDER, "biobakery_workflows", "scripts")
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+def run_script(script, args):
+    """ Run the script in a new process with the package on the path """
+
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join([PACKAGE_FOLDER, environment.get("PYTHONPATH", "")])
+    return subprocess.check_output([sys.executable, os.path.join(SCRIPTS_FOLDER, script)] + args, env=environment)
+
+def load_script(script):
+    """ Load the functions from the script (keeping the globals they use) """
+
+    script_globals = {"__name__": os.path.splitext(script)[0]}
+    script_file = os.path.join(SCRIPTS_FOLDER, script)
+    with open(script_file) as file_handle:
+        exec(compile(file_handle.read(), script_file, "exec"), script_globals)
+    return script_globals
+
+def read_lines(file):
+    """ Read the lines from a file """
+
+    with open(file) as file_handle:
+        return file_handle.readlines()
+
+class TestScripts(TaskTestCase):
+    """ Test the scripts installed with the biobakery workflows """
+
+    def test_get_counts_from_kneaddata_logs(self):
+        """ Test the read count table matches the table written by kneaddata_read_count_table
+            for the same logs (also when the counts are read from the cache) """
+
+        output = os.path.join(self.folder, "read_counts.tsv")
+        expected = read_lines(os.path.join(DATA_FOLDER, "kneaddata_read_count_table.tsv"))
+        args = ["--input", os.path.join(DATA_FOLDER, "kneaddata_logs"), "--output", output, "--threads", "2"]
+
+        run_script("get_counts_from_kneaddata_logs.py", args)
+        self.assertEqual(read_lines(output), expected)
+
+        os.remove(output)
+        run_script("get_counts_from_kneaddata_logs.py", args)
+        self.assertEqual(read_lines(output), expected)
+
+    def test_kneaddata_header_order(self):
+        """ Test the read types are ordered by step with pairs before orphans """
+
+        script = runpy.run_path(os.path.join(SCRIPTS_FOLDER, "get_counts_from_kneaddata_logs.py"))
+        types = ["final orphan1", "final pair1", "decontaminated db orphan1", "decontaminated db pair1",
+            "trimmed orphan1", "trimmed pair2", "trimmed pair1", "raw pair1"]
+
+        self.assertEqual(script["header_order"](types), ["raw pair1", "trimmed pair1", "trimmed pair2",
+            "trimmed orphan1", "decontaminated db pair1", "decontaminated db orphan1", "final pair1", "final orphan1"])
+
+        self.assertEqual(script["header_order"](["final single", "raw single", "trimmed single"]),
+            ["raw single", "trimmed single", "final single"])
+
+    def test_compress_sam_decompress(self):
+        """ Test the decompressed sam file has the header and all of the alignments """
+
+        sam_lines = ["@HD\tVN:1.0\n", "r1\t0\tm2\t1\t42\n", "r2\t0\tm1\t1\t42\n", "r3\t0\tm2\t5\t42\n"]
+        sam_file = os.path.join(self.folder, "sample.sam")
+        with open(sam_file, "w") as file_handle:
+            file_handle.write("".join(sam_lines))
+
+        run_script("compress_sam.py", ["--input", sam_file, "--output", sam_file + ".gz"])
+        run_script("compress_sam.py", ["--decompress", "--input", sam_file + ".gz", "--output", sam_file + ".copy"])
+
+        lines = read_lines(sam_file + ".copy")
+        self.assertEqual(lines[0], sam_lines[0])
+        self.assertEqual(sorted(lines), sorted(sam_lines))
+
+    def test_create_otu_tables_read_counts(self):
+        """ Test the original read counts are the same from the fasta file or a table of counts """
+
+        script = load_script("create_otu_tables_from_alignments.py")
+        fasta_file = os.path.join(self.folder, "original.fasta")
+        with open(fasta_file, "w") as file_handle:
+            file_handle.write(">S1.1\nACGT\n>S1.2\nACGT\n>S2.1\nGG\n")
+        table = os.path.join(self.folder, "read_counts.tsv")
+        with open(table, "w") as file_handle:
+            file_handle.write("# sample\toriginal read count\nS1\t2\nS2\t1\n")
+
+        self.assertEqual(script["count_reads_per_sample"](fasta_file), {"S1": 2, "S2": 1})
+        self.assertEqual(script["count_reads_per_sample"](table), {"S1": 2, "S2": 1})
+
+    @unittest.skipUnless(HUMANN2_INSTALLED, "requires humann2")
+    def test_create_subsampled_demos(self):
+        """ Test each read aligned to the species selected is written once and the temp store
+            of reads is removed (also if the script fails after the store is created) """
+
+        references = ["g__Bacteroides.s__Bacteroides_dorei|UniRef90_A|UniRef50_A|100",
+            "g__Bacteroides.s__Bacteroides_dorei|UniRef90_B|UniRef50_B|100",
+            "g__Escherichia.s__Escherichia_coli|UniRef90_C|UniRef50_C|100"]
+        alignments = [("r1", 0, "ACGT"), ("r1", 1, "ACGT"), ("r2", 0, "GGCC"), ("r3", 2, "TTAA")]
+        sam_file = os.path.join(self.folder, "sample.sam")
+        with open(sam_file, "w") as file_handle:
+            for read, reference, sequence in alignments:
+                file_handle.write("\t".join([read, "0", references[reference], "1", "42", "4M", "*", "0", "0", sequence, "IIII"])+"\n")
+        selection = os.path.join(self.folder, "selection.tsv")
+        with open(selection, "w") as file_handle:
+            file_handle.write("s__Bacteroides_dorei\tALL\n")
+        output = os.path.join(self.folder, "demo.fasta")
+        args = ["--input-sam", sam_file, "--input-selection", selection, "--output", output]
+
+        run_script("create_subsampled_demos.py", args)
+        self.assertEqual(read_lines(output), [">r1\n", "ACGT\n", ">r2\n", "GGCC\n"])
+        self.assertEqual(sorted(os.listdir(self.folder)), ["demo.fasta", "sample.sam", "selection.tsv"])
+
+        # metaphlan2 does not write the marker alignments for the species reads
+        self.track_executables(["metaphlan2.py"])
+        self.assertRaises(subprocess.CalledProcessError, run_script, "create_subsampled_demos.py", args + ["--add-markers"])
+        self.assertEqual(sorted(os.listdir(self.folder)),
+            ["demo.fasta", "demo.fasta.species_specific_reads.fasta", "metaphlan2.py", "sample.sam", "selection.tsv"])
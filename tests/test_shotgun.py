@@ -0,0 +1,159 @@
+import time
+import os
+
+from biobakery_workflows.tasks import shotgun
+from tests.helpers import Task, Workflow, TaskTestCase
+
+class TestShotgunTasks(TaskTestCase):
+    """ Test the functions found in the biobakery workflows shotgun tasks module """
+
+    def write_abundance_file(self):
+        """ Write a merged taxonomic profile with three species """
+
+        return self.write_file("abundance.tsv", ["#SampleID\ts1\ts2",
+            "k__Bacteria\t100.0\t100.0",
+            "k__Bacteria|p__p1|c__c1|o__o1|f__f1|g__Escherichia|s__Escherichia_coli\t10.0\t20.0",
+            "k__Bacteria|p__p1|c__c1|o__o1|f__f1|g__Bacteroides|s__Bacteroides_dorei\t50.0\t60.0",
+            "k__Bacteria|p__p1|c__c1|o__o1|f__f1|g__Prevotella|s__Prevotella_copri\t30.0\t10.0"])
+
+    def test_strainphlan_clade_plan(self):
+        """ Test the plan has the clade and resources for each task, with minimal
+            resources for tasks past the end of the clade list """
+
+        clade_list = self.write_file("clades.txt", ["s__Bacteroides_dorei", "s__Escherichia_coli"])
+        marker_file = self.write_file("s__Bacteroides_dorei.markers.fasta", [">m1", "A"*(1024*1024-4)])
+        clade_markers = self.write_file("clade_markers.txt", ["s__Bacteroides_dorei\t"+marker_file,
+            "s__Escherichia_coli\t"+os.path.join(self.folder, "missing.fasta")])
+        plans = [os.path.join(self.folder, "clade_"+str(i)+".plan") for i in range(3)]
+
+        shotgun.strainphlan_clade_plan(Task(targets=plans), clade_list, clade_markers, total_samples=10)
+
+        # 4 GB plus 20 MB per sample for each MB of markers (or the default estimate if not extracted)
+        self.assertEqual(self.read_lines(plans[0]), ["s__Bacteroides_dorei\t360\t4296"])
+        self.assertEqual(self.read_lines(plans[1]), ["s__Escherichia_coli\t360\t4296"])
+        self.assertEqual(self.read_lines(plans[2]), ["\t5\t1024"])
+
+    def test_strainphlan_clade_resources_max_memory(self):
+        """ Test the memory for a clade is at most the max """
+
+        marker_file = self.write_file("markers.fasta", ["A"*(1024*1024)])
+
+        self.assertEqual(shotgun.strainphlan_clade_resources("s__Escherichia_coli", 10000, marker_file),
+            (shotgun.STRAINPHLAN_CLADE_TIME, shotgun.STRAINPHLAN_MAX_MEMORY))
+
+    def test_panphlan_species(self):
+        """ Test the species are ranked by average abundance, only including species
+            with a database (the latest version), and read back from the file of species """
+
+        panphlan_db = os.path.join(self.folder, "panphlan_db")
+        os.makedirs(panphlan_db)
+        for database in ["panphlan_ecoli14.1.bt2", "panphlan_ecoli16.1.bt2", "panphlan_ecoli16.rev.1.bt2",
+            "panphlan_pcopri16.1.bt2", "panphlan_pcopri16_pangenome.csv"]:
+            open(os.path.join(panphlan_db, database), "w").close()
+        species_file = os.path.join(self.folder, "panphlan_species.tsv")
+
+        self.assertEqual(shotgun.panphlan_databases(panphlan_db), ["ecoli14", "ecoli16", "pcopri16"])
+
+        shotgun.panphlan_species(Task(depends=[self.write_abundance_file()], targets=[species_file]), panphlan_db, 5)
+
+        self.assertEqual(self.read_lines(species_file), ["s__Prevotella_copri\tpcopri16", "s__Escherichia_coli\tecoli16"])
+        self.assertEqual(shotgun.read_panphlan_species(species_file), ["pcopri16", "ecoli16"])
+        self.assertEqual(shotgun.get_panphlan_species_name(species_file, 1), "ecoli16")
+        self.assertEqual(shotgun.get_panphlan_species_name(species_file, 2), None)
+
+        # only the top species are included
+        shotgun.panphlan_species(Task(depends=[self.write_abundance_file()], targets=[species_file]), panphlan_db, 1)
+        self.assertEqual(shotgun.read_panphlan_species(species_file), ["pcopri16"])
+
+    def test_strain_gene_profile_missing_database(self):
+        """ Test the workflow exits with a message if the panphlan database folder is missing or empty """
+
+        panphlan_db = os.path.join(self.folder, "panphlan_db")
+        for make_folder in [False, True]:
+            if make_folder:
+                os.makedirs(panphlan_db)
+            with self.assertRaises(SystemExit) as error:
+                shotgun.strain_gene_profile(Workflow(), [], self.write_abundance_file(), self.folder, 1, panphlan_db, 5)
+            self.assertTrue(str(error.exception.code).startswith("ERROR: Unable to find"))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, "panphlan")))
+
+    def test_ranked_list_size(self):
+        """ Test tasks are only added for the items in the ranked list if it is up to date """
+
+        abundance_file = self.write_abundance_file()
+        clade_list = os.path.join(self.folder, "clades_ordered.txt")
+
+        # the list has not been written
+        self.assertEqual(shotgun.ranked_list_size(clade_list, [abundance_file], shotgun.read_clade_list, 20), 20)
+
+        self.write_file("clades_ordered.txt", ["s__Bacteroides_dorei", "s__Escherichia_coli"])
+        os.utime(abundance_file, (time.time()-60, time.time()-60))
+        self.assertEqual(shotgun.ranked_list_size(clade_list, [abundance_file], shotgun.read_clade_list, 20), 2)
+        self.assertEqual(shotgun.ranked_list_size(clade_list, [abundance_file], shotgun.read_clade_list, 1), 1)
+
+        # the list will be written again as the input is newer (or missing)
+        os.utime(abundance_file, (time.time()+60, time.time()+60))
+        self.assertEqual(shotgun.ranked_list_size(clade_list, [abundance_file], shotgun.read_clade_list, 20), 20)
+        self.assertEqual(shotgun.ranked_list_size(clade_list, [os.path.join(self.folder, "missing.tsv")],
+            shotgun.read_clade_list, 20), 20)
+
+    def test_ranked_list_size_upstream(self):
+        """ Test tasks are added for the max items if a file upstream of the inputs of the ranked list
+            is newer than the list (so the list will be written again when the workflow runs) """
+
+        import anadama2
+
+        sample = self.write_file("sample.fastq", [])
+        profile = self.write_file("sample_profile.tsv", [])
+        abundance_file = self.write_abundance_file()
+        clade_list = self.write_file("clades_ordered.txt", ["s__Bacteroides_dorei", "s__Escherichia_coli"])
+        for file in [sample, profile, abundance_file]:
+            os.utime(file, (time.time()-60, time.time()-60))
+
+        workflow = anadama2.Workflow(cli=False)
+        profile_task = workflow.add_task(lambda task: None, depends=sample, targets=profile, name="profile")
+        workflow.add_task(lambda task: None, depends=profile_task, targets=abundance_file, name="merge")
+
+        self.assertEqual(shotgun.upstream_files(workflow, [abundance_file]), sorted([sample, profile, abundance_file]))
+        self.assertEqual(shotgun.ranked_list_size(clade_list, [abundance_file], shotgun.read_clade_list, 20, workflow), 2)
+
+        os.utime(sample, (time.time()+60, time.time()+60))
+        self.assertEqual(shotgun.ranked_list_size(clade_list, [abundance_file], shotgun.read_clade_list, 20), 2)
+        self.assertEqual(shotgun.ranked_list_size(clade_list, [abundance_file], shotgun.read_clade_list, 20, workflow), 20)
+
+    def test_strainphlan_marker_cache(self):
+        """ Test the marker cache folder is keyed on the contents of the database """
+
+        marker_folder = os.path.join(self.folder, "markers")
+        os.mkdir(marker_folder)
+        database = os.path.join(marker_folder, shotgun.STRAINPHLAN_DATABASE)
+        with open(database, "w") as file_handle:
+            file_handle.write("version1")
+
+        cache_folder = shotgun.strainphlan_marker_cache(marker_folder, self.folder)
+        self.assertEqual(os.path.dirname(os.path.dirname(cache_folder)), marker_folder)
+        self.assertEqual(shotgun.strainphlan_marker_cache(marker_folder, self.folder), cache_folder)
+
+        with open(database, "w") as file_handle:
+            file_handle.write("version2")
+        self.assertNotEqual(shotgun.strainphlan_marker_cache(marker_folder, self.folder), cache_folder)
+
+    def test_sample_pipeline_order(self):
+        """ Test kneaddata for each sample waits for the final task of the sample before it,
+            unless kneaddata has already been run for the sample """
+
+        import anadama2
+
+        self.track_executables(["kneaddata", "metaphlan2.py", "humann2"])
+
+        input_files = [self.write_file(sample+".fastq", []) for sample in ["A", "B", "C"]]
+        output_folder = os.path.join(self.folder, "output")
+        os.makedirs(os.path.join(output_folder, "kneaddata", "main"))
+        self.write_file(os.path.join("output", "kneaddata", "main", "B.fastq"), [])
+
+        workflow = anadama2.Workflow(cli=False)
+        shotgun.sample_pipeline(workflow, input_files, "fastq", output_folder, 1, 1)
+
+        waits_for = dict((task.name, [depend.name for depend in task.depends if hasattr(depend, "task_no")])
+            for task in workflow.tasks if task.name.startswith("kneaddata____"))
+        self.assertEqual(waits_for, {"kneaddata____A": [], "kneaddata____B": [], "kneaddata____C": ["humann2____B"]})
@@ -0,0 +1,198 @@
+import os
+
+from biobakery_workflows.tasks import sixteen_s
+from tests.helpers import Task, Workflow, TaskTestCase
+
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "sixteen_s")
+
+class TestSixteenSTasks(TaskTestCase):
+    """ Test the functions found in the biobakery workflows sixteen_s tasks module """
+
+    def setUp(self):
+        super(TestSixteenSTasks, self).setUp()
+        self.sequences = os.path.join(DATA_FOLDER, "sequences.fasta")
+
+    def test_split_fasta(self):
+        """ Test the sequences (with multiple lines) are split into shards """
+
+        shards = self.temp_files("shard_{0}.fasta", 2)
+        sixteen_s.split_fasta(Task([self.sequences], shards))
+
+        self.assertEqual(self.read_lines(shards[0]), [">asv1", "ACGTACGTAA", "CCGG", ">asv2", "TTGCATTGCA"])
+        self.assertEqual(self.read_lines(shards[1]), [">asv3", "GGGCCCAAAT"])
+
+    def test_split_fasta_min_sequences(self):
+        """ Test empty shards are written if there are fewer than the min sequences
+            or more shards than sequences """
+
+        shards = self.temp_files("shard_{0}.fasta", 2)
+        sixteen_s.split_fasta(Task([self.sequences], shards), min_sequences=4)
+        self.assertEqual([self.read_lines(shard) for shard in shards], [[], []])
+
+        shards = self.temp_files("shard_{0}.fasta", 4)
+        sixteen_s.split_fasta(Task([self.sequences], shards), min_sequences=3)
+        self.assertEqual([len(self.read_lines(shard)) for shard in shards], [3, 2, 2, 0])
+
+    def test_merge_alignments(self):
+        """ Test the uc files are concatenated and the otu table counts are summed for the
+            samples in all of the shards (skipping empty shards) """
+
+        shard_uc = [os.path.join(DATA_FOLDER, "shard_0.uc"), os.path.join(DATA_FOLDER, "shard_1.uc")]
+        shard_tsv = [os.path.join(DATA_FOLDER, "shard_0.tsv"), os.path.join(DATA_FOLDER, "shard_1.tsv")]
+        empty_uc = self.write_file("shard_2.uc", [])
+        empty_tsv = self.write_file("shard_2.tsv", [])
+        merged = [os.path.join(self.folder, "merged.uc"), os.path.join(self.folder, "merged.tsv")]
+
+        sixteen_s.merge_alignments(Task(shard_uc+[empty_uc]+shard_tsv+[empty_tsv], merged))
+
+        self.assertEqual(self.read_lines(merged[0]), self.read_lines(shard_uc[0])+self.read_lines(shard_uc[1]))
+        self.assertEqual(self.read_lines(merged[1]), ["#OTU ID\tS1\tS2\tS3", "1111\t4\t8\t3", "2222\t0\t1\t1"])
+
+    def test_merge_cached_alignments(self):
+        """ Test the uc file is the same as for an alignment of all of the sequences when none,
+            all, or some of the sequences are in the cache """
+
+        cache_folder = os.path.join(self.folder, "cache")
+        database = self.write_file("database.udb", ["database"])
+        full_uc = os.path.join(DATA_FOLDER, "sequences_reference.uc")
+        new_fasta = os.path.join(self.folder, "new_sequences.fasta")
+        new_uc = os.path.join(self.folder, "new_sequences.uc")
+        merged_uc = os.path.join(self.folder, "merged.uc")
+        options = {"method": "vsearch", "id": 0.97, "top_hit_only": True, "cache_folder": cache_folder}
+
+        def align(sequences, uc_lines):
+            sixteen_s.split_cached_alignments(Task([sequences, database], [new_fasta]), **options)
+            self.write_file("new_sequences.uc", uc_lines)
+            sixteen_s.merge_cached_alignments(Task([sequences, database, new_uc], [merged_uc]), **options)
+            return self.read_lines(new_fasta), self.read_lines(merged_uc)
+
+        # no sequences are cached so all are aligned
+        new_sequences, merged = align(self.sequences, self.read_lines(full_uc))
+        self.assertEqual(new_sequences, [">asv1", "ACGTACGTAACCGG", ">asv2", "TTGCATTGCA", ">asv3", "GGGCCCAAAT"])
+        self.assertEqual(merged, self.read_lines(full_uc))
+
+        # all sequences (including those without hits) are cached
+        new_sequences, merged = align(self.sequences, [])
+        self.assertEqual(new_sequences, [])
+        self.assertEqual(merged, self.read_lines(full_uc))
+
+        # a new sequence is aligned and the cached alignments use the ids for this run
+        sequences = self.write_file("sequences.fasta", [">otu1", "ACGTACGTAACCGG", ">otu4", "AAAATTTT", ">otu3", "gggcccaaat"])
+        new_sequences, merged = align(sequences, ["H\t2\t8\t100.0\t+\t0\t0\t8M\totu4\t3333"])
+        self.assertEqual(new_sequences, [">otu4", "AAAATTTT"])
+        self.assertEqual(merged, ["H\t0\t14\t100.0\t+\t0\t0\t14M\totu1\t1111", "H\t2\t8\t100.0\t+\t0\t0\t8M\totu4\t3333",
+            "H\t1\t10\t98.0\t+\t0\t0\t10M\totu3\t2222"])
+
+    def test_combine_dereplicated(self):
+        """ Test the sizes of the sequences found in more than one sample are summed (with a size
+            of one for sequences without a size) and the sequences are ordered by decreasing size """
+
+        combined = os.path.join(self.folder, "combined.fasta")
+        sixteen_s.combine_dereplicated(Task([os.path.join(DATA_FOLDER, "S1_dereplicated.fasta"),
+            os.path.join(DATA_FOLDER, "S2_dereplicated.fasta")], [combined]))
+
+        self.assertEqual(self.read_lines(combined), [">S1.4;size=6", "TTTT", ">S1.1;size=5", "ACGTACGT", ">S2.9;size=1", "GGGG"])
+
+    def test_subsample_fastq_files(self):
+        """ Test the first reads are written from each sample """
+
+        reads = [["@S1.{0}".format(i), "ACGT", "+", "IIII"] for i in range(3)]
+        sample1 = self.write_file("S1.fastq", [line for read in reads for line in read])
+        sample2 = self.write_file("S2.fastq", ["@S2.1", "GG", "+", "II"])
+        subsample = os.path.join(self.folder, "subsample.fastq")
+
+        sixteen_s.subsample_fastq_files(Task([sample1, sample2], [subsample]), reads=2)
+
+        self.assertEqual(self.read_lines(subsample), reads[0]+reads[1]+["@S2.1", "GG", "+", "II"])
+
+    def test_gather_read_counts(self):
+        """ Test the read counts for each sample are gathered into a table (skipping samples without reads) """
+
+        read_counts = [self.write_file("S1_read_count.tsv", ["S1\t10"]), self.write_file("S2_read_count.tsv", []),
+            self.write_file("S3_read_count.tsv", ["S3\t2"])]
+        table = os.path.join(self.folder, "read_counts.tsv")
+
+        sixteen_s.gather_read_counts(Task(read_counts, [table]))
+
+        self.assertEqual(self.read_lines(table), ["# sample\toriginal read count", "S1\t10", "S3\t2"])
+
+    def test_reformat_picrust2_input_otus(self):
+        """ Test the numeric otu ids are prefixed in the table and fasta file and the taxonomy column is removed """
+
+        fasta = self.write_file("otus.fasta", [">1111", "ACGT", ">2222", "GGCC"])
+        table = self.write_file("otus.tsv", ["#OTU ID\tS1\tS2\ttaxonomy", "1111\t4\t0\tk__Bacteria", "2222\t1\t2\tk__Archaea"])
+        reformatted = [os.path.join(self.folder, "reformatted.tsv"), os.path.join(self.folder, "reformatted.fasta")]
+
+        sixteen_s.reformat_picrust2_input(Task([fasta, table], reformatted), otus=True)
+
+        self.assertEqual(self.read_lines(reformatted[0]), ["#OTU ID\tS1\tS2\ttaxonomy", "seq1111\t4\t0", "seq2222\t1\t2"])
+        self.assertEqual(self.read_lines(reformatted[1]), [">seq1111", "ACGT", ">seq2222", "GGCC"])
+
+    def test_reformat_picrust2_input_asvs(self):
+        """ Test only the taxonomy column is removed from the table for asvs (and no fasta file is written) """
+
+        table = self.write_file("asvs.tsv", ["#OTU ID\tS1\ttaxonomy", "asv1\t3\tk__Bacteria"])
+        reformatted = [os.path.join(self.folder, "reformatted.tsv")]
+
+        sixteen_s.reformat_picrust2_input(Task([self.sequences, table], reformatted))
+
+        self.assertEqual(self.read_lines(reformatted[0]), ["#OTU ID\tS1\ttaxonomy", "asv1\t3"])
+        self.assertEqual(sorted(os.listdir(self.folder)), ["asvs.tsv", "reformatted.tsv"])
+
+    def test_centroid_alignment_tasks(self):
+        """ Test a set of sequences that is known to be small is aligned in a single gridable task and
+            the tasks for both alignments are added if the number of sequences is not known """
+
+        output = os.path.join(self.folder, "aligned.fasta")
+        self.track_executables(["clustalo"])
+
+        workflow = Workflow()
+        sixteen_s.centroid_alignment(workflow, self.sequences, output, 1, reference_alignment=self.sequences, chunks=2)
+        self.assertEqual([(task.name, task.gridable) for task in workflow.tasks], [("clustalo", True)])
+
+        workflow = Workflow()
+        sixteen_s.centroid_alignment(workflow, os.path.join(self.folder, "otus.fasta"), output, 1, chunks=2)
+        self.assertEqual([(task.name, task.gridable) for task in workflow.tasks], [("clustalo_reference", False), ("clustalo_reference_alignment", True),
+            ("clustalo_split", False), ("clustalo_profile____0", True), ("clustalo_profile____1", True),
+            ("clustalo_all", True), ("clustalo", False)])
+
+    def test_profile_seed_fasta(self):
+        """ Test the first sequences are written with reference ids (or none if there are too few sequences) """
+
+        seed = os.path.join(self.folder, "seed.fasta")
+
+        sixteen_s.profile_seed_fasta(Task([self.sequences], [seed]), seed_sequences=2)
+        self.assertEqual(self.read_lines(seed), [">reference_asv1", "ACGTACGTAACCGG", ">reference_asv2", "TTGCATTGCA"])
+
+        sixteen_s.profile_seed_fasta(Task([self.sequences], [seed]), seed_sequences=2, min_sequences=4)
+        self.assertEqual(self.read_lines(seed), [])
+
+    def test_merge_profile_alignments(self):
+        """ Test the reference sequences and the columns that are gaps ("-" or ".") in all of the
+            reference sequences are removed from each chunk (skipping empty chunks) """
+
+        reference = self.write_file("reference.fasta", [">ref1 seed", "AC-GT", ">ref2", "A.CGT"])
+        chunk1 = self.write_file("chunk_0_aligned.fasta", [">ref1 seed", "AC--GT", ">ref2", "A..CGT", ">asv1", "ACTTGT"])
+        chunk2 = self.write_file("chunk_1_aligned.fasta", [">ref1 seed", "AC-GT-", ">asv2 size=2", "A--GTA", ">ref2", "A.CGT."])
+        empty = self.write_file("chunk_2_aligned.fasta", [])
+        merged = os.path.join(self.folder, "merged.fasta")
+
+        sixteen_s.merge_profile_alignments(Task([reference, chunk1, empty, chunk2], [merged]))
+
+        self.assertEqual(self.read_lines(merged), [">asv1", "ACTGT", ">asv2 size=2", "A--GT"])
+
+    def test_merge_profile_alignments_all_aligned(self):
+        """ Test the alignment of all sequences is used if it is not empty """
+
+        reference = self.write_file("reference.fasta", [">ref1", "AC-GT"])
+        all_aligned = self.write_file("all_aligned.fasta", [">asv1", "ACG-T", ">asv2", "AC-GT"])
+        chunk = self.write_file("chunk_0_aligned.fasta", [])
+        merged = os.path.join(self.folder, "merged.fasta")
+
+        sixteen_s.merge_profile_alignments(Task([reference, all_aligned, chunk], [merged]), all_aligned=True)
+        self.assertEqual(self.read_lines(merged), self.read_lines(all_aligned))
+
+        all_aligned = self.write_file("all_aligned.fasta", [])
+        chunk = self.write_file("chunk_0_aligned.fasta", [">ref1", "AC-GTT", ">asv1", "ACGGT-"])
+        sixteen_s.merge_profile_alignments(Task([reference, all_aligned, chunk], [merged]), all_aligned=True)
+        self.assertEqual(self.read_lines(merged), [">asv1", "ACGT-"])
@@ -0,0 +1,195 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from biobakery_workflows import tables
+
+class TestTablesFunctions(unittest.TestCase):
+    """ Test the functions found in the biobakery workflows tables module """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="biobakery_workflows_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_table(self, name, lines):
+        """ Write the lines to a table in the temp folder """
+
+        file = os.path.join(self.folder, name)
+        with open(file, "w") as file_handle:
+            file_handle.write("\n".join(lines)+"\n")
+        return file
+
+    def read_lines(self, file):
+        with open(file) as file_handle:
+            return [line.rstrip("\n") for line in file_handle]
+
+    def write_gene_tables(self, total):
+        """ Write gene tables for the number of samples """
+
+        files = []
+        for i in range(total):
+            files.append(self.write_table("s"+str(i)+"_genefamilies.tsv",
+                ["# Gene Family\ts"+str(i)+"_Abundance-RPKs",
+                 "UniRef90_B\t"+str(i+1)+".0",
+                 "UniRef90_A|g__g1.s__s1\t0",
+                 "UNMAPPED\t"+str(i*2)+".0"] + (["UniRef90_A\t1.5"] if i % 2 else [])))
+        return files
+
+    def test_join_tables(self):
+        """ Test join tables fills in missing features and sorts special features first """
+
+        files = self.write_gene_tables(2)
+        output = os.path.join(self.folder, "joined.tsv")
+        tables.join_tables(files, output)
+
+        expected = ["# Gene Family\ts0_Abundance-RPKs\ts1_Abundance-RPKs",
+            "UNMAPPED\t0.0\t2.0",
+            "UniRef90_A\t0\t1.5",
+            "UniRef90_A|g__g1.s__s1\t0\t0",
+            "UniRef90_B\t1.0\t2.0"]
+
+        self.assertEqual(self.read_lines(output), expected)
+
+    def test_join_tables_same_header(self):
+        """ Test join tables uses the file names if all of the headers are the same """
+
+        file1 = self.write_table("s1_taxonomic_profile.tsv", ["#SampleID\tMetaphlan2_Analysis", "k__Bacteria\t100.0"])
+        file2 = self.write_table("s2_taxonomic_profile.tsv", ["#SampleID\tMetaphlan2_Analysis", "k__Archaea\t100.0"])
+        output = os.path.join(self.folder, "joined.tsv")
+        tables.join_tables([file1, file2], output)
+
+        self.assertEqual(self.read_lines(output)[0], "#SampleID\ts1_taxonomic_profile\ts2_taxonomic_profile")
+
+    def test_update_store_incremental(self):
+        """ Test adding samples to the store only adds a chunk for the new samples
+            and the materialized table matches joining all tables at once """
+
+        files = self.write_gene_tables(5)
+        store = os.path.join(self.folder, "store")
+
+        tables.update_store(store, files[:3])
+        chunks = tables.update_store(store, files)
+        self.assertEqual(len(chunks), 2)
+
+        expected_output = os.path.join(self.folder, "joined.tsv")
+        tables.join_tables(files, expected_output)
+        output = os.path.join(self.folder, "materialized.tsv")
+        tables.materialize_store(store, output)
+
+        self.assertEqual(self.read_lines(output), self.read_lines(expected_output))
+
+    def test_materialize_store_unchanged(self):
+        """ Test the materialized table is only written again if the store changes """
+
+        files = self.write_gene_tables(3)
+        store = os.path.join(self.folder, "store")
+        output = os.path.join(self.folder, "materialized.tsv")
+
+        tables.update_store(store, files[:2])
+        self.assertTrue(tables.materialize_store(store, output))
+        tables.update_store(store, files[:2])
+        self.assertFalse(tables.materialize_store(store, output))
+
+        tables.update_store(store, files)
+        self.assertTrue(tables.materialize_store(store, output))
+        self.assertEqual(len(self.read_lines(output)[0].split("\t")), 4)
+
+        # the table is written if it has been removed
+        os.remove(output)
+        self.assertTrue(tables.materialize_store(store, output))
+
+    def test_update_store_removed_sample(self):
+        """ Test removing a sample rebuilds the chunk it was stored in """
+
+        files = self.write_gene_tables(4)
+        store = os.path.join(self.folder, "store")
+
+        tables.update_store(store, files[:2])
+        tables.update_store(store, files)
+        chunks = tables.update_store(store, files[1:])
+
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual([entry[1] for entry in tables.read_store_index(store)].count(files[0]), 0)
+
+    def test_count_store_features(self):
+        """ Test the feature counts from the store """
+
+        files = self.write_gene_tables(3)
+        store = os.path.join(self.folder, "store")
+        tables.update_store(store, files[:1])
+        tables.update_store(store, files)
+
+        output = os.path.join(self.folder, "counts.tsv")
+        tables.count_store_features(store, output, reduce_sample_names=True,
+            ignore_un_features=True, ignore_stratification=True)
+
+        self.assertEqual(self.read_lines(output), ["# samples\ttotal features", "s0\t1", "s1\t2", "s2\t1"])
+
+    def test_renorm_join_tables(self):
+        """ Test normalizing tables to relative abundance with the community totals
+            and joining the original and normalized tables """
+
+        files = self.write_gene_tables(3)
+        relab_files = [os.path.join(self.folder, "s"+str(i)+"_genefamilies_relab.tsv") for i in range(3)]
+        output = os.path.join(self.folder, "joined.tsv")
+        relab_output = os.path.join(self.folder, "joined_relab.tsv")
+        tables.renorm_join_tables(files, relab_files, output, relab_output, max_open=2)
+
+        self.assertEqual(self.read_lines(relab_files[1]), ["# Gene Family\ts1_Abundance-RPKs",
+            "UniRef90_B\t0.571429", "UniRef90_A|g__g1.s__s1\t0", "UniRef90_A\t0.428571"])
+
+        expected_output = os.path.join(self.folder, "expected.tsv")
+        tables.join_tables(files, expected_output)
+        self.assertEqual(self.read_lines(output), self.read_lines(expected_output))
+
+        tables.join_tables(relab_files, expected_output)
+        self.assertEqual(self.read_lines(relab_output), self.read_lines(expected_output))
+        self.assertEqual(sorted(os.listdir(self.folder)), sorted([os.path.basename(file)
+            for file in files + relab_files + [output, relab_output, expected_output]]))
+
+    def test_regroup_table(self):
+        """ Test regrouping features within each stratum, keeping the protected features """
+
+        file = self.write_table("s1_genefamilies.tsv", ["# Gene Family\ts1_Abundance-RPKs",
+            "UNMAPPED\t2.0", "UniRef90_A\t1.25", "UniRef90_A|g__g1.s__s1\t1.25",
+            "UniRef90_B: name\t2.5", "UniRef90_C\t3.0"])
+        mapping = self.write_table("map.txt", ["1.1.1.1\tUniRef90_A\tUniRef90_B", "2.2.2.2\tUniRef90_A"])
+        output = os.path.join(self.folder, "s1_ecs.tsv")
+        tables.regroup_table(file, output, mapping)
+
+        self.assertEqual(self.read_lines(output), ["# Gene Family\ts1_Abundance-RPKs",
+            "UNMAPPED\t2.0", "UNGROUPED\t3.0", "1.1.1.1\t3.75", "1.1.1.1|g__g1.s__s1\t1.25",
+            "2.2.2.2\t1.25", "2.2.2.2|g__g1.s__s1\t1.25"])
+
+    def test_group_index(self):
+        """ Test regrouping with the group index matches regrouping with the mapping file,
+            including features with the same hash """
+
+        file = self.write_table("s1_genefamilies.tsv", ["# Gene Family\ts1_Abundance-RPKs",
+            "UNMAPPED\t2.0", "UniRef90_A\t1.25", "UniRef90_A|g__g1.s__s1\t1.25",
+            "UniRef90_B: name\t2.5", "UniRef90_C\t3.0", "UniRef90_D\t0.5"])
+        mapping = self.write_table("map.txt", ["1.1.1.1\tUniRef90_A\tUniRef90_B",
+            "2.2.2.2\tUniRef90_A\tUniRef90_D", "3.3.3.3\tUniRef90_D"])
+        index = os.path.join(self.folder, "map.index")
+
+        feature_hash = tables.feature_hash
+        tables.feature_hash = lambda feature: 1 if feature in ["UniRef90_B","UniRef90_D"] else feature_hash(feature)
+        try:
+            tables.write_group_index(mapping, index)
+            group_index = tables.GroupIndex(index)
+            self.assertEqual(group_index.get("UniRef90_D"), ["2.2.2.2","3.3.3.3"])
+            self.assertEqual(group_index.get("UniRef90_A"), ["1.1.1.1","2.2.2.2"])
+            self.assertEqual(group_index.get("UniRef90_C"), None)
+            group_index.close()
+
+            output = os.path.join(self.folder, "s1_ecs.tsv")
+            tables.regroup_table(file, output, mapping)
+            index_output = os.path.join(self.folder, "s1_ecs_index.tsv")
+            tables.regroup_table(file, index_output, index, index=True)
+        finally:
+            tables.feature_hash = feature_hash
+
+        self.assertEqual(self.read_lines(index_output), self.read_lines(output))
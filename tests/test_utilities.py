@@ -1,6 +1,9 @@
 
 import unittest
 import tempfile
+import shutil
+import subprocess
+import json
 import os
 import sys
 
@@ -16,6 +19,13 @@ def write_temp(data):
     
     return file
 
+# count the lines in a file (for the parse files test)
+def count_lines(file):
+    """ Count the lines in a file """
+
+    with open(file) as file_handle:
+        return len(file_handle.readlines())
+
 class TestUtiltiesFunctions(unittest.TestCase):
     """ Test the functions found in the biobakery workflows utilities module """
     
@@ -692,3 +702,134 @@ class TestUtiltiesFunctions(unittest.TestCase):
         
         
 
+
+    def test_file_checksum(self):
+        """ Test the file checksum function reading in small blocks """
+
+        temp_file = write_temp("database contents\n")
+        checksum = utilities.file_checksum(temp_file, block_size=4)
+        os.remove(temp_file)
+
+        self.assertEqual(checksum,"d1866763a0eec1ca3fd045a049c214e9")
+
+    def test_read_write_manifest(self):
+        """ Test writing and then reading a database manifest """
+
+        manifest = {"humann2/chocophlan/g__A.s__B.ffn.gz":"abc","kneaddata_db_human_genome/hg.1.bt2":"def"}
+        temp_file = write_temp("")
+        utilities.write_manifest(manifest, temp_file)
+        actual_manifest = utilities.read_manifest(temp_file)
+        os.remove(temp_file)
+
+        self.assertEqual(actual_manifest, manifest)
+
+    def test_link_file(self):
+        """ Test the link file function shares the contents of the source """
+
+        source = write_temp("database contents\n")
+        destination = write_temp("old contents\n")
+        method = utilities.link_file(source, destination)
+
+        with open(destination) as file_handle:
+            contents = file_handle.read()
+        same_inode = os.stat(source).st_ino == os.stat(destination).st_ino
+        os.remove(source)
+        os.remove(destination)
+
+        self.assertEqual(contents,"database contents\n")
+        self.assertEqual(method,"hardlink")
+        self.assertTrue(same_inode)
+
+    def test_parse_files(self):
+        """ Test parsing files in parallel only parses the files changed since the cached results """
+
+        files = [write_temp("line\n"*(i+1)) for i in range(3)]
+        cache_file = write_temp("")
+
+        first_counts = utilities.parse_files(count_lines, files, cache_file, threads=2)
+        # the cached result is used if the file has not changed
+        with open(cache_file) as file_handle:
+            cache = json.load(file_handle)
+        cache[files[2]][1] = 30
+        with open(cache_file,"w") as file_handle:
+            json.dump(cache, file_handle)
+        second_counts = utilities.parse_files(count_lines, files, cache_file, threads=2)
+
+        for file in files+[cache_file]:
+            os.remove(file)
+
+        self.assertEqual(first_counts,[1,2,3])
+        self.assertEqual(second_counts,[1,2,30])
+
+    def test_import_time(self):
+        """ Test importing the utilities module (in a new process) only imports the standard library
+            and is fast, as it is imported by every workflow and grid task """
+
+        script = "; ".join(["import sys, time","start = time.time()",
+            "import biobakery_workflows.utilities, biobakery_workflows.visualizations",
+            "elapsed = time.time() - start",
+            "heavy = sorted(name for name in sys.modules if name.split('.')[0] in ['anadama2','numpy','matplotlib','pweave','urllib2'])",
+            "print(str(elapsed) + '\\t' + ','.join(heavy))"])
+        package_folder = os.path.dirname(os.path.dirname(os.path.abspath(utilities.__file__)))
+        output = subprocess.check_output([sys.executable, "-c", script], cwd=package_folder)
+        elapsed, heavy = output.decode("utf-8").strip("\n").split("\t")
+
+        self.assertEqual(heavy, "")
+        self.assertLess(float(elapsed), 1.0)
+
+    def test_read_fasta(self):
+        """ Test reading the sequences from a fasta file with sequences on multiple lines """
+
+        fasta_file = write_temp(">seq1 description\nACGT\nAC\n\n>seq2\nGG\n")
+        sequences = utilities.read_fasta(fasta_file)
+        ids = utilities.read_fasta(fasta_file, id_only=True)
+        os.remove(fasta_file)
+
+        self.assertEqual(sequences, [["seq1 description", "ACGTAC"], ["seq2", "GG"]])
+        self.assertEqual(ids, [["seq1", "ACGTAC"], ["seq2", "GG"]])
+
+    def test_append_to_cache(self):
+        """ Test the header is only written to a new cache file """
+
+        cache_folder = tempfile.mkdtemp(prefix="biobakery_workflows_test")
+        cache_file = os.path.join(cache_folder, "key", "cache.tsv")
+        utilities.append_to_cache(cache_file, ["a\t1"], header="#hash\tvalue")
+        utilities.append_to_cache(cache_file, ["b\t2", "c\t3"], header="#hash\tvalue")
+        with open(cache_file) as file_handle:
+            lines = file_handle.readlines()
+        shutil.rmtree(cache_folder)
+
+        self.assertEqual(lines, ["#hash\tvalue\n", "a\t1\n", "b\t2\n", "c\t3\n"])
+        self.assertEqual(utilities.sequence_hash("acgt"), utilities.sequence_hash("ACGT"))
+
+    def test_extract_clade_markers(self):
+        """ Test extracting the markers for multiple clades in one pass """
+
+        import bz2
+        import pickle
+
+        database = {"markers": {"m1": {"clade": "s__A"}, "m2": {"clade": "s__B"},
+            "m3": {"clade": "s__A"}, "m4": {"clade": "s__C"}}}
+        handle, pkl_file = tempfile.mkstemp(prefix="biobakery_workflows_test")
+        os.close(handle)
+        with bz2.BZ2File(pkl_file, "w") as file_handle:
+            pickle.dump(database, file_handle, 2)
+        markers_file = write_temp("\n".join([">m1 marker one", "ACGT", "AC", ">m2", "GG",
+            ">m4", "TT", ">m3", "A"*70])+"\n")
+        clade_files = {"s__A": markers_file+".s__A", "s__B": markers_file+".s__B"}
+
+        counts = utilities.extract_clade_markers(pkl_file, markers_file, clade_files)
+        temp_files = [file for file in os.listdir(os.path.dirname(markers_file))
+            if file.startswith(os.path.basename(markers_file)) and file.endswith(".tmp")]
+        contents = {}
+        for clade, file in clade_files.items():
+            with open(file) as file_handle:
+                contents[clade] = file_handle.read()
+            os.remove(file)
+        os.remove(pkl_file)
+        os.remove(markers_file)
+
+        self.assertEqual(temp_files, [])
+        self.assertEqual(counts, {"s__A": 2, "s__B": 1})
+        self.assertEqual(contents["s__A"], ">m1 marker one\nACGTAC\n>m3\n"+"A"*60+"\n"+"A"*10+"\n")
+        self.assertEqual(contents["s__B"], ">m2\nGG\n")